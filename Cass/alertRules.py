@@ -0,0 +1,172 @@
+import json
+import logging
+import threading
+from collections import deque, namedtuple
+
+log = logging.getLogger()
+
+'''
+========================================================
+==                 Alert rule engine                  ==
+========================================================
+
+Rules are read from a JSON file shaped like:
+
+    {
+        "cooldown_minutes": 15,
+        "rules": [
+            {"low": 0, "high": 1000},
+            {"type": "heart rate", "low": 60, "high": 100, "hysteresis": 2},
+            {"type": "heart rate", "account_id": "P0001", "low": 50, "high": 110,
+             "count": 3, "minutes": 10}
+        ]
+    }
+
+A rule without type or account_id is the global fallback. The most
+specific rule wins: account and type, then account, then type, then
+global. "count" readings out of range within "minutes" start an alarm.
+The alarm clears once a reading is back inside the range narrowed by
+"hysteresis" on both sides. Each alarm raises one alert, and alarms for
+the same account and type raise at most one alert per cooldown.
+
+Readings of an account and type must reach an engine in time order, one
+older than the last evaluated for its pair is skipped and counted in
+out_of_order. Loads of historic readings evaluate them on an engine of
+their own, see AlertRules.fresh.
+'''
+
+DEFAULT_COOLDOWN_MINUTES = 15
+
+# window and cooldown are in seconds
+Rule = namedtuple('Rule', ['low', 'high', 'hysteresis', 'count', 'window', 'cooldown'])
+
+def compile_rule(spec, cooldown_minutes):
+    return Rule(
+        low=float(spec.get('low', float('-inf'))),
+        high=float(spec.get('high', float('inf'))),
+        hysteresis=float(spec.get('hysteresis', 0)),
+        count=max(1, int(spec.get('count', 1))),
+        window=float(spec.get('minutes', 0)) * 60,
+        cooldown=float(spec.get('cooldown_minutes', cooldown_minutes)) * 60,
+    )
+
+class AlertRules(object):
+
+    def __init__(self, rules, cooldown_minutes=DEFAULT_COOLDOWN_MINUTES):
+        self._specs = list(rules)
+        self.cooldown_minutes = cooldown_minutes
+        # Compiled rules keyed by (account_id, type), either may be None
+        self._rules = {}
+        for spec in rules:
+            key = (spec.get('account_id'), spec.get('type'))
+            self._rules[key] = compile_rule(spec, cooldown_minutes)
+
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._last_alert = {}
+        self._last_seen = {}
+        # (account_id, type) pairs currently in alarm, readable without the lock
+        self.alarmed = set()
+        self.evaluated = 0
+        self.alerts = 0
+        self.suppressed = 0
+        self.out_of_order = 0
+
+    def fresh(self):
+        # The same rules without any window, alarm or cooldown state
+        return AlertRules(self._specs, self.cooldown_minutes)
+
+    @classmethod
+    def from_ranges(cls, ranges, cooldown_minutes=DEFAULT_COOLDOWN_MINUTES):
+        return cls([{"type": vital_sign_type, "low": low, "high": high}
+                    for vital_sign_type, (low, high) in ranges.items()], cooldown_minutes)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, mode='r') as file:
+            config = json.load(file)
+        return cls(config.get('rules', []), config.get('cooldown_minutes', DEFAULT_COOLDOWN_MINUTES))
+
+    def rule_for(self, account_id, vital_sign_type):
+        rules = self._rules
+        return (rules.get((account_id, vital_sign_type)) or rules.get((account_id, None))
+                or rules.get((None, vital_sign_type)) or rules.get((None, None)))
+
+    def prefilter_ranges(self):
+        # Narrowest (low, high) of every rule that may apply to each type,
+        # plus the one for types without rules (None if they never alert).
+        # A reading inside it cannot start an alarm under any rule
+        ranges = {}
+        default = None
+        for (account_id, vital_sign_type), rule in self._rules.items():
+            if vital_sign_type is None:
+                default = _narrowest(default, rule)
+        for (account_id, vital_sign_type), rule in self._rules.items():
+            if vital_sign_type is not None:
+                ranges[vital_sign_type] = _narrowest(ranges.get(vital_sign_type, default), rule)
+        return ranges, default
+
+    def evaluate(self, account_id, vital_sign_type, timestamp, value):
+        # Returns True when this reading should raise an alert. Readings
+        # must arrive in time order per account and type
+        rule = self.rule_for(account_id, vital_sign_type)
+        if rule is None:
+            return False
+        key = (account_id, vital_sign_type)
+
+        with self._lock:
+            self.evaluated += 1
+            last_seen = self._last_seen.get(key)
+            if last_seen is not None and timestamp < last_seen:
+                self.out_of_order += 1
+                return False
+            self._last_seen[key] = timestamp
+            if rule.low <= value <= rule.high:
+                if (key in self.alarmed
+                        and rule.low + rule.hysteresis <= value <= rule.high - rule.hysteresis):
+                    self.alarmed.discard(key)
+                return False
+
+            window = self._windows.setdefault(key, deque())
+            window.append(timestamp)
+            while window[0] < timestamp - rule.window:
+                window.popleft()
+
+            if key in self.alarmed:
+                self.suppressed += 1
+                return False
+            if len(window) < rule.count:
+                return False
+
+            self.alarmed.add(key)
+            last_alert = self._last_alert.get(key)
+            if last_alert is not None and timestamp - last_alert < rule.cooldown:
+                self.suppressed += 1
+                return False
+            self._last_alert[key] = timestamp
+            self.alerts += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "evaluated": self.evaluated,
+                "alerts": self.alerts,
+                "suppressed": self.suppressed,
+                "out_of_order": self.out_of_order,
+                "alarmed": len(self.alarmed),
+            }
+
+def _narrowest(current, rule):
+    if current is None:
+        return (rule.low, rule.high)
+    return (max(current[0], rule.low), min(current[1], rule.high))
+
+def load_rules(path, ranges):
+    # Falls back to one rule per type built from ranges when there is no file
+    if path:
+        try:
+            return AlertRules.from_file(path)
+        except (OSError, ValueError) as exc:
+            log.error(f"Could not load alert rules from {path}: {exc}")
+    return AlertRules.from_ranges(ranges)
@@ -0,0 +1,288 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from Cass import cassandraModel as model
+from Cass import clusterProfile
+
+log = logging.getLogger()
+
+'''
+========================================================
+==                Event loop bridge                   ==
+========================================================
+'''
+
+# The functions below mirror the model ones but return their rows instead
+# of printing them, so callers can await many of them at once with
+# asyncio.gather from a single thread. Statements are prepared the first
+# time they are used, call model.prepare_statements at start up so that
+# never blocks the event loop
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _reject(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+def wrap_future(response_future, all_pages=False):
+    # Turns a driver ResponseFuture into an asyncio future. The driver
+    # calls back from its own event thread, so the result is handed over
+    # with call_soon_threadsafe. With all_pages every page is fetched and
+    # the future resolves to the full list of rows, otherwise it resolves
+    # to (rows, paging_state) for the first page
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    rows = []
+
+    def on_page(page):
+        if all_pages:
+            rows.extend(page or [])
+            if response_future.has_more_pages:
+                # The callbacks stay registered and fire again for the next page
+                response_future.start_fetching_next_page()
+                return
+            result = rows
+        else:
+            # The future is done by the time its callbacks run, result()
+            # returns at once
+            result_set = response_future.result()
+            result = (list(page or []), result_set.paging_state)
+        try:
+            loop.call_soon_threadsafe(_resolve, future, result)
+        except RuntimeError:
+            # The loop was closed while the query was in flight
+            pass
+
+    def on_error(exc):
+        try:
+            loop.call_soon_threadsafe(_reject, future, exc)
+        except RuntimeError:
+            pass
+
+    response_future.add_callbacks(on_page, on_error)
+    future.add_done_callback(lambda done: done.cancelled() and response_future.cancel())
+    return future
+
+async def execute(session, query, params, execution_profile=model.EXEC_PROFILE_DEFAULT):
+    bound = model.get_prepared(session, query).bind(params)
+    return await wrap_future(session.execute_async(bound, execution_profile=execution_profile), all_pages=True)
+
+async def execute_page(session, query, params, fetch_size=model.DEFAULT_FETCH_SIZE, paging_state=None):
+    bound = model.get_prepared(session, query).bind(params)
+    bound.fetch_size = fetch_size
+    return await wrap_future(session.execute_async(bound, paging_state=paging_state))
+
+async def gather(aws, concurrency=model.BULK_CONCURRENCY):
+    # asyncio.gather with at most concurrency awaitables in flight
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(bounded(aw) for aw in aws))
+
+async def execute_writes(session, writes, concurrency=model.BULK_CONCURRENCY,
+                         execution_profile=model.EXEC_PROFILE_DEFAULT):
+    # writes are (query, params) pairs
+    await gather((execute(session, query, params, execution_profile) for query, params in writes), concurrency)
+
+'''
+========================================================
+==                     Accounts                       ==
+========================================================
+'''
+
+async def get_user(session, account_id):
+    row = model.accounts.get(account_id)
+    if row is not None:
+        return row
+
+    rows = await execute(session, model.SELECT_ACCOUNTS, [account_id])
+    row = rows[0] if rows else None
+    if row is not None:
+        model.accounts.put(account_id, row)
+    return row
+
+async def get_users(session, account_ids, concurrency=model.BULK_CONCURRENCY):
+    # Returns {account_id: row or None}, sharing the model's account cache
+    account_ids = list(set(account_ids))
+    rows = await gather((get_user(session, account_id) for account_id in account_ids), concurrency)
+    return dict(zip(account_ids, rows))
+
+async def create_account(session, accountData):
+    insertAccountData = [accountData[0], accountData[4], accountData[1],
+                            accountData[2], accountData[5], accountData[6]]
+    await execute(session, model.INSERT_ACCOUNT, insertAccountData)
+    model.accounts.invalidate(accountData[0])
+
+async def insert_patient(session, patientData):
+    await asyncio.gather(execute(session, model.INSERT_PATIENT, list(patientData[:4])),
+                         create_account(session, patientData))
+
+async def insert_doctor(session, doctorData):
+    await asyncio.gather(execute(session, model.INSERT_DOCTOR, list(doctorData[:4])),
+                         create_account(session, doctorData))
+
+'''
+========================================================
+==                   Appointments                     ==
+========================================================
+'''
+
+async def execute_fan_out(session, writes, mode=model.APPOINTMENT_WRITE_MODE, retries=model.APPOINTMENT_WRITE_RETRIES):
+    # Same retries and WriteReport as model.execute_fan_out
+    rounds = model.fan_out_rounds(session, writes, mode, retries)
+    try:
+        delay, statements = next(rounds)
+        while True:
+            if delay:
+                await asyncio.sleep(delay)
+            results = await asyncio.gather(*(wrap_future(session.execute_async(stmt), all_pages=True)
+                                             for stmt in statements), return_exceptions=True)
+            delay, statements = rounds.send([result if isinstance(result, Exception) else None
+                                             for result in results])
+    except StopIteration as stop:
+        return stop.value
+
+async def insert_appointment(session, appointmentData, alertData=None, mode=model.APPOINTMENT_WRITE_MODE):
+    return await execute_fan_out(session, model.appointment_writes(appointmentData, alertData), mode)
+
+async def update_appointment(session, appointmentData, mode=model.APPOINTMENT_WRITE_MODE):
+    rows = await execute(session, model.SELECT_APPOINTMENT_DATE_BY_DOCTOR, [appointmentData[2], appointmentData[0]])
+    appointment_date = rows[0].appointment_date if rows else None
+    return await execute_fan_out(session, model.appointment_update_writes(appointmentData, appointment_date), mode)
+
+async def get_doctor_calendar(session, doctor_id, day, days=1):
+    if isinstance(day, datetime):
+        day = day.date()
+    dates = [day + timedelta(days=i) for i in range(days)]
+    results = await asyncio.gather(*(execute(session, model.SELECT_APPOINTMENTS_BY_DOCTOR_DAY, [doctor_id, date])
+                                     for date in dates))
+    return dict(zip(dates, results))
+
+async def get_appointments_by_patient(session, patient_id, appointment_date=None,
+                                      fetch_size=model.DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = model.appointments_by_patient_query(patient_id, appointment_date)
+    return await execute_page(session, query, params, fetch_size, paging_state)
+
+async def get_appointments_by_doctor(session, doctor_id, appointment_date=None,
+                                     fetch_size=model.DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = model.appointments_by_doctor_query(doctor_id, appointment_date)
+    return await execute_page(session, query, params, fetch_size, paging_state)
+
+async def get_appointments_by_patient_doctor(session, patient_id, doctor_id, appointment_date=None,
+                                             fetch_size=model.DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = model.appointments_by_patient_doctor_query(patient_id, doctor_id, appointment_date)
+    return await execute_page(session, query, params, fetch_size, paging_state)
+
+'''
+========================================================
+==                   Vital signs                      ==
+========================================================
+'''
+
+async def insert_vital_sign(session, vitalSignData):
+    vitalSignData = model.vital_sign_row(session, vitalSignData)
+    writes = [(query, vitalSignData) for query in model.VITAL_SIGN_INSERTS]
+    writes.append((model.INSERT_VITAL_SIGN_TYPE, vitalSignData[1:3]))
+    writes.append((model.INSERT_LATEST_VITAL_SIGN, model.latest_vital_sign_params(vitalSignData)))
+    # At the profile the rollup rebuilds read with, see model.refresh_rollups
+    await execute_writes(session, writes, execution_profile=model.profile_for(session, clusterProfile.PROFILE_BULK))
+    # Rebuilt by the session's RollupRefresher thread, off the event loop
+    model.get_rollup_refresher(session).mark([model.rollup_key(vitalSignData[1], vitalSignData[2], vitalSignData[0])])
+
+async def delete_vital_signs(session, account_id, start_date, end_date, concurrency=model.BULK_CONCURRENCY):
+    start_date, end_date = model.delete_range(start_date, end_date)
+    indexed, latest = await asyncio.gather(execute(session, model.SELECT_VITAL_SIGN_TYPES_BY_ACCOUNT, [account_id]),
+                                           get_latest_vitals(session, [account_id]))
+    latest = latest[account_id].values()
+    # Same types as model.vital_sign_types
+    types = {row.type for row in indexed} | {row.type for row in latest}
+    writes = model.vital_sign_deletes(account_id, start_date, end_date, types)
+    writes.extend(model.latest_vital_sign_deletes(latest, start_date, end_date))
+    # The rollup lookup and rebuild use the blocking driver API, as in
+    # model.delete_vital_signs, keep them off the event loop
+    loop = asyncio.get_running_loop()
+    touched = await loop.run_in_executor(None, model.rollup_hours, session, account_id, types, start_date, end_date)
+    await execute_writes(session, writes, concurrency,
+                         model.profile_for(session, clusterProfile.PROFILE_BULK))
+    await loop.run_in_executor(None, model.refresh_rollups, session, touched)
+
+async def get_latest_vitals(session, account_ids, concurrency=model.BULK_CONCURRENCY):
+    # {account_id: {type: row}}
+    account_ids = list(dict.fromkeys(account_ids))
+    results = await gather((execute(session, model.SELECT_LATEST_VITAL_SIGNS, [account_id])
+                            for account_id in account_ids), concurrency)
+    return {account_id: {row.type: row for row in rows} for account_id, rows in zip(account_ids, results)}
+
+async def get_vital_signs(session, account_id, start_date=None, end_date=None, vital_sign_type=None,
+                          fetch_size=model.DEFAULT_FETCH_SIZE, paging_state=None):
+    # Same pages and paging state as model.get_vital_signs_page
+    walk = model.vital_sign_page_walk(account_id, start_date, end_date, vital_sign_type, fetch_size, paging_state)
+    try:
+        requests = next(walk)
+        while True:
+            pages = await asyncio.gather(*(execute_page(session, query, params, size, state)
+                                           for query, params, size, state in requests))
+            requests = walk.send(pages)
+    except StopIteration as stop:
+        return stop.value
+
+async def get_vital_signs_range(session, account_id, start_date=None, end_date=None, vital_sign_type=None,
+                                concurrency=model.BULK_CONCURRENCY):
+    # Every row in the range, newest first
+    start_date, end_date = model.default_date_range(start_date, end_date)
+    queries = [model.vital_sign_query(account_id, bucket, start_date, end_date, vital_sign_type)
+               for bucket in model.vital_sign_buckets(start_date, end_date)]
+    results = await gather((execute(session, query, params) for query, params in queries), concurrency)
+    return [row for rows in results for row in rows]
+
+async def get_vital_signs_many(session, account_ids, start_date=None, end_date=None, vital_sign_types=None,
+                               concurrency=model.BULK_CONCURRENCY):
+    # Async generator of (account_id, rows) in the order patients finish,
+    # as model.get_vital_signs_many
+    start_date, end_date = model.default_date_range(start_date, end_date)
+    types = list(dict.fromkeys(vital_sign_types or [None]))
+    buckets = model.vital_sign_buckets(start_date, end_date)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(query, params):
+        async with semaphore:
+            return await execute(session, query, params)
+
+    async def patient(account_id):
+        results = await asyncio.gather(*(bounded(*model.vital_sign_query(account_id, bucket, start_date, end_date,
+                                                                          vital_sign_type))
+                                         for vital_sign_type in types for bucket in buckets))
+        rows = [row for rows in results for row in rows]
+        return account_id, sorted(rows, key=lambda row: row.vital_sign_id.time, reverse=True)
+
+    tasks = [asyncio.ensure_future(patient(account_id)) for account_id in dict.fromkeys(account_ids)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def get_vital_signs_summary(session, account_id, vital_sign_type, start_date=None, end_date=None,
+                                  max_points=model.DEFAULT_SUMMARY_POINTS):
+    resolution, query, params = model.summary_query(account_id, vital_sign_type, start_date, end_date, max_points)
+    return resolution, await execute(session, query, params)
+
+'''
+========================================================
+==                      Alerts                        ==
+========================================================
+'''
+
+async def insert_alert(session, alertData):
+    await execute(session, model.INSERT_ALERT_BY_ACCOUNT_DATE, alertData)
+
+async def get_alerts(session, account_id, fetch_size=model.DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = model.alerts_query(account_id)
+    return await execute_page(session, query, params, fetch_size, paging_state)
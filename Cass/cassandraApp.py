@@ -5,9 +5,10 @@ from datetime import datetime
 import datetime as dt
 from uuid import UUID
 
-from cassandra.cluster import Cluster
-
 from Cass import cassandraModel as model
+from Cass import vitalAnalytics
+from Cass import vitalExport
+from Cass import queryStats
 
 #Set logger
 log = logging.getLogger()
@@ -17,7 +18,6 @@ handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(
 log.addHandler(handler)
 
 # Read env vars related to Cassandra App
-CLUSTER_IPS = os.getenv('CASSANDRA_CLUSTER_IPS', 'localhost')
 KEYSPACE = os.getenv('CASSANDRA_KEYSPACE', 'healthcare')
 REPLICATION_FACTOR = os.getenv('CASSANDRA_REPLICATION_FACTOR', '1')
 
@@ -62,6 +62,15 @@ def handle_date_ranges():
 
     return date_range
 
+def print_pages(fetch_page):
+    # fetch_page prints one page for a paging state and returns the next one
+    paging_state = fetch_page(None)
+    while paging_state:
+        more = input("Press Enter for more results ('q' to stop): ")
+        if more.lower() == 'q':
+            break
+        paging_state = fetch_page(paging_state)
+
 def printMenuDoctor():
     mm_options = {
         0: "Create a new patient",
@@ -71,6 +80,11 @@ def printMenuDoctor():
         4: "View vital signs",
         5: "Delete vital signs",
         6: "Create a new doctor",
+        7: "Analyze vital signs",
+        8: "Latest vital signs of patients",
+        9: "Population vital sign report",
+        11: "Ward vital signs",
+        12: "Vital sign percentiles",
         10: "Exit"
     }
     for key in mm_options.keys():
@@ -109,8 +123,17 @@ def createAppointment(session):
     alertData[3] = "Appointment"
     alertData[4] = f"You have an appointment scheduled with doctor {appointmentData[3]}"
 
-    model.insert_appointment(session, appointmentData)
-    model.insert_alert(session, alertData)
+    conflicts = model.find_conflicts(session, appointmentData[3], date)
+    if conflicts:
+        print("**** The doctor already has an appointment at that time ****")
+        for row in conflicts:
+            print(f"=== {row.appointment_id} with {row.patient_id} ({row.status})")
+        return
+
+    report = model.insert_appointment(session, appointmentData, alertData)
+    if not report.ok:
+        print(f"**** Appointment partially saved: {report} ****")
+        return
 
     print("**** Appointment created ****")
 
@@ -126,7 +149,10 @@ def updateAppointment(session, accountData):
     appointmentData[3] = input("Enter status (leave empty for no changes): ")
     appointmentData[4] = input("Enter notes (leave empty for no changes): ")
 
-    model.update_appointment(session, appointmentData)
+    report = model.update_appointment(session, appointmentData)
+    if not report.ok:
+        print(f"**** Appointment partially updated: {report} ****")
+        return
 
     print("**** Appointment updated ****")
 
@@ -142,9 +168,11 @@ def viewAppointmentsDoctor(session, accountData):
         date = datetime.now()
 
     if patientId:
-        model.get_appointments_by_patient_doctor(session, patientId, accountData['account_id'], date)
+        print_pages(lambda state: model.get_appointments_by_patient_doctor(
+            session, patientId, accountData['account_id'], date, paging_state=state))
     else:
-        model.get_appointments_by_doctor(session, accountData['account_id'], date)
+        week = input("Show the whole week? [y/N]: ").strip().lower() == 'y'
+        model.print_doctor_calendar(session, accountData['account_id'], date, 7 if week else 1)
 
 def viewVitalSignsbyPatient(session):
     os.system("cls")
@@ -155,9 +183,108 @@ def viewVitalSignsbyPatient(session):
 
     if vitalSignType:
         vitalSignType = vitalSignType.lower()
-        model.get_vital_signs(session, patientId, dateRange[0], dateRange[1], vitalSignType)
     else:
-        model.get_vital_signs(session, patientId, dateRange[0], dateRange[1])
+        vitalSignType = None
+    print_pages(lambda state: model.get_vital_signs(
+        session, patientId, dateRange[0], dateRange[1], vitalSignType, paging_state=state))
+
+def analyzeVitalSignsbyPatient(session):
+    os.system("cls")
+    print("**** Analyze vital signs ****")
+    patientId = input("Enter patient ID:")
+    dateRange = handle_date_ranges()
+
+    report = vitalAnalytics.analyze_vital_signs(session, patientId, dateRange[0], dateRange[1])
+    if not report:
+        print("You have no vital signs registered.")
+        return
+
+    for vitalSignType, summary in report.items():
+        print(" ")
+        print(f"**** {vitalSignType} ****")
+        print(f"=== Readings: {summary['count']}")
+        print(f"=== Mean: {summary['mean']:.2f} (min {summary['min']:.2f}, max {summary['max']:.2f})")
+        print(f"=== Out of range: {summary['out_of_range']}")
+        print(f"=== Anomalies: {summary['anomalies']}")
+        print(f"=== Trend: {summary['slope_per_day']:+.3f} per day")
+
+def viewVitalSignPercentiles(session):
+    os.system("cls")
+    print("**** Vital sign percentiles ****")
+    patientId = input("Enter patient ID:")
+    vitalSignType = input("Enter vital sign type:").lower()
+    dateRange = handle_date_ranges()
+
+    readings, percentiles = model.get_vital_sign_percentiles(session, patientId, vitalSignType, dateRange[0], dateRange[1])
+    if not readings:
+        print("You have no vital signs registered.")
+        return
+    print(f"=== Whole range: {readings} readings, median {percentiles[50]:.1f}, p95 {percentiles[95]:.1f}")
+    for day, readings, percentiles in model.get_daily_percentiles(session, patientId, vitalSignType,
+                                                                   dateRange[0], dateRange[1]):
+        print(f"=== {day:%Y-%m-%d}: {readings} readings, median {percentiles[50]:.1f}, p95 {percentiles[95]:.1f}")
+
+def viewLatestVitalSigns(session):
+    os.system("cls")
+    print("**** Latest vital signs ****")
+    patientIds = [patientId.strip() for patientId in input("Enter patient IDs separated by commas:").split(',')]
+
+    latest = model.get_latest_vitals(session, [patientId for patientId in patientIds if patientId])
+    for patientId, vitalSigns in latest.items():
+        print(" ")
+        print(f"**** {patientId} ****")
+        if not vitalSigns:
+            print("=== No vital signs registered")
+        for vitalSignType, row in sorted(vitalSigns.items()):
+            print(f"=== {vitalSignType}: {row.value} ({row.date})")
+
+def viewWardVitalSigns(session):
+    os.system("cls")
+    print("**** Ward vital signs ****")
+    patientIds = [patientId.strip() for patientId in input("Enter patient IDs separated by commas:").split(',')]
+    dateRange = handle_date_ranges()
+    vitalSignTypes = [vitalSignType.strip().lower() for vitalSignType in
+                      input("Enter vital sign types separated by commas (leave empty for all):").split(',')]
+
+    # Patients are printed in the order their readings arrive
+    for patientId, rows in model.get_vital_signs_many(session, [patientId for patientId in patientIds if patientId],
+                                                      dateRange[0], dateRange[1],
+                                                      [vitalSignType for vitalSignType in vitalSignTypes if vitalSignType]):
+        print(" ")
+        print(f"**** {patientId} ****")
+        if not rows:
+            print("=== No vital signs registered")
+        for row in rows:
+            print(f"=== {row.date} {row.type}: {row.value}")
+
+def populationVitalSigns(session):
+    os.system("cls")
+    print("**** Population vital sign report ****")
+    vitalSignType = input("Enter vital sign type:").lower()
+    dateRange = handle_date_ranges()
+
+    report = vitalAnalytics.population_out_of_range(session, vitalSignType, dateRange[0], dateRange[1])
+    print(f"=== Patients with readings: {report['patients']}")
+    print(f"=== Patients out of range: {report['abnormal']} ({report['share']:.1%})")
+
+def exportVitalSigns(session):
+    os.system("cls")
+    print("**** Export vital signs ****")
+    accountIds = [accountId.strip() for accountId in input("Enter patient IDs separated by commas (leave empty for all):").split(',')]
+    dateRange = handle_date_ranges()
+    outDir = input("Enter output directory (leave empty for ./export):") or os.path.join('.', 'export')
+    fileFormat = input("Enter format [parquet/arrow] (leave empty for parquet):").lower() or 'parquet'
+
+    rows, files = vitalExport.export_vital_signs(session, outDir, [accountId for accountId in accountIds if accountId],
+                                                 dateRange[0], dateRange[1], file_format=fileFormat)
+    print(f"*** Exported {rows} vital signs to {files} files in {outDir} ***")
+
+def viewQueryStats(session):
+    os.system("cls")
+    print("**** Query statistics ****")
+    print(queryStats.query_stats.report())
+    if input("Reset statistics? [y/n]:").lower() == 'y':
+        queryStats.query_stats.reset()
 
 def deleteVitalSignsDoctor(session):
     os.system("cls")
@@ -179,9 +306,11 @@ def viewAppointmentsPatient(session, accountData):
         date = datetime.now()
     
     if doctorId:
-        model.get_appointments_by_patient_doctor(session, accountData['account_id'], doctorId, date)
+        print_pages(lambda state: model.get_appointments_by_patient_doctor(
+            session, accountData['account_id'], doctorId, date, paging_state=state))
     else:
-        model.get_appointments_by_patient(session, accountData['account_id'], date)
+        print_pages(lambda state: model.get_appointments_by_patient(
+            session, accountData['account_id'], date, paging_state=state))
 
 def viewVitalSignsPatient(session, accountData):
     os.system("cls")
@@ -191,11 +320,12 @@ def viewVitalSignsPatient(session, accountData):
 
     if vitalSignType:
         vitalSignType = vitalSignType.lower()
-        model.get_vital_signs(session, accountData['account_id'], dateRange[0], dateRange[1], vitalSignType)
     else:
-        model.get_vital_signs(session, accountData['account_id'], dateRange[0], dateRange[1])
+        vitalSignType = None
+    print_pages(lambda state: model.get_vital_signs(
+        session, accountData['account_id'], dateRange[0], dateRange[1], vitalSignType, paging_state=state))
 
 def viewAlertsPatient(session, accountData):
     os.system("cls")
     print("**** View alerts ****")
-    model.get_alerts(session, accountData['account_id'])
+    print_pages(lambda state: model.get_alerts(session, accountData['account_id'], paging_state=state))
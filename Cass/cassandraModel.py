@@ -1,11 +1,29 @@
 import time_uuid
 import logging
+import os
+import time
 from datetime import datetime
 import datetime as dt
 import random
 from uuid import UUID
-from cassandra.query import BatchStatement
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
+from cassandra.cluster import EXEC_PROFILE_DEFAULT
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+import atexit
 import csv
+import functools
+import hashlib
+import multiprocessing
+import struct
+from collections import OrderedDict
+from itertools import chain, islice
+import queue
+import threading
+import weakref
+
+from Cass import alertRules
+from Cass import clusterProfile
+from Cass import quantileSketch
 
 log = logging.getLogger()
 
@@ -88,26 +106,84 @@ CREATE_APPOINTMENTS_BY_DATE_PD_TABLE = """
     )WITH CLUSTERING ORDER BY (appointment_id DESC);
 """
 
-CREATE_VITAL_SIGNS_BY_ACCOUNT_DATE_TABLE = """
-    CREATE TABLE IF NOT EXISTS vital_signs_by_account_date (
+# One partition per doctor and day, the calendar of a day is a single read
+CREATE_APPOINTMENTS_BY_DOCTOR_DAY_TABLE = """
+    CREATE TABLE IF NOT EXISTS appointments_by_doctor_day (
+        appointment_id TIMEUUID,
+        appointment_date DATE,
+        patient_id TEXT,
+        doctor_id TEXT,
+        status TEXT,
+        notes TEXT,
+        PRIMARY KEY ((doctor_id, appointment_date), appointment_id)
+    )WITH CLUSTERING ORDER BY (appointment_id ASC);
+"""
+
+# Vital signs are split into time buckets (see vital_sign_bucket) so a
+# continuously monitored patient does not grow a single partition forever
+CREATE_VITAL_SIGNS_BY_ACCOUNT_BUCKET_TABLE = """
+    CREATE TABLE IF NOT EXISTS vital_signs_by_account_bucket (
         vital_sign_id TIMEUUID,
         account_id TEXT,
         type TEXT,
         value DOUBLE,
         date DATE,
-        PRIMARY KEY (account_id, vital_sign_id)
+        bucket INT,
+        PRIMARY KEY ((account_id, bucket), vital_sign_id)
     )WITH CLUSTERING ORDER BY (vital_sign_id DESC);
 """
 
-CREATE_VITAL_SIGNS_BY_ACCOUNT_TYPE_DATE_TABLE = """
-    CREATE TABLE IF NOT EXISTS vital_signs_by_account_type_date (
+CREATE_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET_TABLE = """
+    CREATE TABLE IF NOT EXISTS vital_signs_by_account_type_bucket (
         vital_sign_id TIMEUUID,
         account_id TEXT,
         type TEXT,
         value DOUBLE,
         date DATE,
-        PRIMARY KEY (account_id, type, vital_sign_id)
-    )WITH CLUSTERING ORDER BY (type DESC, vital_sign_id DESC);
+        bucket INT,
+        PRIMARY KEY ((account_id, type, bucket), vital_sign_id)
+    )WITH CLUSTERING ORDER BY (vital_sign_id DESC);
+"""
+
+# Most recent reading per account and type. Writes carry the reading's own
+# time as their timestamp, so the newest reading wins whatever the order
+# the writes arrive in
+CREATE_LATEST_VITAL_SIGNS_TABLE = """
+    CREATE TABLE IF NOT EXISTS latest_vital_signs (
+        account_id TEXT,
+        type TEXT,
+        vital_sign_id TIMEUUID,
+        value DOUBLE,
+        date DATE,
+        PRIMARY KEY (account_id, type)
+    );
+"""
+
+# Every type stored for an account, written with each reading so deletes
+# know which per type partitions to clear without reading the readings
+CREATE_VITAL_SIGN_TYPES_BY_ACCOUNT_TABLE = """
+    CREATE TABLE IF NOT EXISTS vital_sign_types_by_account (
+        account_id TEXT,
+        type TEXT,
+        PRIMARY KEY (account_id, type)
+    );
+"""
+
+# Pre-aggregated vital signs per hour and day, kept up to date on ingest.
+# The sketch column is added through SCHEMA_COLUMNS
+CREATE_VITAL_SIGN_ROLLUPS_TABLE = """
+    CREATE TABLE IF NOT EXISTS vital_sign_rollups (
+        account_id TEXT,
+        type TEXT,
+        resolution TEXT,
+        period TIMESTAMP,
+        min_value DOUBLE,
+        max_value DOUBLE,
+        avg_value DOUBLE,
+        sum_value DOUBLE,
+        count INT,
+        PRIMARY KEY ((account_id, type, resolution), period)
+    )WITH CLUSTERING ORDER BY (period DESC);
 """
 
 CREATE_ALERTS_BY_ACCOUNT_DATE_TABLE = """
@@ -121,6 +197,40 @@ CREATE_ALERTS_BY_ACCOUNT_DATE_TABLE = """
     );
 """
 
+# Fingerprint of every schema component applied, see ensure_schema
+CREATE_SCHEMA_FINGERPRINTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_fingerprints (
+        component TEXT,
+        fingerprint TEXT,
+        applied_at TIMESTAMP,
+        PRIMARY KEY (component)
+    );
+"""
+
+# (table, CREATE statement) in creation order
+SCHEMA_TABLES = [
+    ('patients', CREATE_PATIENTS_TABLE),
+    ('doctors', CREATE_DOCTORS_TABLE),
+    ('appointments_by_patient', CREATE_APPOINTMENTS_BY_PATIENT_DATE_TABLE),
+    ('appointments_by_doctor', CREATE_APPOINTMENTS_BY_DOCTOR_DATE_TABLE),
+    ('appointments_by_pd', CREATE_APPOINTMENTS_BY_DATE_PD_TABLE),
+    ('appointments_by_doctor_day', CREATE_APPOINTMENTS_BY_DOCTOR_DAY_TABLE),
+    ('accounts', CREATE_ACCOUNTS_TABLE),
+    ('vital_signs_by_account_type_bucket', CREATE_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET_TABLE),
+    ('vital_signs_by_account_bucket', CREATE_VITAL_SIGNS_BY_ACCOUNT_BUCKET_TABLE),
+    ('alerts_by_account_date', CREATE_ALERTS_BY_ACCOUNT_DATE_TABLE),
+    ('vital_sign_rollups', CREATE_VITAL_SIGN_ROLLUPS_TABLE),
+    ('latest_vital_signs', CREATE_LATEST_VITAL_SIGNS_TABLE),
+    ('vital_sign_types_by_account', CREATE_VITAL_SIGN_TYPES_BY_ACCOUNT_TABLE),
+]
+
+# (table, column, type) added after their table first shipped. They are
+# left out of the CREATE statements so existing tables keep matching the
+# fingerprint of their creation and get the column through ALTER TABLE
+SCHEMA_COLUMNS = [
+    ('vital_sign_rollups', 'sketch', 'BLOB'),
+]
+
 '''
 ========================================================
 ==               Cassandra Queries                    ==
@@ -134,25 +244,52 @@ SELECT_ACCOUNTS = """
         WHERE account_id = ?
 """
 
-SELECT_VITAL_SIGNS_BY_ACCOUNT_DATE = """
+SELECT_VITAL_SIGNS_BY_ACCOUNT_BUCKET = """
     SELECT
         vital_sign_id, account_id, type, value, date
-    FROM vital_signs_by_account_date
+    FROM vital_signs_by_account_bucket
         WHERE account_id = ?
+        AND bucket = ?
         AND VITAL_SIGN_ID >= minTimeuuid(?)
         AND VITAL_SIGN_ID <= maxTimeuuid(?)
 """
 
-SELECT_VITAL_SIGNS_BY_ACCOUNT_TYPE_DATE = """
+SELECT_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET = """
     SELECT
         vital_sign_id, account_id, type, value, date
-    FROM vital_signs_by_account_type_date
+    FROM vital_signs_by_account_type_bucket
         WHERE account_id = ?
         AND type = ?
+        AND bucket = ?
         AND VITAL_SIGN_ID >= minTimeuuid(?)
         AND VITAL_SIGN_ID <= maxTimeuuid(?)
 """
 
+# Unbucketed table written by earlier versions, only read by the migration
+SELECT_LEGACY_VITAL_SIGNS = """
+    SELECT
+        vital_sign_id, account_id, type, value, date
+    FROM vital_signs_by_account_date
+"""
+
+SELECT_LATEST_VITAL_SIGNS = """
+    SELECT
+        account_id, type, vital_sign_id, value, date
+    FROM latest_vital_signs
+        WHERE account_id = ?
+"""
+
+SELECT_VITAL_SIGN_ROLLUPS = """
+    SELECT
+        period, min_value, max_value, avg_value, sum_value, count, sketch
+    FROM vital_sign_rollups
+        WHERE account_id = ?
+        AND type = ?
+        AND resolution = ?
+        AND period >= ?
+        AND period <= ?
+"""
+
 SELECT_APPOINTMENTS_BY_PATIENT = """
     SELECT
         appointment_id, appointment_date, patient_id, doctor_id, status, notes
@@ -187,6 +324,32 @@ SELECT_APPOINTMENTS_BY_DOCTOR_DATE = """
         AND appointment_id <= maxTimeuuid(?)
 """
 
+SELECT_APPOINTMENT_DATE_BY_DOCTOR = """
+    SELECT
+        appointment_date
+    FROM appointments_by_doctor
+        WHERE doctor_id = ?
+        AND appointment_id = ?
+"""
+
+SELECT_APPOINTMENTS_BY_DOCTOR_DAY = """
+    SELECT
+        appointment_id, appointment_date, patient_id, doctor_id, status, notes
+    FROM appointments_by_doctor_day
+        WHERE doctor_id = ?
+        AND appointment_date = ?
+"""
+
+SELECT_APPOINTMENTS_BY_DOCTOR_SLOT = """
+    SELECT
+        appointment_id, appointment_date, patient_id, doctor_id, status, notes
+    FROM appointments_by_doctor_day
+        WHERE doctor_id = ?
+        AND appointment_date = ?
+        AND appointment_id > maxTimeuuid(?)
+        AND appointment_id < minTimeuuid(?)
+"""
+
 SELECT_APPOINTMENTS_BY_PATIENT_DOCTOR = """
     SELECT
         appointment_id, appointment_date, patient_id, doctor_id, status, notes
@@ -224,6 +387,11 @@ INSERT_APPOINTMENT_BY_DOCTOR = """
     VALUES (?, ?, ?, ?, ?, ?)
 """
 
+INSERT_APPOINTMENT_BY_DOCTOR_DAY = """
+    INSERT INTO appointments_by_doctor_day(appointment_id, appointment_date, patient_id, doctor_id, status, notes)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
 INSERT_APPOINTMENT_BY_DATE = """
     INSERT INTO appointments_by_date(appointment_id, appointment_date, patient_id, doctor_id, status, notes)
     VALUES (?, ?, ?, ?, ?, ?)
@@ -258,6 +426,31 @@ UPDATE_APPOINTMENT_PATIENT_DOCTOR = """
         AND patient_id = ?
         AND doctor_id = ?
 """
+UPDATE_APPOINTMENT_DOCTOR_DAY = """
+    UPDATE appointments_by_doctor_day
+        SET status = ?,
+            notes = ?
+        WHERE appointment_id = ?
+        AND doctor_id = ?
+        AND appointment_date = ?
+"""
+
+UPDATE_APPOINTMENT_DOCTOR_DAY_S = """
+    UPDATE appointments_by_doctor_day
+        SET status = ?
+        WHERE appointment_id = ?
+        AND doctor_id = ?
+        AND appointment_date = ?
+"""
+
+UPDATE_APPOINTMENT_DOCTOR_DAY_N = """
+    UPDATE appointments_by_doctor_day
+        SET notes = ?
+        WHERE appointment_id = ?
+        AND doctor_id = ?
+        AND appointment_date = ?
+"""
+
 UPDATE_APPOINTMENT_PATIENT_S = """
     UPDATE appointments_by_patient
         SET status = ?
@@ -321,31 +514,266 @@ INSERT_ALERT_BY_ACCOUNT_DATE = """
     VALUES (?, ?, ?, ?, ?)
 """
 
-INSERT_VITAL_SIGN_BY_ACCOUNT_DATE = """
-    INSERT INTO vital_signs_by_account_date(vital_sign_id, account_id, type, value, date)
-    VALUES (?, ?, ?, ?, ?)
+INSERT_VITAL_SIGN_BY_ACCOUNT_BUCKET = """
+    INSERT INTO vital_signs_by_account_bucket(vital_sign_id, account_id, type, value, date, bucket)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_VITAL_SIGN_BY_ACCOUNT_TYPE_BUCKET = """
+    INSERT INTO vital_signs_by_account_type_bucket(vital_sign_id, account_id, type, value, date, bucket)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_VITAL_SIGN_TYPE = """
+    INSERT INTO vital_sign_types_by_account(account_id, type)
+    VALUES (?, ?)
 """
 
-INSERT_VITAL_SIGN_BY_ACCOUNT_TYPE_DATE = """
-    INSERT INTO vital_signs_by_account_type_date(vital_sign_id, account_id, type, value, date)
+SELECT_VITAL_SIGN_TYPES_BY_ACCOUNT = """
+    SELECT
+        type
+    FROM vital_sign_types_by_account
+        WHERE account_id = ?
+"""
+
+INSERT_LATEST_VITAL_SIGN = """
+    INSERT INTO latest_vital_signs(account_id, type, vital_sign_id, value, date)
     VALUES (?, ?, ?, ?, ?)
+    USING TIMESTAMP ?
+"""
+
+DELETE_LATEST_VITAL_SIGN = """
+    DELETE FROM latest_vital_signs
+    USING TIMESTAMP ?
+    WHERE account_id = ?
+    AND type = ?
 """
 
-DELETE_VITAL_SIGNS_BY_ACCOUNT_DATE = """
-    DELETE FROM vital_signs_by_account_date
+INSERT_VITAL_SIGN_ROLLUP = """
+    INSERT INTO vital_sign_rollups(account_id, type, resolution, period, min_value, max_value, avg_value, sum_value, count, sketch)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    USING TIMESTAMP ?
+"""
+
+DELETE_VITAL_SIGN_ROLLUP = """
+    DELETE FROM vital_sign_rollups
+    USING TIMESTAMP ?
+    WHERE account_id = ?
+    AND type = ?
+    AND resolution = ?
+    AND period = ?
+"""
+
+DELETE_VITAL_SIGNS_BY_ACCOUNT_BUCKET = """
+    DELETE FROM vital_signs_by_account_bucket
     WHERE account_id = ?
+    AND bucket = ?
     AND vital_sign_id >= minTimeuuid(?)
     AND vital_sign_id <= maxTimeuuid(?)
 """
 
-DELETE_VITAL_SIGNS_BY_ACCOUNT_TYPE_DATE = """
-    DELETE FROM vital_signs_by_account_type_date
+DELETE_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET = """
+    DELETE FROM vital_signs_by_account_type_bucket
     WHERE account_id = ?
     AND type = ?
+    AND bucket = ?
     AND vital_sign_id >= minTimeuuid(?)
     AND vital_sign_id <= maxTimeuuid(?)
 """
 
+DELETE_VITAL_SIGN_BUCKET = """
+    DELETE FROM vital_signs_by_account_bucket
+    WHERE account_id = ?
+    AND bucket = ?
+"""
+
+DELETE_VITAL_SIGN_TYPE_BUCKET = """
+    DELETE FROM vital_signs_by_account_type_bucket
+    WHERE account_id = ?
+    AND type = ?
+    AND bucket = ?
+"""
+
+DELETE_VITAL_SIGN_ROLLUPS_BEFORE = """
+    DELETE FROM vital_sign_rollups
+    WHERE account_id = ?
+    AND type = ?
+    AND resolution = ?
+    AND period < ?
+"""
+
+DELETE_ALERTS_BEFORE = """
+    DELETE FROM alerts_by_account_date
+    WHERE account_id = ?
+    AND alert_id < minTimeuuid(?)
+"""
+
+# Partition key scans used by the purge job, run unprepared and paged
+SELECT_VITAL_SIGN_PARTITIONS = """
+    SELECT DISTINCT account_id, bucket FROM vital_signs_by_account_bucket
+"""
+
+SELECT_VITAL_SIGN_TYPE_PARTITIONS = """
+    SELECT DISTINCT account_id, type, bucket FROM vital_signs_by_account_type_bucket
+"""
+
+SELECT_ALERT_PARTITIONS = """
+    SELECT DISTINCT account_id FROM alerts_by_account_date
+"""
+
+SELECT_VITAL_SIGN_ROLLUP_PARTITIONS = """
+    SELECT DISTINCT account_id, type, resolution FROM vital_sign_rollups
+"""
+
+SELECT_SCHEMA_FINGERPRINTS = """
+    SELECT component, fingerprint FROM schema_fingerprints
+"""
+
+INSERT_SCHEMA_FINGERPRINT = """
+    INSERT INTO schema_fingerprints(component, fingerprint, applied_at)
+    VALUES (?, ?, ?)
+"""
+
+ALTER_TABLE_RETENTION = """
+    ALTER TABLE {} WITH default_time_to_live = {} AND compaction = {}
+"""
+
+ALTER_TABLE_ADD_COLUMN = """
+    ALTER TABLE {} ADD {} {}
+"""
+
+# Statements prepared eagerly by prepare_statements (appointments_by_date
+# has no table, so INSERT_APPOINTMENT_BY_DATE is left out on purpose)
+PREPARED_QUERIES = [
+    SELECT_ACCOUNTS,
+    SELECT_VITAL_SIGNS_BY_ACCOUNT_BUCKET,
+    SELECT_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET,
+    SELECT_VITAL_SIGN_ROLLUPS,
+    SELECT_LATEST_VITAL_SIGNS,
+    SELECT_VITAL_SIGN_TYPES_BY_ACCOUNT,
+    INSERT_VITAL_SIGN_TYPE,
+    SELECT_APPOINTMENTS_BY_PATIENT,
+    SELECT_APPOINTMENTS_BY_PATIENT_DATE,
+    SELECT_APPOINTMENTS_BY_DOCTOR,
+    SELECT_APPOINTMENTS_BY_DOCTOR_DATE,
+    SELECT_APPOINTMENTS_BY_PATIENT_DOCTOR,
+    SELECT_APPOINTMENTS_BY_PATIENT_DOCTOR_DATE,
+    SELECT_APPOINTMENT_DATE_BY_DOCTOR,
+    SELECT_APPOINTMENTS_BY_DOCTOR_DAY,
+    SELECT_APPOINTMENTS_BY_DOCTOR_SLOT,
+    SELECT_ALERTS_BY_ACCOUNT,
+    INSERT_APPOINTMENT_BY_PATIENT,
+    INSERT_APPOINTMENT_BY_DOCTOR,
+    INSERT_APPOINTMENT_BY_PD,
+    INSERT_APPOINTMENT_BY_DOCTOR_DAY,
+    UPDATE_APPOINTMENT_PATIENT,
+    UPDATE_APPOINTMENT_DOCTOR,
+    UPDATE_APPOINTMENT_PATIENT_DOCTOR,
+    UPDATE_APPOINTMENT_PATIENT_S,
+    UPDATE_APPOINTMENT_DOCTOR_S,
+    UPDATE_APPOINTMENT_PATIENT_DOCTOR_S,
+    UPDATE_APPOINTMENT_PATIENT_N,
+    UPDATE_APPOINTMENT_DOCTOR_N,
+    UPDATE_APPOINTMENT_PATIENT_DOCTOR_N,
+    UPDATE_APPOINTMENT_DOCTOR_DAY,
+    UPDATE_APPOINTMENT_DOCTOR_DAY_S,
+    UPDATE_APPOINTMENT_DOCTOR_DAY_N,
+    INSERT_DOCTOR,
+    INSERT_PATIENT,
+    INSERT_ACCOUNT,
+    INSERT_ALERT_BY_ACCOUNT_DATE,
+    INSERT_VITAL_SIGN_BY_ACCOUNT_BUCKET,
+    INSERT_VITAL_SIGN_BY_ACCOUNT_TYPE_BUCKET,
+    INSERT_VITAL_SIGN_ROLLUP,
+    DELETE_VITAL_SIGN_ROLLUP,
+    INSERT_LATEST_VITAL_SIGN,
+    DELETE_LATEST_VITAL_SIGN,
+    DELETE_VITAL_SIGN_BUCKET,
+    DELETE_VITAL_SIGN_TYPE_BUCKET,
+    DELETE_ALERTS_BEFORE,
+    DELETE_VITAL_SIGN_ROLLUPS_BEFORE,
+    DELETE_VITAL_SIGNS_BY_ACCOUNT_BUCKET,
+    DELETE_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET,
+]
+
+'''
+========================================================
+==           Prepared statement registry              ==
+========================================================
+'''
+
+class StatementRegistry(object):
+    """
+    Caches prepared statements per session and keyspace so every CQL
+    string is prepared only once. Entries are dropped with invalidate()
+    after DDL runs, and the next lookup prepares the statement again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session, query):
+        key = (session.keyspace, query)
+        with self._lock:
+            statements = self._sessions.setdefault(session, {})
+            stmt = statements.get(key)
+            if stmt is not None:
+                self.hits += 1
+                return stmt
+            self.misses += 1
+
+        # Prepare outside the lock so a slow coordinator does not block
+        # lookups of statements that are already cached
+        stmt = session.prepare(query)
+        # Reads never change data, so the driver may retry them or race a
+        # speculative copy on another replica
+        stmt.is_idempotent = query.split()[0].upper() == 'SELECT'
+        with self._lock:
+            return self._sessions.setdefault(session, {}).setdefault(key, stmt)
+
+    def prepare_all(self, session, queries=PREPARED_QUERIES):
+        for query in queries:
+            self.get(session, query)
+
+    def invalidate(self, session=None):
+        with self._lock:
+            if session is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session, None)
+
+    def stats(self):
+        with self._lock:
+            size = sum(len(statements) for statements in self._sessions.values())
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": size,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+statements = StatementRegistry()
+
+def get_prepared(session, query):
+    return statements.get(session, query)
+
+def profile_for(session, name):
+    # The named execution profile, or the default one on clusters not built
+    # by clusterProfile.create_cluster
+    try:
+        profiles = session.cluster.profile_manager.profiles
+    except AttributeError:
+        return EXEC_PROFILE_DEFAULT
+    return name if name in profiles else EXEC_PROFILE_DEFAULT
+
+def prepare_statements(session):
+    log.info("Preparing Cassandra statements")
+    statements.prepare_all(session)
+
 def random_dateUUID(dateUUID):
         return time_uuid.TimeUUID.with_timestamp(time_uuid.mkutime(dateUUID))
 
@@ -360,17 +788,73 @@ def create_keyspace(session, keyspace, replication_factor):
     log.info(f"Creating keyspace: {keyspace} with replication factor: {replication_factor}")
     session.execute(CREATE_KEYSPACE.format(keyspace, replication_factor))
 
-def create_schema(session):
-    log.info("Creating Cassandra model schema")
-    session.execute(CREATE_PATIENTS_TABLE)
-    session.execute(CREATE_DOCTORS_TABLE)
-    session.execute(CREATE_APPOINTMENTS_BY_PATIENT_DATE_TABLE)
-    session.execute(CREATE_APPOINTMENTS_BY_DOCTOR_DATE_TABLE)
-    session.execute(CREATE_APPOINTMENTS_BY_DATE_PD_TABLE)
-    session.execute(CREATE_ACCOUNTS_TABLE)
-    session.execute(CREATE_VITAL_SIGNS_BY_ACCOUNT_TYPE_DATE_TABLE)
-    session.execute(CREATE_VITAL_SIGNS_BY_ACCOUNT_DATE_TABLE)
-    session.execute(CREATE_ALERTS_BY_ACCOUNT_DATE_TABLE)
+def schema_fingerprint(ddl):
+    return hashlib.sha256(' '.join(ddl.split()).encode()).hexdigest()
+
+def schema_components():
+    # (component, table, DDL) in the order they are applied, added columns
+    # and the retention of each table after every table has been created
+    components = [(table, table, ddl) for table, ddl in SCHEMA_TABLES]
+    components.extend((f"{table}:{column}", table, ALTER_TABLE_ADD_COLUMN.format(table, column, cql_type))
+                      for table, column, cql_type in SCHEMA_COLUMNS)
+    components.extend((f"{table}:retention", table, ALTER_TABLE_RETENTION.format(table, days * 86400, compaction))
+                      for table, days, compaction in retention_settings())
+    return components
+
+def schema_column_names(keyspace_metadata, table):
+    if keyspace_metadata is None or table not in keyspace_metadata.tables:
+        return []
+    return list(keyspace_metadata.tables[table].columns)
+
+def ensure_schema(session, keyspace, replication_factor):
+    # Runs only the DDL of components that are missing or changed. The
+    # keyspace and tables are looked up in the driver's cached schema
+    # metadata and the rest compared with the fingerprints stored by the
+    # last run, so a warm start issues a single read and no DDL. Returns
+    # the number of DDL statements run
+    keyspace_metadata = session.cluster.metadata.keyspaces.get(keyspace)
+    ran = 0
+    if keyspace_metadata is None:
+        create_keyspace(session, keyspace, replication_factor)
+        ran += 1
+    session.set_keyspace(keyspace)
+
+    tables = set(keyspace_metadata.tables) if keyspace_metadata is not None else set()
+    if 'schema_fingerprints' in tables:
+        stored = {row.component: row.fingerprint for row in session.execute(SELECT_SCHEMA_FINGERPRINTS)}
+    else:
+        session.execute(CREATE_SCHEMA_FINGERPRINTS_TABLE)
+        ran += 1
+        stored = {}
+
+    added_columns = {f"{table}:{column}": column for table, column, cql_type in SCHEMA_COLUMNS}
+    applied = []
+    for component, table, ddl in schema_components():
+        fingerprint = schema_fingerprint(ddl)
+        if table in tables and stored.get(component) == fingerprint:
+            continue
+        if component == table and table in tables:
+            # CREATE TABLE IF NOT EXISTS would leave the table as it is
+            if component in stored:
+                log.warning(f"The definition of {table} changed since it was created, alter the table by hand")
+        elif component in added_columns and added_columns[component] in schema_column_names(keyspace_metadata, table):
+            # Added by a run whose fingerprint was lost
+            pass
+        else:
+            log.info(f"Applying schema component {component}")
+            session.execute(ddl)
+            ran += 1
+        applied.append((component, fingerprint))
+
+    if applied:
+        stmt = get_prepared(session, INSERT_SCHEMA_FINGERPRINT)
+        now = datetime.utcnow()
+        for component, fingerprint in applied:
+            session.execute(stmt, (component, fingerprint, now))
+    if ran:
+        statements.invalidate(session)
+    log.info(f"Schema of {keyspace} is up to date, {ran} DDL statements run")
+    return ran
 
 patientsData = [
     {"id": "P0001", "first_name": "John", "last_name": "Doe", "username": "jdoe"},
@@ -418,302 +902,1393 @@ def execute_batch(session, stmt, data):
         for item in data[i : i+batch_size]:
             batch.add(stmt, item)
         session.execute(batch)
-    session.execute(batch)
-
-def bulk_insert(session):
-    pat_stmt = session.prepare("INSERT INTO patients(patient_id, first_name, last_name, dob) VALUES (?, ?, ?, ?)")
-    doc_stmt = session.prepare("INSERT INTO doctors(doctor_id, first_name, last_name, specialty) VALUES (?, ?, ?, ?)")
-    appbpt_stmt = session.prepare("INSERT INTO appointments_by_patient(appointment_id, appointment_date, patient_id, doctor_id, status, notes) VALUES (?, ?, ?, ?, ?, ?)")
-    appbdt_stmt = session.prepare("INSERT INTO appointments_by_doctor(appointment_id, appointment_date, patient_id, doctor_id, status, notes) VALUES (?, ?, ?, ?, ?, ?)")
-    appbpd_stmt = session.prepare("INSERT INTO appointments_by_pd(appointment_id, appointment_date, patient_id, doctor_id, status, notes) VALUES (?, ?, ?, ?, ?, ?)")
-    acc_stmt = session.prepare("INSERT INTO accounts(account_id, username, first_name, last_name, registration_date, role) VALUES (?, ?, ?, ?, ?, ?)")
-    vs_stmt = session.prepare("INSERT INTO vital_signs_by_account_type_date(vital_sign_id, account_id, type, value, date) VALUES (?, ?, ?, ?, ?)")
-    vsad_stmt = session.prepare("INSERT INTO vital_signs_by_account_date(vital_sign_id, account_id, type, value, date) VALUES (?, ?, ?, ?, ?)")
-    alert_stmt = session.prepare("INSERT INTO alerts_by_account_date(alert_id, account_id, date, alert_type, alert_message) VALUES (?, ?, ?, ?, ?)")
-
-    patients = []
-    patientsAcc = []
-    doctors = []
-    doctorsAcc = []
-
-    patients_num=10
-    doctor_num=10
-    appointments=50
-    vital_signs=1000
-    actions=100
-    alerts=100
-
-    # Load patients from CSV
-    with open(".\\data\\patients.csv", mode='r') as file:
-        csv_reader = csv.DictReader(file)
-        data = []
-        for row in csv_reader:
-            patient_uuid = row['patient_id']
-            patients.append(patient_uuid)
-            dob = datetime.strptime(row['dob'], '%Y-%m-%d').date()
-            data.append((patient_uuid, row['first_name'], row['last_name'], dob))
-    execute_batch(session, pat_stmt, data)
-
-    # Load doctors from CSV
-    with open(".\\data\\doctors.csv", mode='r') as file:
-        csv_reader = csv.DictReader(file)
-        data = []
-        for row in csv_reader:
-            doctor_uuid = row['doctor_id']
-            doctors.append(doctor_uuid)
-            specialty = row['specialty']
-            data.append((patient_uuid, row['first_name'], row['last_name'], specialty))
-    execute_batch(session, doc_stmt, data)
-
-    # Load appointments from CSV
-    with open(".\\data\\appointments.csv", mode='r') as file:
-        csv_reader = csv.DictReader(file)
-        data = []
-        for row in csv_reader:
-            app_date = datetime.strptime(row['appointment_date'], '%Y-%m-%d').date()
-            app_id = UUID(row['appointment_id'])
-            patient = row['patient_id']
-            doctor = row['doctor_id']
-            status = row['status']
-            notes = row['notes']
-            data.append((app_id, app_date, patient, doctor, status, notes))
-    execute_batch(session, appbpt_stmt, data)
-    execute_batch(session, appbdt_stmt, data)
-    execute_batch(session, appbpd_stmt, data)
-
-    # Generate accounts from accounts CSV
-    with open(".\\data\\accounts.csv", mode='r') as file:
-        csv_reader = csv.DictReader(file)
-        data = []
-        for row in csv_reader:
-            account_id = row['account_id']
-            if row['role'] == 'patient':
-                patientsAcc.append(account_id)
-            elif row['role'] == 'doctor':
-                doctorsAcc.append(account_id)
-            registration_date = UUID(row['registration_date'])
-            data.append((account_id, row['username'], row['first_name'], row['last_name'], registration_date, row['role']))
-    execute_batch(session, acc_stmt, data)
-
-    # Load vital signs from CSV
-    with open(".\\data\\vital_signs.csv", mode='r') as file:
-        csv_reader = csv.DictReader(file)
-        data = []
-        for row in csv_reader:
-            vital_sign_date = datetime.strptime(row['date'], '%Y-%m-%d').date()
-            # vital_sign_date = row['date']
-            date = datetime.strptime(row['vital_sign_id'],'%Y-%m-%d %H:%M:%S') + dt.timedelta(hours=6)
-            vital_sign_id = random_dateUUID(date)
-            account_id = row['account_id']
-            vital_sign_type = row['type']
-            vital_sign_value = float(row['value'])
-            data.append((vital_sign_id, account_id, vital_sign_type, vital_sign_value, vital_sign_date))
-    execute_batch(session, vs_stmt, data)
-    execute_batch(session, vsad_stmt, data)
-
-    # Generate alerts
-    data = []
+
+'''
+========================================================
+==                  Bulk loading                      ==
+========================================================
+'''
+
+DATA_DIR = os.path.join('.', 'data')
+BULK_MODE = os.getenv('CASSANDRA_BULK_MODE', 'concurrent')
+BULK_CONCURRENCY = int(os.getenv('CASSANDRA_BULK_CONCURRENCY', '100'))
+BULK_BATCH_SIZE = int(os.getenv('CASSANDRA_BULK_BATCH_SIZE', '50'))
+BULK_PROCESSES = int(os.getenv('CASSANDRA_BULK_PROCESSES', '1'))
+# Byte ranges handed to each process, more than one evens out slow chunks
+BULK_CHUNKS_PER_PROCESS = 4
+# Partitions buffered in batch mode before everything pending is flushed
+BULK_MAX_PENDING = 1000
+# Readings checked against their ranges per vectorized call
+VITAL_SIGN_CHUNK_ROWS = 10000
+
+# Positions of the partition key columns in each insert's bound values
+PARTITION_KEYS = {
+    INSERT_PATIENT: (0,),
+    INSERT_DOCTOR: (0,),
+    INSERT_ACCOUNT: (0,),
+    INSERT_APPOINTMENT_BY_PATIENT: (2,),
+    INSERT_APPOINTMENT_BY_DOCTOR: (3,),
+    INSERT_APPOINTMENT_BY_PD: (2, 3),
+    INSERT_APPOINTMENT_BY_DOCTOR_DAY: (3, 1),
+    INSERT_VITAL_SIGN_BY_ACCOUNT_BUCKET: (1, 5),
+    INSERT_VITAL_SIGN_BY_ACCOUNT_TYPE_BUCKET: (1, 2, 5),
+    INSERT_ALERT_BY_ACCOUNT_DATE: (1,),
+    INSERT_VITAL_SIGN_TYPE: (0,),
+}
+
+VITAL_SIGN_INSERTS = [INSERT_VITAL_SIGN_BY_ACCOUNT_TYPE_BUCKET, INSERT_VITAL_SIGN_BY_ACCOUNT_BUCKET]
+
+class LoadStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.writes = 0
+        self.errors = 0
+        self.alerts = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f"{self.name}: {self.rows} rows, {self.writes} writes, "
+                f"{self.errors} errors in {self.seconds:.2f}s "
+                f"({self.rows_per_sec:.0f} rows/s)")
+
+def read_csv(file_name, parse_row):
+    # Rows are parsed lazily so large files never sit in memory as a list
+    with open(os.path.join(DATA_DIR, file_name), mode='r', newline='') as file:
+        for row in csv.DictReader(file):
+            yield parse_row(row)
+
+def parse_patient_row(row):
+    dob = datetime.strptime(row['dob'], '%Y-%m-%d').date()
+    return (row['patient_id'], row['first_name'], row['last_name'], dob)
+
+def parse_doctor_row(row):
+    return (row['doctor_id'], row['first_name'], row['last_name'], row['specialty'])
+
+def parse_appointment_row(row):
+    app_date = datetime.strptime(row['appointment_date'], '%Y-%m-%d').date()
+    return (UUID(row['appointment_id']), app_date, row['patient_id'],
+            row['doctor_id'], row['status'], row['notes'])
+
+def parse_account_row(row):
+    registration_date = UUID(row['registration_date'])
+    return (row['account_id'], row['username'], row['first_name'],
+            row['last_name'], registration_date, row['role'])
+
+def parse_vital_sign_row(row):
+    vital_sign_date = datetime.strptime(row['date'], '%Y-%m-%d').date()
+    date = datetime.strptime(row['vital_sign_id'], '%Y-%m-%d %H:%M:%S') + dt.timedelta(hours=6)
+    value = float(row['value'])
+    vital_sign_id = vital_sign_uuid(row['account_id'], row['type'], date, value)
+    return (vital_sign_id, row['account_id'], row['type'], value, vital_sign_date,
+            uuid_bucket(vital_sign_id))
+
+def _count_rows(rows, stats):
+    for row in rows:
+        stats.rows += 1
+        yield row
+
+def _fan_out(queries, rows):
+    for row in rows:
+        for query in queries:
+            yield query, row
+
+def _prepared_writes(session, writes):
+    for query, params in writes:
+        yield get_prepared(session, query), params
+
+def _partition_batches(session, writes, batch_size):
+    # Groups rows that share a partition into unlogged batches, so each
+    # batch is applied by a single replica set instead of the coordinator
+    pending = {}
+
+    def make_batch(query, items):
+        stmt = get_prepared(session, query)
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for item in items:
+            batch.add(stmt, item)
+        return batch, None
+
+    for query, row in writes:
+        key = (query, tuple(row[i] for i in PARTITION_KEYS[query]))
+        items = pending.setdefault(key, [])
+        items.append(row)
+        if len(items) >= batch_size:
+            del pending[key]
+            yield make_batch(query, items)
+        if len(pending) >= BULK_MAX_PENDING:
+            for (query, partition), items in pending.items():
+                yield make_batch(query, items)
+            pending = {}
+
+    for (query, partition), items in pending.items():
+        yield make_batch(query, items)
+
+def execute_writes(session, stats, writes, mode=BULK_MODE,
+                   concurrency=BULK_CONCURRENCY, batch_size=BULK_BATCH_SIZE):
+    # writes yields (query, params) pairs, stats is updated in place
+    if mode == 'batch':
+        writes = _partition_batches(session, writes, batch_size)
+    else:
+        writes = _prepared_writes(session, writes)
+
+    start = time.perf_counter()
+    results = execute_concurrent(session, writes, concurrency=concurrency,
+                                 raise_on_first_error=False, results_generator=True,
+                                 execution_profile=profile_for(session, clusterProfile.PROFILE_BULK))
+    for success, result in results:
+        stats.writes += 1
+        if not success:
+            stats.errors += 1
+            log.error(f"Bulk load of {stats.name} failed a write: {result}")
+    stats.seconds = time.perf_counter() - start
+
+    log.info(str(stats))
+    return stats
+
+def load_rows(session, name, queries, rows, mode=BULK_MODE,
+              concurrency=BULK_CONCURRENCY, batch_size=BULK_BATCH_SIZE):
+    stats = LoadStats(name)
+    writes = _fan_out(queries, _count_rows(rows, stats))
+    return execute_writes(session, stats, writes, mode, concurrency, batch_size)
+
+def split_csv(file_name, chunks):
+    # Splits a CSV into byte ranges of roughly equal size, the header line
+    # is returned separately since only the first range would contain it
+    path = os.path.join(DATA_DIR, file_name)
+    with open(path, mode='rb') as file:
+        fieldnames = next(csv.reader([file.readline().decode()]))
+        start = file.tell()
+        size = os.fstat(file.fileno()).st_size
+    step = max(1, -(-(size - start) // chunks))
+    ranges = [(path, offset, min(offset + step, size)) for offset in range(start, size, step)]
+    return fieldnames, ranges
+
+def read_csv_chunk(path, fieldnames, start, end, parse_row):
+    # A line belongs to the range it starts in, so the line straddling
+    # start is skipped here and read whole by the previous range.
+    # Quoted values with embedded newlines are not supported.
+    with open(path, mode='rb') as file:
+        file.seek(start - 1)
+        file.readline()
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                break
+            values = next(csv.reader([line.decode()]), None)
+            if values:
+                yield parse_row(dict(zip(fieldnames, values)))
+
+_worker_cluster = None
+_worker_session = None
+
+def _init_load_worker(contact_points, port, keyspace):
+    global _worker_cluster, _worker_session
+    _worker_cluster = clusterProfile.create_cluster(contact_points=contact_points, port=port)
+    _worker_session = _worker_cluster.connect(keyspace)
+
+def _load_chunk(task):
+    loader, fieldnames, chunk, parse_row, mode, concurrency = task
+    path, start, end = chunk
+    rows = read_csv_chunk(path, fieldnames, start, end, parse_row)
+    return loader(_worker_session, rows=rows, mode=mode, concurrency=concurrency)
+
+def table_loader(name, queries):
+    # Loaders are called as loader(session, rows=..., mode=..., concurrency=...)
+    # and must pickle, so worker processes can run them too
+    return functools.partial(load_rows, name=name, queries=queries)
+
+def parallel_load(session, name, loader, file_name, parse_row, processes=BULK_PROCESSES,
+                  mode=BULK_MODE, concurrency=BULK_CONCURRENCY):
+    # Each worker process connects its own session, the parent only hands
+    # out byte ranges and aggregates what the workers report back
+    fieldnames, chunks = split_csv(file_name, processes * BULK_CHUNKS_PER_PROCESS)
+    tasks = [(loader, fieldnames, chunk, parse_row, mode, concurrency) for chunk in chunks]
+    initargs = (session.cluster.contact_points, session.cluster.port, session.keyspace)
+
+    stats = LoadStats(name)
+    start = time.perf_counter()
+    # spawn keeps the parent's driver threads and sockets out of the workers
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes, initializer=_init_load_worker, initargs=initargs) as pool:
+        for done, chunk_stats in enumerate(pool.imap_unordered(_load_chunk, tasks), 1):
+            stats.rows += chunk_stats.rows
+            stats.writes += chunk_stats.writes
+            stats.errors += chunk_stats.errors
+            stats.alerts += chunk_stats.alerts
+            stats.seconds = time.perf_counter() - start
+            log.info(f"{name}: {done}/{len(tasks)} chunks, {stats.rows} rows, "
+                     f"{stats.errors} errors, {stats.rows_per_sec:.0f} rows/s")
+
+    log.info(str(stats))
+    return stats
+
+def _vital_sign_writes(rows, stats, touched, latest, rules):
+    # Readings are prefiltered a chunk at a time with NumPy against the
+    # narrowest range of any alert rule. Only readings outside it, or of an
+    # account and type already in alarm, go through the rule engine, and
+    # the alerts it raises are written next to the readings' inserts. The
+    # engine takes each chunk sorted by account, type and time, it skips
+    # readings older than ones of their pair in an earlier chunk
+    from Cass import vitalAnalytics
+
+    ranges, default = rules.prefilter_ranges()
+    rows = _count_rows(rows, stats)
+    while True:
+        chunk = list(islice(rows, VITAL_SIGN_CHUNK_ROWS))
+        if not chunk:
+            break
+        candidates = vitalAnalytics.out_of_range([row[2] for row in chunk], [row[3] for row in chunk],
+                                                 ranges, default).tolist()
+        for row in chunk:
+            touched.add(rollup_key(row[1], row[2], row[0]))
+            newest = latest.get((row[1], row[2]))
+            if newest is None:
+                # Indexed before the readings of the type land
+                yield INSERT_VITAL_SIGN_TYPE, (row[1], row[2])
+            if newest is None or newest[0].time < row[0].time:
+                latest[(row[1], row[2])] = row
+            for query in VITAL_SIGN_INSERTS:
+                yield query, row
+
+        order = sorted(range(len(chunk)), key=lambda i: (chunk[i][1], chunk[i][2], uuid_timestamp(chunk[i][0])))
+        for i in order:
+            row = chunk[i]
+            if ((candidates[i] or (row[1], row[2]) in rules.alarmed)
+                    and rules.evaluate(row[1], row[2], uuid_timestamp(row[0]), row[3])):
+                # The reading's own id keeps a replayed load from duplicating alerts
+                stats.alerts += 1
+                yield INSERT_ALERT_BY_ACCOUNT_DATE, (row[0], row[1], row[4], "Vital Signs", VITAL_SIGN_ALERT_MESSAGE)
+
+def load_vital_signs(session, rows, mode=BULK_MODE, concurrency=BULK_CONCURRENCY, defer_rollups=False, rules=None):
+    # Rollups of every hour the rows touch are rebuilt once the raw writes
+    # have landed, instead of once per reading, or handed to the session's
+    # RollupRefresher with defer_rollups. Only the newest reading of each
+    # account and type is written to the snapshot. Alerts are evaluated on
+    # rules, by default a fresh engine of the load's own, so a historic
+    # load neither sees nor changes the alarms of live readings. Parallel
+    # loads evaluate each CSV chunk separately
+    rules = rules or alert_rules.fresh()
+    touched = set()
+    latest = {}
+    stats = LoadStats("vital signs")
+    execute_writes(session, stats, _vital_sign_writes(rows, stats, touched, latest, rules), mode, concurrency)
+    if rules.out_of_order:
+        log.warning(f"{rules.out_of_order} readings arrived after newer ones of their account and type "
+                    f"and were not checked for alerts")
+    if defer_rollups:
+        get_rollup_refresher(session).mark(touched)
+    else:
+        refresh_rollups(session, touched, concurrency)
+    write_latest_vital_signs(session, latest.values(), concurrency)
+    return stats
+
+def generate_alerts(patientsAcc, alerts):
     for i in range(alerts):
         account = random.choice(patientsAcc)
         alert_date = random_date(datetime(2020, 1, 1), datetime(2025, 1, 1))
         alert_id = random_dateUUID(alert_date)
         alert_type = random.choice(['appointment', 'vital_sign', 'alert'])
         alert_message = random.choice(['Appointment scheduled', 'Vital sign out of range', 'New alert'])
-        data.append((alert_id, account, alert_date, alert_type, alert_message))
-    execute_batch(session, alert_stmt, data)
+        yield (alert_id, account, alert_date, alert_type, alert_message)
 
-def check_vital_signs(type, value):
+def bulk_insert(session, mode=BULK_MODE, concurrency=BULK_CONCURRENCY, processes=BULK_PROCESSES):
+    patientsAcc = []
+    alerts = 100
+
+    def track_account(row):
+        account = parse_account_row(row)
+        if account[5] == 'patient':
+            patientsAcc.append(account[0])
+        return account
+
+    # (name, loader, file, row parser, large enough to shard across processes)
+    loads = [
+        ("patients", table_loader("patients", [INSERT_PATIENT]), 'patients.csv', parse_patient_row, False),
+        ("doctors", table_loader("doctors", [INSERT_DOCTOR]), 'doctors.csv', parse_doctor_row, False),
+        ("appointments", table_loader("appointments", [INSERT_APPOINTMENT_BY_PATIENT, INSERT_APPOINTMENT_BY_DOCTOR,
+                                                       INSERT_APPOINTMENT_BY_PD, INSERT_APPOINTMENT_BY_DOCTOR_DAY]),
+            'appointments.csv', parse_appointment_row, True),
+        ("accounts", table_loader("accounts", [INSERT_ACCOUNT]), 'accounts.csv', track_account, False),
+        ("vital signs", load_vital_signs, 'vital_signs.csv', parse_vital_sign_row, True),
+    ]
+
+    results = []
+    for name, loader, file_name, parse_row, sharded in loads:
+        if sharded and processes > 1:
+            stats = parallel_load(session, name, loader, file_name, parse_row, processes, mode, concurrency)
+        else:
+            stats = loader(session, rows=read_csv(file_name, parse_row), mode=mode, concurrency=concurrency)
+        results.append(stats)
+
+    # Alerts are generated for the patient accounts loaded above
+    results.append(load_rows(session, "alerts", [INSERT_ALERT_BY_ACCOUNT_DATE],
+                             generate_alerts(patientsAcc, alerts), mode, concurrency))
+
+    for stats in results:
+        print(f"=== {stats}")
+    return results
+
+# Normal (low, high) range of each vital sign type, other types are never flagged
+VITAL_SIGN_RANGES = {
+    'blood pressure': (90, 140),
+    'heart rate': (60, 100),
+    'oxygenation': (95, 100),
+    'temperature': (36.1, 37.2),
+}
+VITAL_SIGN_ALERT_MESSAGE = "You're vital signs are out of bounds take a moment"
+
+ALERT_RULES_FILE = os.getenv('ALERT_RULES_FILE')
+ALERT_FLUSH_SECONDS = float(os.getenv('ALERT_FLUSH_SECONDS', '0.05'))
+ALERT_BATCH_SIZE = int(os.getenv('ALERT_BATCH_SIZE', '100'))
+# Seconds flush waits for pending alerts before giving up on them
+ALERT_FLUSH_TIMEOUT = float(os.getenv('ALERT_FLUSH_TIMEOUT', '30'))
+
+alert_rules = alertRules.load_rules(ALERT_RULES_FILE, VITAL_SIGN_RANGES)
+
+class AlertWriter(object):
+    """
+    Writes alerts from a background thread so callers never wait on them.
+    Alerts are collected for up to flush_seconds or batch_size alerts and
+    then written as one unlogged batch per account, all batches at once.
+    """
+
+    def __init__(self, session, flush_seconds=ALERT_FLUSH_SECONDS, batch_size=ALERT_BATCH_SIZE):
+        self.session = session
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.written = 0
+        self.errors = 0
+        self._queue = queue.Queue()
+        # Alerts submitted and not yet written or failed
+        self._unfinished = 0
+        self._finished = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="alert-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, alertData):
+        with self._finished:
+            self._unfinished += 1
+        self._queue.put(tuple(alertData))
+
+    def flush(self, timeout=ALERT_FLUSH_TIMEOUT):
+        # Blocks until every submitted alert has been written or has failed,
+        # for at most timeout seconds. Returns whether they all finished
+        with self._finished:
+            if self._finished.wait_for(lambda: not self._unfinished, timeout):
+                return True
+            log.warning(f"{self._unfinished} alerts still pending after {timeout}s")
+            return False
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(pending)
+            except Exception as exc:
+                # The thread must outlive a failed batch, or every later
+                # alert would wait in the queue forever
+                self.errors += len(pending)
+                log.error(f"Writing {len(pending)} alerts failed: {exc}")
+            with self._finished:
+                self._unfinished -= len(pending)
+                self._finished.notify_all()
+
+    def _write(self, alerts):
+        stmt = get_prepared(self.session, INSERT_ALERT_BY_ACCOUNT_DATE)
+        batches = {}
+        for alert in alerts:
+            batch = batches.setdefault(alert[1], BatchStatement(batch_type=BatchType.UNLOGGED))
+            batch.add(stmt, alert)
+
+        futures = [(batch, self.session.execute_async(batch)) for batch in batches.values()]
+        for batch, future in futures:
+            try:
+                future.result()
+                self.written += len(batch)
+            except Exception as exc:
+                self.errors += len(batch)
+                log.error(f"Writing {len(batch)} alerts failed: {exc}")
+
+_alert_writers = {}
+_alert_writers_lock = threading.Lock()
+
+def get_alert_writer(session):
+    with _alert_writers_lock:
+        writer = _alert_writers.get(session)
+        if writer is None:
+            writer = _alert_writers[session] = AlertWriter(session)
+        return writer
+
+@atexit.register
+def flush_alert_writers():
+    for writer in list(_alert_writers.values()):
+        writer.flush()
 
-    if type == 'blood pressure':
-        return value < 90 or value > 140
-    elif type == 'heart rate':
-        return value < 60 or value > 100
-    elif type == 'oxygenation':
-        return value < 95 or value > 100
-    elif type == 'temperature':
-        return value < 36.1 or value > 37.2
-    else:
+def check_vital_signs(type, value):
+    if type not in VITAL_SIGN_RANGES:
         return False
+    low, high = VITAL_SIGN_RANGES[type]
+    return value < low or value > high
 
 def create_account(session, accountData):
-    stmt = session.prepare(INSERT_ACCOUNT)
+    stmt = get_prepared(session, INSERT_ACCOUNT)
 
     insertAccountData = [accountData[0], accountData[4], accountData[1], 
                             accountData[2], accountData[5], accountData[6]]
     session.execute(stmt, insertAccountData)
+    accounts.invalidate(accountData[0])
 
 def insert_patient(session, patientData):
-    stmt = session.prepare(INSERT_PATIENT)
+    stmt = get_prepared(session, INSERT_PATIENT)
     insertPatientData = [patientData[0], patientData[1], patientData[2], patientData[3]]
     session.execute(stmt, insertPatientData)
     create_account(session, patientData)
 
 def insert_doctor(session, doctorData):
-    stmt = session.prepare(INSERT_DOCTOR)
+    stmt = get_prepared(session, INSERT_DOCTOR)
     insertDoctorData = [doctorData[0], doctorData[1], doctorData[2], doctorData[3]]
     session.execute(stmt, insertDoctorData)
     create_account(session, doctorData)
 
-def insert_appointment(session, appointmentData):
+def appointment_writes(appointmentData, alertData=None):
+    writes = [(INSERT_APPOINTMENT_BY_PATIENT, appointmentData),
+              (INSERT_APPOINTMENT_BY_DOCTOR, appointmentData),
+              (INSERT_APPOINTMENT_BY_PD, appointmentData),
+              (INSERT_APPOINTMENT_BY_DOCTOR_DAY, appointmentData)]
+    if alertData is not None:
+        writes.append((INSERT_ALERT_BY_ACCOUNT_DATE, alertData))
+    return writes
+
+def appointment_update_writes(appointmentData, appointment_date=None):
+    # The day table is keyed by the appointment date, it is only updated
+    # when the caller knows it (see appointment_date_of)
+    if appointmentData[3] == "":
+        writes = [(UPDATE_APPOINTMENT_PATIENT_N, [appointmentData[4], appointmentData[0], appointmentData[1]]),
+                  (UPDATE_APPOINTMENT_DOCTOR_N, [appointmentData[4], appointmentData[0], appointmentData[2]]),
+                  (UPDATE_APPOINTMENT_PATIENT_DOCTOR_N, [appointmentData[4], appointmentData[0], appointmentData[1], appointmentData[2]])]
+        day_write = (UPDATE_APPOINTMENT_DOCTOR_DAY_N, [appointmentData[4], appointmentData[0], appointmentData[2], appointment_date])
+    elif appointmentData[4] == "":
+        writes = [(UPDATE_APPOINTMENT_PATIENT_S, [appointmentData[3], appointmentData[0], appointmentData[1]]),
+                  (UPDATE_APPOINTMENT_DOCTOR_S, [appointmentData[3], appointmentData[0], appointmentData[2]]),
+                  (UPDATE_APPOINTMENT_PATIENT_DOCTOR_S, [appointmentData[3], appointmentData[0], appointmentData[1], appointmentData[2]])]
+        day_write = (UPDATE_APPOINTMENT_DOCTOR_DAY_S, [appointmentData[3], appointmentData[0], appointmentData[2], appointment_date])
+    else:
+        writes = [(UPDATE_APPOINTMENT_PATIENT, [appointmentData[3], appointmentData[4], appointmentData[0], appointmentData[1]]),
+                  (UPDATE_APPOINTMENT_DOCTOR, [appointmentData[3], appointmentData[4], appointmentData[0], appointmentData[2]]),
+                  (UPDATE_APPOINTMENT_PATIENT_DOCTOR, [appointmentData[3], appointmentData[4], appointmentData[0], appointmentData[1], appointmentData[2]])]
+        day_write = (UPDATE_APPOINTMENT_DOCTOR_DAY, [appointmentData[3], appointmentData[4], appointmentData[0], appointmentData[2], appointment_date])
+    if appointment_date is not None:
+        writes.append(day_write)
+    return writes
+
+def appointment_date_of(session, doctor_id, appointment_id):
+    stmt = get_prepared(session, SELECT_APPOINTMENT_DATE_BY_DOCTOR)
+    rows = list(session.execute(stmt, [doctor_id, appointment_id]))
+    return rows[0].appointment_date if rows else None
+
+'''
+========================================================
+==                Appointment writes                  ==
+========================================================
+'''
 
-    appbpt_stmt = session.prepare(INSERT_APPOINTMENT_BY_PATIENT)
-    appbdt_stmt = session.prepare(INSERT_APPOINTMENT_BY_DOCTOR)
-    appbpd_stmt = session.prepare(INSERT_APPOINTMENT_BY_PD)
+# 'concurrent' sends every denormalized write at once, 'logged' sends them
+# as one logged batch so they apply all together or not at all
+APPOINTMENT_WRITE_MODE = os.getenv('CASSANDRA_APPOINTMENT_WRITE_MODE', 'concurrent')
+APPOINTMENT_WRITE_RETRIES = int(os.getenv('CASSANDRA_APPOINTMENT_WRITE_RETRIES', '2'))
+APPOINTMENT_RETRY_DELAY = 0.1
+
+class WriteReport(object):
+    """
+    Outcome of a fan-out write, the tables written and the ones that still
+    failed after every retry with their last error.
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.attempts = 0
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def __str__(self):
+        if self.ok:
+            return f"{len(self.succeeded)} writes applied in {self.attempts} attempts"
+        failed = ", ".join(f"{table} ({error})" for table, error in self.failed)
+        return (f"{len(self.succeeded)} writes applied, {len(self.failed)} failed "
+                f"after {self.attempts} attempts: {failed}")
+
+def _table_name(query):
+    words = query.split()
+    return words[2].split('(')[0] if words[0] == 'INSERT' else words[1]
+
+def _write_statements(session, writes, mode):
+    # Every write of an appointment has fixed keys and values, replaying one
+    # leaves the row as it was, so they are all marked idempotent
+    if mode == 'logged':
+        batch = BatchStatement(batch_type=BatchType.LOGGED)
+        for query, params in writes:
+            batch.add(get_prepared(session, query), params)
+        batch.is_idempotent = True
+        return [(" + ".join(_table_name(query) for query, params in writes), batch)]
+
+    statements = []
+    for query, params in writes:
+        bound = get_prepared(session, query).bind(params)
+        bound.is_idempotent = True
+        statements.append((_table_name(query), bound))
+    return statements
+
+def fan_out_rounds(session, writes, mode=APPOINTMENT_WRITE_MODE, retries=APPOINTMENT_WRITE_RETRIES):
+    # Retries shared by execute_fan_out and asyncModel.execute_fan_out.
+    # Yields (delay, statements) rounds to send concurrently after waiting
+    # delay seconds, is sent back the exception of each statement or None,
+    # and returns a WriteReport. Only the failed writes are retried
+    report = WriteReport()
+    pending = _write_statements(session, writes, mode)
+    errors = {}
+    for attempt in range(retries + 1):
+        report.attempts += 1
+        delay = APPOINTMENT_RETRY_DELAY * 2 ** (attempt - 1) if attempt else 0
+        outcomes = yield delay, [stmt for table, stmt in pending]
+        retry = []
+        for (table, stmt), error in zip(pending, outcomes):
+            if error is None:
+                report.succeeded.append(table)
+            else:
+                errors[table] = error
+                retry.append((table, stmt))
+        pending = retry
+        if not pending:
+            break
+
+    report.failed = [(table, errors[table]) for table, stmt in pending]
+    if not report.ok:
+        log.error(f"Appointment write incomplete: {report}")
+    return report
+
+def _error_of(future):
+    try:
+        future.result()
+        return None
+    except Exception as exc:
+        return exc
+
+def execute_fan_out(session, writes, mode=APPOINTMENT_WRITE_MODE, retries=APPOINTMENT_WRITE_RETRIES):
+    # Sends the (query, params) writes in one round trip and retries only
+    # the ones that failed, returns a WriteReport
+    rounds = fan_out_rounds(session, writes, mode, retries)
+    try:
+        delay, statements = next(rounds)
+        while True:
+            if delay:
+                time.sleep(delay)
+            futures = [session.execute_async(stmt) for stmt in statements]
+            delay, statements = rounds.send([_error_of(future) for future in futures])
+    except StopIteration as stop:
+        return stop.value
+
+def insert_appointment(session, appointmentData, alertData=None, mode=APPOINTMENT_WRITE_MODE):
+    return execute_fan_out(session, appointment_writes(appointmentData, alertData), mode)
+
+def update_appointment(session, appointmentData, mode=APPOINTMENT_WRITE_MODE):
+    appointment_date = appointment_date_of(session, appointmentData[2], appointmentData[0])
+    return execute_fan_out(session, appointment_update_writes(appointmentData, appointment_date), mode)
 
-    execute_batch(session, appbpt_stmt, [appointmentData])
-    execute_batch(session, appbdt_stmt, [appointmentData])
-    execute_batch(session, appbpd_stmt, [appointmentData])
+'''
+========================================================
+==                 Doctor calendar                    ==
+========================================================
+'''
 
-def update_appointment(session, appointmentData):
+# Length of an appointment, two appointments of a doctor closer than this overlap
+APPOINTMENT_SLOT_MINUTES = int(os.getenv('CASSANDRA_APPOINTMENT_SLOT_MINUTES', '30'))
+# Appointments in these states no longer hold their slot
+FREE_APPOINTMENT_STATUSES = {'cancelled', 'canceled'}
+
+def get_doctor_calendar(session, doctor_id, day, days=1, concurrency=BULK_CONCURRENCY):
+    # Returns {date: rows in time order} for days consecutive days from day,
+    # one partition read per day issued concurrently
+    if isinstance(day, datetime):
+        day = day.date()
+    dates = [day + dt.timedelta(days=i) for i in range(days)]
+    stmt = get_prepared(session, SELECT_APPOINTMENTS_BY_DOCTOR_DAY)
+    results = execute_concurrent_with_args(session, stmt, [(doctor_id, date) for date in dates],
+                                           concurrency=concurrency)
+    return OrderedDict((date, list(result)) for date, (success, result) in zip(dates, results))
+
+def find_conflicts(session, doctor_id, appointment_time, slot_minutes=APPOINTMENT_SLOT_MINUTES):
+    # Appointments of the doctor that overlap a slot starting at
+    # appointment_time, read from every day partition the window spans so
+    # slots around midnight are caught. The bounds are exclusive, back to
+    # back appointments do not conflict. This is a check before writing,
+    # two bookings of one slot made at the same instant can still both
+    # succeed
+    slot = dt.timedelta(minutes=slot_minutes)
+    start, end = appointment_time - slot, appointment_time + slot
+    dates = [start.date() + dt.timedelta(days=i) for i in range((end.date() - start.date()).days + 1)]
+    stmt = get_prepared(session, SELECT_APPOINTMENTS_BY_DOCTOR_SLOT)
+    results = execute_concurrent_with_args(session, stmt, [(doctor_id, date, start, end) for date in dates])
+    return [row for success, rows in results for row in rows
+            if (row.status or '').lower() not in FREE_APPOINTMENT_STATUSES]
+
+def print_doctor_calendar(session, doctor_id, day, days=1):
+    calendar = get_doctor_calendar(session, doctor_id, day, days)
+    users = get_users(session, [row.patient_id for rows in calendar.values() for row in rows])
+    for date, rows in calendar.items():
+        print(" ")
+        print(f"**** {date:%A %Y-%m-%d} ****")
+        if not rows:
+            print("=== No appointments")
+        for row in rows:
+            time = datetime.fromtimestamp(time_uuid.TimeUUID.get_timestamp(row.appointment_id))
+            print(f"=== {time:%H:%M} {full_name(users, row.patient_id)} ({row.status}) {row.notes or ''}")
+    return calendar
 
-    if appointmentData[3] == "":
-        appbpt_stmt = session.prepare(UPDATE_APPOINTMENT_PATIENT_N)
-        appbdt_stmt = session.prepare(UPDATE_APPOINTMENT_DOCTOR_N)
-        appbpd_stmt = session.prepare(UPDATE_APPOINTMENT_PATIENT_DOCTOR_N)
-        updateByPatient = [appointmentData[4], appointmentData[0], appointmentData[1]]
-        updateByDoctor = [appointmentData[4], appointmentData[0], appointmentData[2]]
-        updateByPatientDoctor = [appointmentData[4], appointmentData[0], appointmentData[1], appointmentData[2]]
-    elif appointmentData[4] == "":
-        appbpt_stmt = session.prepare(UPDATE_APPOINTMENT_PATIENT_S)
-        appbdt_stmt = session.prepare(UPDATE_APPOINTMENT_DOCTOR_S)
-        appbpd_stmt = session.prepare(UPDATE_APPOINTMENT_PATIENT_DOCTOR_S)
-        updateByPatient = [appointmentData[3], appointmentData[0], appointmentData[1]]
-        updateByDoctor = [appointmentData[3], appointmentData[0], appointmentData[2]]
-        updateByPatientDoctor = [appointmentData[3], appointmentData[0], appointmentData[1], appointmentData[2]]
+'''
+========================================================
+==               Vital sign buckets                   ==
+========================================================
+'''
+
+# Days covered by one vital sign partition. Changing it on a keyspace
+# that already holds data needs the rows rewritten into the new buckets
+VITAL_SIGN_BUCKET_DAYS = int(os.getenv('CASSANDRA_VITAL_SIGN_BUCKET_DAYS', '30'))
+# Buckets queried at once by a paged read
+VITAL_SIGN_BUCKET_FANOUT = 8
+# 100ns intervals between the UUID epoch (1582-10-15) and the unix epoch
+UUID_EPOCH_OFFSET = 0x01b21dd213814000
+UUID_TICKS_PER_DAY = 864000000000
+EPOCH_DATE = dt.date(1970, 1, 1)
+EPOCH_DATETIME = datetime(1970, 1, 1)
+
+def vital_sign_bucket(day):
+    if isinstance(day, datetime):
+        day = day.date()
+    return (day - EPOCH_DATE).days // VITAL_SIGN_BUCKET_DAYS
+
+def uuid_bucket(vital_sign_id):
+    days = (vital_sign_id.time - UUID_EPOCH_OFFSET) // UUID_TICKS_PER_DAY
+    return days // VITAL_SIGN_BUCKET_DAYS
+
+def vital_sign_buckets(start_date, end_date):
+    # Newest bucket first, the same order rows have inside a bucket
+    return list(range(vital_sign_bucket(end_date), vital_sign_bucket(start_date) - 1, -1))
+
+def default_date_range(start_date, end_date):
+    if not end_date:
+        end_date = datetime.utcnow()
+    if not start_date:
+        start_date = end_date - dt.timedelta(days=30)
+    return start_date, end_date
+
+def vital_sign_query(account_id, bucket, start_date, end_date, vital_sign_type=None):
+    if vital_sign_type:
+        return SELECT_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET, [account_id, vital_sign_type, bucket, start_date, end_date]
+    return SELECT_VITAL_SIGNS_BY_ACCOUNT_BUCKET, [account_id, bucket, start_date, end_date]
+
+def encode_bucket_state(bucket, paging_state):
+    return struct.pack('>i', bucket) + (paging_state or b'')
+
+def decode_bucket_state(state):
+    return struct.unpack('>i', state[:4])[0], state[4:] or None
+
+'''
+========================================================
+==               Deterministic reading ids            ==
+========================================================
+'''
+
+# The id of a reading is a version 1 TimeUUID whose time fields hold the
+# reading's timestamp and whose clock sequence and node hold 62 bits of a
+# hash of (account, type, timestamp, value). The same reading always gets
+# the same id, so loading a file twice rewrites the same rows, and
+# readings in the same second only collide when they are identical
+UUID_VERSION_1 = 0x1000 << 64
+UUID_VARIANT = 0x8000 << 48
+# Set on the node like on a random node id, never a real MAC address
+UUID_MULTICAST = 0x010000000000
+
+def timestamp_ticks(timestamp):
+    # 100ns intervals since the UUID epoch for a naive UTC datetime or unix seconds
+    if isinstance(timestamp, datetime):
+        delta = timestamp - EPOCH_DATETIME
+        return (delta.days * 86400 + delta.seconds) * 10000000 + delta.microseconds * 10 + UUID_EPOCH_OFFSET
+    return int(round(timestamp * 10000000)) + UUID_EPOCH_OFFSET
+
+def _reading_uuid(blake2b, account_id, vital_sign_type, ticks, value):
+    digest = blake2b(f"{account_id}\x1f{vital_sign_type}\x1f{ticks}\x1f{float(value)!r}".encode(),
+                     digest_size=8).digest()
+    bits = int.from_bytes(digest, 'big')
+    return UUID(int=((ticks & 0xffffffff) << 96 | ((ticks >> 32) & 0xffff) << 80
+                     | ((ticks >> 48) & 0x0fff) << 64 | UUID_VERSION_1
+                     | ((bits >> 48) & 0x3fff) << 48 | UUID_VARIANT
+                     | (bits & 0xffffffffffff) | UUID_MULTICAST))
+
+def vital_sign_uuid(account_id, vital_sign_type, timestamp, value):
+    return _reading_uuid(hashlib.blake2b, account_id, vital_sign_type, timestamp_ticks(timestamp), value)
+
+def vital_sign_uuids(account_ids, vital_sign_types, timestamps, values):
+    # Batch form of vital_sign_uuid over parallel sequences
+    blake2b = hashlib.blake2b
+    return [_reading_uuid(blake2b, account_id, vital_sign_type, timestamp_ticks(timestamp), value)
+            for account_id, vital_sign_type, timestamp, value
+            in zip(account_ids, vital_sign_types, timestamps, values)]
+
+LEGACY_VITAL_SIGN_TABLE = 'vital_signs_by_account_date'
+
+def migrate_vital_sign_buckets(session, fetch_size=1000, mode=BULK_MODE, concurrency=BULK_CONCURRENCY):
+    # Copies the unbucketed vital_signs_by_account_date table written by
+    # earlier versions into both bucketed tables, one page at a time.
+    # Running it again only rewrites the same rows and rollups. Keyspaces
+    # created without the legacy table have nothing to copy. The types of
+    # readings written before the type index existed are indexed too
+    keyspace_metadata = session.cluster.metadata.keyspaces.get(session.keyspace)
+    if keyspace_metadata is None or LEGACY_VITAL_SIGN_TABLE not in keyspace_metadata.tables:
+        print("=== No legacy vital signs to migrate")
+        stats = LoadStats("vital signs")
     else:
-        appbpt_stmt = session.prepare(UPDATE_APPOINTMENT_PATIENT)
-        appbdt_stmt = session.prepare(UPDATE_APPOINTMENT_DOCTOR)
-        appbpd_stmt = session.prepare(UPDATE_APPOINTMENT_PATIENT_DOCTOR)
-        updateByPatient = [appointmentData[3], appointmentData[4], appointmentData[0], appointmentData[1]]
-        updateByDoctor = [appointmentData[3], appointmentData[4], appointmentData[0], appointmentData[2]]
-        updateByPatientDoctor = [appointmentData[3], appointmentData[4], appointmentData[0], appointmentData[1], appointmentData[2]]
+        stmt = SimpleStatement(SELECT_LEGACY_VITAL_SIGNS, fetch_size=fetch_size)
+        rows = ((row.vital_sign_id, row.account_id, row.type, row.value, row.date, uuid_bucket(row.vital_sign_id))
+                for row in session.execute(stmt))
+        stats = load_vital_signs(session, rows, mode, concurrency)
+        print(f"=== {stats}")
+    print(f"=== {index_vital_sign_types(session, concurrency)} account vital sign types indexed")
+    return stats
+
+def index_vital_sign_types(session, concurrency=BULK_CONCURRENCY):
+    # Fills vital_sign_types_by_account from the partition keys of the per
+    # type table, as the purge job reads them. Returns the pairs written
+    indexed = set()
+    for row in _scan_partitions(session, SELECT_VITAL_SIGN_TYPE_PARTITIONS):
+        indexed.add((row.account_id, row.type))
+    execute_concurrent_with_args(session, get_prepared(session, INSERT_VITAL_SIGN_TYPE), list(indexed),
+                                 concurrency=concurrency)
+    return len(indexed)
 
-    execute_batch(session, appbpt_stmt, [updateByPatient])
-    execute_batch(session, appbdt_stmt, [updateByDoctor])
-    execute_batch(session, appbpd_stmt, [updateByPatientDoctor])
+'''
+========================================================
+==               Vital sign rollups                   ==
+========================================================
+'''
+
+# Seconds covered by one rollup row, finest first
+ROLLUP_RESOLUTIONS = [('hour', 3600), ('day', 86400)]
+DEFAULT_SUMMARY_POINTS = 500
+# Rollup keys refreshed per concurrent round, bounds the result sets held
+ROLLUP_REFRESH_CHUNK = 1000
+# Seconds between rebuilds of the hours marked dirty by single inserts
+ROLLUP_REFRESH_SECONDS = float(os.getenv('CASSANDRA_ROLLUP_REFRESH_SECONDS', '1'))
+ROLLUP_FLUSH_TIMEOUT = 30
+
+def uuid_timestamp(vital_sign_id):
+    return (vital_sign_id.time - UUID_EPOCH_OFFSET) / 1e7
+
+def rollup_key(account_id, vital_sign_type, vital_sign_id):
+    hour = int(uuid_timestamp(vital_sign_id) // 3600 * 3600)
+    return (account_id, vital_sign_type, hour)
+
+def utc_datetime(timestamp):
+    return EPOCH_DATETIME + dt.timedelta(seconds=timestamp)
+
+def summarize(values):
+    # values are (min, max, sum, count) tuples, raw readings use (v, v, v, 1)
+    count = sum(value[3] for value in values)
+    if not count:
+        return None
+    total = sum(value[2] for value in values)
+    return (min(value[0] for value in values), max(value[1] for value in values),
+            total / count, total, count)
+
+def _write_rollups(session, resolution, summaries, timestamp, concurrency):
+    # summaries are (key, summary, sketch), timestamp is when the reads they
+    # were built from started
+    insert_stmt = get_prepared(session, INSERT_VITAL_SIGN_ROLLUP)
+    delete_stmt = get_prepared(session, DELETE_VITAL_SIGN_ROLLUP)
+    writes = []
+    for (account_id, vital_sign_type, period), summary, sketch in summaries:
+        if summary is None:
+            # Every reading of the period was deleted, drop its rollup too
+            writes.append((delete_stmt, (timestamp, account_id, vital_sign_type, resolution, utc_datetime(period))))
+        else:
+            writes.append((insert_stmt, (account_id, vital_sign_type, resolution, utc_datetime(period))
+                           + summary + (sketch.to_bytes(), timestamp)))
+    execute_concurrent(session, writes, concurrency=concurrency)
+
+def _read_start():
+    return int(time.time() * 1e6)
+
+def rollup_sketches(rows):
+    # Rollups written before sketches existed have none and are skipped
+    return [quantileSketch.TDigest.from_bytes(row.sketch) for row in rows if row.sketch]
+
+def _refresh_hours(session, keys, concurrency):
+    stmt = get_prepared(session, SELECT_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET)
+    params = []
+    for account_id, vital_sign_type, hour in keys:
+        bucket = int(hour // 86400) // VITAL_SIGN_BUCKET_DAYS
+        params.append((account_id, vital_sign_type, bucket,
+                       utc_datetime(hour), utc_datetime(hour + 3600) - dt.timedelta(milliseconds=1)))
+    timestamp = _read_start()
+    results = execute_concurrent_with_args(session, stmt, params, concurrency=concurrency,
+                                           execution_profile=profile_for(session, clusterProfile.PROFILE_BULK))
+    summaries = []
+    for key, (success, result) in zip(keys, results):
+        values = [row.value for row in result]
+        summaries.append((key, summarize([(value, value, value, 1) for value in values]),
+                          quantileSketch.TDigest.from_values(values)))
+    _write_rollups(session, 'hour', summaries, timestamp, concurrency)
+
+def _refresh_days(session, keys, concurrency):
+    stmt = get_prepared(session, SELECT_VITAL_SIGN_ROLLUPS)
+    params = [(account_id, vital_sign_type, 'hour', utc_datetime(day), utc_datetime(day + 86400 - 3600))
+              for account_id, vital_sign_type, day in keys]
+    timestamp = _read_start()
+    results = execute_concurrent_with_args(session, stmt, params, concurrency=concurrency,
+                                           execution_profile=profile_for(session, clusterProfile.PROFILE_BULK))
+    summaries = []
+    for key, (success, result) in zip(keys, results):
+        rows = list(result)
+        summaries.append((key, summarize([(row.min_value, row.max_value, row.sum_value, row.count) for row in rows]),
+                          quantileSketch.TDigest.merge_all(rollup_sketches(rows))))
+    _write_rollups(session, 'day', summaries, timestamp, concurrency)
+
+def refresh_rollups(session, hour_keys, concurrency=BULK_CONCURRENCY):
+    # Hourly rows are rebuilt from the raw readings of the hour and daily
+    # rows from the hourly ones, sketches included. Each rebuild writes
+    # with the timestamp of when its reads started, so of two rebuilds of
+    # one hour the one that read last wins whichever lands last, and a read
+    # started after a reading was acknowledged sees it. Rebuilding instead
+    # of incrementing keeps the rollups exact when a load is replayed.
+    # Reads use the bulk profile, at LOCAL_QUORUM, and so does every write
+    # that marks an hour dirty, single inserts and deletes included, so the
+    # reads overlap the replicas the writes reached
+    hour_keys = sorted(set(hour_keys))
+    for i in range(0, len(hour_keys), ROLLUP_REFRESH_CHUNK):
+        _refresh_hours(session, hour_keys[i : i+ROLLUP_REFRESH_CHUNK], concurrency)
+
+    day_keys = sorted(set((account_id, vital_sign_type, hour // 86400 * 86400)
+                          for account_id, vital_sign_type, hour in hour_keys))
+    for i in range(0, len(day_keys), ROLLUP_REFRESH_CHUNK):
+        _refresh_days(session, day_keys[i : i+ROLLUP_REFRESH_CHUNK], concurrency)
+
+class RollupRefresher(object):
+    """
+    Rebuilds the rollups of hours marked dirty from a background thread
+    every interval seconds, so a single insert never waits on them. Each
+    hour is rebuilt once per round however many readings touched it.
+    Hours marked but not yet rebuilt when the process dies stay stale
+    until their next reading.
+    """
+
+    def __init__(self, session, interval=ROLLUP_REFRESH_SECONDS):
+        self.session = session
+        self.interval = interval
+        self.refreshed = 0
+        self.errors = 0
+        self._dirty = set()
+        self._busy = False
+        self._stopped = False
+        self._flush_requested = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="rollup-refresher", daemon=True)
+        self._thread.start()
+
+    def mark(self, hour_keys):
+        with self._condition:
+            self._dirty.update(hour_keys)
+
+    def flush(self, timeout=ROLLUP_FLUSH_TIMEOUT):
+        # Rebuilds the dirty hours now and waits for them, for at most
+        # timeout seconds. Returns whether they were all rebuilt
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._stopped or (not self._dirty and not self._busy), timeout)
+            if not self._dirty and not self._busy:
+                return True
+            log.warning(f"{len(self._dirty)} rollup hours left dirty by the flush")
+            return False
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._flush_requested, self.interval)
+                self._flush_requested = False
+                if self.session.is_shutdown:
+                    # Nothing can be rebuilt any more, flush reports the
+                    # hours left dirty
+                    self._stopped = True
+                    self._condition.notify_all()
+                    return
+                keys, self._dirty = self._dirty, set()
+                self._busy = bool(keys)
+            if keys:
+                try:
+                    refresh_rollups(self.session, keys)
+                    self.refreshed += len(keys)
+                except Exception as exc:
+                    # Retried next round
+                    self.errors += 1
+                    log.error(f"Refreshing {len(keys)} rollup hours failed: {exc}")
+                    with self._condition:
+                        self._dirty.update(keys)
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+_rollup_refreshers = {}
+_rollup_refreshers_lock = threading.Lock()
+
+def get_rollup_refresher(session):
+    with _rollup_refreshers_lock:
+        refresher = _rollup_refreshers.get(session)
+        if refresher is None:
+            refresher = _rollup_refreshers[session] = RollupRefresher(session)
+        return refresher
+
+@atexit.register
+def flush_rollup_refreshers():
+    for session, refresher in list(_rollup_refreshers.items()):
+        if not session.is_shutdown:
+            refresher.flush()
+
+def default_datetime_range(start_date, end_date):
+    # Dates stand for their midnight
+    start_date, end_date = default_date_range(start_date, end_date)
+    if not isinstance(start_date, datetime):
+        start_date = datetime.combine(start_date, dt.time())
+    if not isinstance(end_date, datetime):
+        end_date = datetime.combine(end_date, dt.time())
+    return start_date, end_date
+
+def summary_query(account_id, vital_sign_type, start_date=None, end_date=None, max_points=DEFAULT_SUMMARY_POINTS):
+    # Returns (resolution, query, params) for the finest rollup that still
+    # fits the range in max_points rows, falling back to daily rows for
+    # ranges longer than that
+    start_date, end_date = default_datetime_range(start_date, end_date)
+    seconds = (end_date - start_date).total_seconds()
+
+    for resolution, width in ROLLUP_RESOLUTIONS:
+        if seconds / width <= max_points:
+            break
+    return resolution, SELECT_VITAL_SIGN_ROLLUPS, [account_id, vital_sign_type, resolution, start_date, end_date]
+
+def get_vital_signs_summary(session, account_id, vital_sign_type, start_date=None, end_date=None,
+                            max_points=DEFAULT_SUMMARY_POINTS):
+    resolution, query, params = summary_query(account_id, vital_sign_type, start_date, end_date, max_points)
+    return resolution, list(session.execute(get_prepared(session, query), params))
+
+DEFAULT_PERCENTILES = [50, 95]
+
+def sketch_periods(start_date, end_date):
+    # (resolution, first period, last period) covering the range with daily
+    # rollups for the whole days and hourly ones for the hours around them.
+    # The first hour is included whole, so the range is rounded to hours
+    start = int((start_date - EPOCH_DATETIME).total_seconds()) // 3600 * 3600
+    end = int((end_date - EPOCH_DATETIME).total_seconds())
+    first_day = -(-start // 86400) * 86400
+    end_day = end // 86400 * 86400
+    if first_day >= end_day:
+        return [('hour', start, end)]
+    periods = [('day', first_day, end_day - 86400), ('hour', start, first_day - 3600), ('hour', end_day, end)]
+    return [period for period in periods if period[1] <= period[2]]
+
+def get_vital_sign_sketch(session, account_id, vital_sign_type, start_date=None, end_date=None,
+                          concurrency=BULK_CONCURRENCY):
+    # Merges the rollup sketches of the range, touching at most two days
+    # of hourly rows whatever the length of the range
+    start_date, end_date = default_datetime_range(start_date, end_date)
+
+    stmt = get_prepared(session, SELECT_VITAL_SIGN_ROLLUPS)
+    params = [(account_id, vital_sign_type, resolution, utc_datetime(first), utc_datetime(last))
+              for resolution, first, last in sketch_periods(start_date, end_date)]
+    results = execute_concurrent_with_args(session, stmt, params, concurrency=concurrency)
+    return quantileSketch.TDigest.merge_all(chain.from_iterable(rollup_sketches(result) for success, result in results))
+
+def get_vital_sign_percentiles(session, account_id, vital_sign_type, start_date=None, end_date=None,
+                               percentiles=DEFAULT_PERCENTILES):
+    # (readings, {percentile: value}) over the range, values are None
+    # without readings
+    sketch = get_vital_sign_sketch(session, account_id, vital_sign_type, start_date, end_date)
+    return sketch.count, sketch.percentiles(percentiles)
+
+def get_daily_percentiles(session, account_id, vital_sign_type, start_date=None, end_date=None,
+                          percentiles=DEFAULT_PERCENTILES):
+    # [(day, readings, {percentile: value})] newest first, from the sketch
+    # of each daily rollup
+    start_date, end_date = default_datetime_range(start_date, end_date)
+    stmt = get_prepared(session, SELECT_VITAL_SIGN_ROLLUPS)
+    rows = session.execute(stmt, [account_id, vital_sign_type, 'day', start_date, end_date])
+    days = []
+    for row in rows:
+        for sketch in rollup_sketches([row]):
+            days.append((row.period, sketch.count, sketch.percentiles(percentiles)))
+    return days
+
+'''
+========================================================
+==                  Paged reads                       ==
+========================================================
+'''
+
+DEFAULT_FETCH_SIZE = int(os.getenv('CASSANDRA_FETCH_SIZE', '20'))
 
-def get_appointments_by_patient(session, patient_id, appointment_date=None):
+def execute_page(session, query, params, fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    # Pulls a single page through the driver. The returned paging state is
+    # opaque and resumes right after the last row, or is None at the end
+    bound = get_prepared(session, query).bind(params)
+    bound.fetch_size = fetch_size
+    rows = session.execute(bound, paging_state=paging_state)
+    return rows.current_rows, rows.paging_state
 
+def appointments_by_patient_query(patient_id, appointment_date=None):
     if appointment_date:
-        stmt = session.prepare(SELECT_APPOINTMENTS_BY_PATIENT_DATE)
         endDate = appointment_date + dt.timedelta(days=1)
-        rows = session.execute(stmt, [patient_id, appointment_date, endDate])
-    else:
-        stmt = session.prepare(SELECT_APPOINTMENTS_BY_PATIENT)
-        rows = session.execute(stmt, [patient_id, appointment_date])
+        return SELECT_APPOINTMENTS_BY_PATIENT_DATE, [patient_id, appointment_date, endDate]
+    return SELECT_APPOINTMENTS_BY_PATIENT, [patient_id, appointment_date]
+
+def get_appointments_by_patient_page(session, patient_id, appointment_date=None,
+                                     fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = appointments_by_patient_query(patient_id, appointment_date)
+    return execute_page(session, query, params, fetch_size, paging_state)
+
+def appointments_by_doctor_query(doctor_id, appointment_date=None):
+    if appointment_date:
+        endDate = appointment_date + dt.timedelta(days=1)
+        return SELECT_APPOINTMENTS_BY_DOCTOR_DATE, [doctor_id, appointment_date, endDate]
+    return SELECT_APPOINTMENTS_BY_DOCTOR, [doctor_id, appointment_date]
+
+def get_appointments_by_doctor_page(session, doctor_id, appointment_date=None,
+                                    fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = appointments_by_doctor_query(doctor_id, appointment_date)
+    return execute_page(session, query, params, fetch_size, paging_state)
 
-    if rows is None:
+def appointments_by_patient_doctor_query(patient_id, doctor_id, appointment_date=None):
+    if appointment_date:
+        endDate = appointment_date + dt.timedelta(days=1)
+        return SELECT_APPOINTMENTS_BY_PATIENT_DOCTOR_DATE, [patient_id, doctor_id, appointment_date, endDate]
+    return SELECT_APPOINTMENTS_BY_PATIENT_DOCTOR, [patient_id, doctor_id, datetime.now()]
+
+def get_appointments_by_patient_doctor_page(session, patient_id, doctor_id, appointment_date=None,
+                                            fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = appointments_by_patient_doctor_query(patient_id, doctor_id, appointment_date)
+    return execute_page(session, query, params, fetch_size, paging_state)
+
+def vital_sign_page_walk(account_id, start_date, end_date, vital_sign_type, fetch_size, paging_state):
+    # Walks the buckets newest first. Yields each window as (query, params,
+    # fetch_size, paging_state) requests to run concurrently, is sent back
+    # their (rows, paging_state) in order and returns (rows, next paging
+    # state). The paging state packs the bucket to resume in with the
+    # driver's paging state inside that bucket. Shared by
+    # get_vital_signs_page and asyncModel.get_vital_signs
+    start_date, end_date = default_date_range(start_date, end_date)
+    buckets = vital_sign_buckets(start_date, end_date)
+    driver_state = None
+    if paging_state:
+        resume_bucket, driver_state = decode_bucket_state(paging_state)
+        buckets = [bucket for bucket in buckets if bucket <= resume_bucket]
+
+    rows = []
+    # The first bucket is read alone for the whole page, a bucket usually
+    # holds more than one. Once a bucket runs out with room left, up to
+    # VITAL_SIGN_BUCKET_FANOUT of the next ones are read at once, each for
+    # an equal share of the room, so every page they return fits
+    fanout = 1
+    while buckets and len(rows) < fetch_size:
+        room = fetch_size - len(rows)
+        count = min(fanout, room)
+        window, buckets = buckets[:count], buckets[count:]
+        requests = []
+        for i, bucket in enumerate(window):
+            query, params = vital_sign_query(account_id, bucket, start_date, end_date, vital_sign_type)
+            size = room // len(window) + (1 if i < room % len(window) else 0)
+            requests.append((query, params, size, driver_state if i == 0 else None))
+        driver_state = None
+        fanout = VITAL_SIGN_BUCKET_FANOUT
+
+        pages = yield requests
+        for bucket, (page, state) in zip(window, pages):
+            rows.extend(page)
+            if state:
+                # The bucket has more rows, the older buckets of the
+                # window are read again by the next page
+                return rows, encode_bucket_state(bucket, state)
+
+    if buckets:
+        return rows, encode_bucket_state(buckets[0], None)
+    return rows, None
+
+def get_vital_signs_page(session, account_id, start_date=None, end_date=None, vital_sign_type=None,
+                         fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    walk = vital_sign_page_walk(account_id, start_date, end_date, vital_sign_type, fetch_size, paging_state)
+    try:
+        requests = next(walk)
+        while True:
+            futures = []
+            for query, params, size, state in requests:
+                bound = get_prepared(session, query).bind(params)
+                bound.fetch_size = size
+                futures.append(session.execute_async(bound, paging_state=state))
+            results = [future.result() for future in futures]
+            requests = walk.send([(result.current_rows, result.paging_state) for result in results])
+    except StopIteration as stop:
+        return stop.value
+
+def get_vital_signs_range(session, account_id, start_date=None, end_date=None, vital_sign_type=None,
+                          concurrency=BULK_CONCURRENCY):
+    # Queries every bucket in the range concurrently. Buckets never overlap
+    # in time, so chaining them newest first keeps the rows in time order
+    start_date, end_date = default_date_range(start_date, end_date)
+    buckets = vital_sign_buckets(start_date, end_date)
+    query = vital_sign_query(account_id, None, start_date, end_date, vital_sign_type)[0]
+    params = [vital_sign_query(account_id, bucket, start_date, end_date, vital_sign_type)[1] for bucket in buckets]
+    results = execute_concurrent_with_args(session, get_prepared(session, query), params, concurrency=concurrency)
+    return chain.from_iterable(result for success, result in results)
+
+def get_vital_signs_many(session, account_ids, start_date=None, end_date=None, vital_sign_types=None,
+                         concurrency=BULK_CONCURRENCY):
+    # Yields (account_id, rows) for a whole ward, each patient as soon as
+    # all of its partitions are read, so the ward loads in about one round
+    # trip. Every (account, bucket, type) partition is one query, with at
+    # most concurrency of them in flight. Rows come newest first
+    start_date, end_date = default_date_range(start_date, end_date)
+    account_ids = list(dict.fromkeys(account_ids))
+    types = list(dict.fromkeys(vital_sign_types or [None]))
+    buckets = vital_sign_buckets(start_date, end_date)
+    queries = [(account_id,) + tuple(vital_sign_query(account_id, bucket, start_date, end_date, vital_sign_type))
+               for account_id in account_ids for vital_sign_type in types for bucket in buckets]
+    remaining = {account_id: len(types) * len(buckets) for account_id in account_ids}
+    rows = {account_id: [] for account_id in account_ids}
+    # Callbacks run on the driver's event thread and hand every finished
+    # partition back to this generator through done
+    done = queue.Queue()
+    in_flight = set()
+
+    def start(account_id, query, params):
+        future = session.execute_async(get_prepared(session, query).bind(params))
+        partition = []
+
+        def on_page(page):
+            partition.extend(page or [])
+            if future.has_more_pages:
+                future.start_fetching_next_page()
+                return
+            done.put((future, account_id, partition, None))
+
+        future.add_callbacks(on_page, lambda exc: done.put((future, account_id, partition, exc)))
+        in_flight.add(future)
+
+    pending = iter(queries)
+    try:
+        for account_id, query, params in islice(pending, concurrency):
+            start(account_id, query, params)
+        while in_flight:
+            future, account_id, partition, exc = done.get()
+            in_flight.discard(future)
+            for account_id_next, query, params in islice(pending, 1):
+                start(account_id_next, query, params)
+            if exc is not None:
+                log.error(f"Vital signs of {account_id} failed: {exc}")
+            rows[account_id].extend(partition)
+            remaining[account_id] -= 1
+            if not remaining[account_id]:
+                yield account_id, sorted(rows.pop(account_id), key=lambda row: row.vital_sign_id.time,
+                                         reverse=True)
+        # Accounts with no bucket in the range
+        for account_id in list(rows):
+            yield account_id, rows.pop(account_id)
+    finally:
+        # The caller stopped early, the rest of the ward is not needed
+        for future in in_flight:
+            future.cancel()
+
+def alerts_query(account_id):
+    date = datetime.now() - dt.timedelta(days=760)
+    return SELECT_ALERTS_BY_ACCOUNT, [account_id, date]
+
+def get_alerts_page(session, account_id, fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    query, params = alerts_query(account_id)
+    return execute_page(session, query, params, fetch_size, paging_state)
+
+'''
+========================================================
+==                 Printed listings                   ==
+========================================================
+'''
+
+# The listings below print one page and return the paging state of the
+# next one, pass it back in to continue where the last page stopped
+
+def get_appointments_by_patient(session, patient_id, appointment_date=None,
+                                fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    rows, next_state = get_appointments_by_patient_page(session, patient_id, appointment_date,
+                                                        fetch_size, paging_state)
+
+    if not rows and paging_state is None:
         print("You have no appointments.")
-        return
+        return None
 
+    users = get_users(session, [row.doctor_id for row in rows])
     for row in rows:
         print(" ")
         print("**** Appointment ****")
-        doctorData = get_user(session, row.doctor_id)
         date = time_uuid.TimeUUID.get_timestamp(row.appointment_id)
         date = datetime.fromtimestamp(date)
         print(f"=== Date: {date}")
-        print(f"=== Doctor: {doctorData[3]} {doctorData[4]}")
+        print(f"=== Doctor: {full_name(users, row.doctor_id)}")
         print(f"=== Status: {row.status}")
         print(f"=== Notes: {row.notes}")
+    return next_state
 
 
-def get_appointments_by_doctor(session, doctor_id, appointment_date=None):
-    if appointment_date:
-        stmt = session.prepare(SELECT_APPOINTMENTS_BY_DOCTOR_DATE)
-        endDate = appointment_date + dt.timedelta(days=1)
-        rows = session.execute(stmt, [doctor_id, appointment_date, endDate])
-    else:
-        stmt = session.prepare(SELECT_APPOINTMENTS_BY_DOCTOR)
-        rows = session.execute(stmt, [doctor_id, appointment_date])
+def get_appointments_by_doctor(session, doctor_id, appointment_date=None,
+                               fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    rows, next_state = get_appointments_by_doctor_page(session, doctor_id, appointment_date,
+                                                       fetch_size, paging_state)
 
-    if rows is None:
+    if not rows and paging_state is None:
         print("You have no appointments.")
-        return
+        return None
 
+    users = get_users(session, [row.patient_id for row in rows])
     for row in rows:
-        patientData = get_user(session, row.patient_id)
         print(" ")
         print("**** Appointment ****")
         date = time_uuid.TimeUUID.get_timestamp(row.appointment_id)
         date = datetime.fromtimestamp(date)
         print(f"=== Date: {date}")
-        print(f"=== Patient: {patientData[3]} {patientData[4]}")
+        print(f"=== Patient: {full_name(users, row.patient_id)}")
         print(f"=== Status: {row.status}")
         print(f"=== Notes: {row.notes}")
+    return next_state
 
-def get_appointments_by_patient_doctor(session, patient_id, doctor_id, appointment_date=None):
-    if appointment_date:
-        stmt = session.prepare(SELECT_APPOINTMENTS_BY_PATIENT_DOCTOR_DATE)
-        endDate = appointment_date + dt.timedelta(days=1)
-        rows = session.execute(stmt, [patient_id, doctor_id, appointment_date, endDate])
-    else:
-        appointment_date = datetime.datetime.now()
-        stmt = session.prepare(SELECT_APPOINTMENTS_BY_PATIENT_DOCTOR)
-        rows = session.execute(stmt, [patient_id, doctor_id, appointment_date])
+def get_appointments_by_patient_doctor(session, patient_id, doctor_id, appointment_date=None,
+                                       fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    rows, next_state = get_appointments_by_patient_doctor_page(session, patient_id, doctor_id,
+                                                               appointment_date, fetch_size, paging_state)
 
-    if rows is None:
+    if not rows and paging_state is None:
         print("You have no appointments.")
-        return
+        return None
 
+    users = get_users(session, [row.patient_id for row in rows] + [row.doctor_id for row in rows])
     for row in rows:
-        patientData = get_user(session, row.patient_id)
-        doctorData = get_user(session, row.doctor_id)
         print(" ")
         print("**** Appointment ****")
         date = time_uuid.TimeUUID.get_timestamp(row.appointment_id)
         date = datetime.fromtimestamp(date)
         print(f"=== Date: {date}")
-        print(f"=== Doctor: {doctorData[3]} {doctorData[4]}")
-        print(f"=== Patient: {patientData[3]} {patientData[4]}")
+        print(f"=== Doctor: {full_name(users, row.doctor_id)}")
+        print(f"=== Patient: {full_name(users, row.patient_id)}")
         print(f"=== Status: {row.status}")
         print(f"=== Notes: {row.notes}")
+    return next_state
 
-def insert_vital_sign(session, vitalSignData):
-    vs_stmt = session.prepare(INSERT_VITAL_SIGN_BY_ACCOUNT_DATE)
-    vsad_stmt = session.prepare(INSERT_VITAL_SIGN_BY_ACCOUNT_TYPE_DATE)
+def vital_sign_row(session, vitalSignData):
+    # Adds the bucket to the row and hands an alert to the alert writer
+    # when the reading trips a rule
+    vitalSignData = list(vitalSignData[:5]) + [uuid_bucket(vitalSignData[0])]
 
-    if check_vital_signs(vitalSignData[2], vitalSignData[3]):
+    if alert_rules.evaluate(vitalSignData[1], vitalSignData[2], uuid_timestamp(vitalSignData[0]), vitalSignData[3]):
         alertData = ['']*5
-        alertData[0] = random_dateUUID(datetime.now() + dt.timedelta(hours=6))
+        alertData[0] = vitalSignData[0]
         alertData[1] = vitalSignData[1]
         alertData[2] = vitalSignData[4]
         alertData[3] = "Vital Signs"
-        alertData[4] = "You're vital signs are out of bounds take a moment"
-        insert_alert(session, alertData)
-
-    execute_batch(session, vs_stmt, [vitalSignData])
-    execute_batch(session, vsad_stmt, [vitalSignData])
-
-def delete_vital_signs(session, account_id, start_date, end_date):
-    vs_stmt = session.prepare(DELETE_VITAL_SIGNS_BY_ACCOUNT_DATE)
-    vsad_stmt = session.prepare(DELETE_VITAL_SIGNS_BY_ACCOUNT_TYPE_DATE)
+        alertData[4] = VITAL_SIGN_ALERT_MESSAGE
+        get_alert_writer(session).submit(alertData)
+    return vitalSignData
 
+def insert_vital_sign(session, vitalSignData):
+    # Both tables and the snapshot are written in one concurrent round, at
+    # the bulk profile the rollup rebuilds read with, the rollups of the
+    # hour are rebuilt in the background
+    vitalSignData = vital_sign_row(session, vitalSignData)
+    writes = [(get_prepared(session, query), vitalSignData) for query in VITAL_SIGN_INSERTS]
+    writes.append((get_prepared(session, INSERT_VITAL_SIGN_TYPE), vitalSignData[1:3]))
+    writes.append((get_prepared(session, INSERT_LATEST_VITAL_SIGN), latest_vital_sign_params(vitalSignData)))
+    execute_concurrent(session, writes, concurrency=len(writes),
+                       execution_profile=profile_for(session, clusterProfile.PROFILE_BULK))
+    get_rollup_refresher(session).mark([rollup_key(vitalSignData[1], vitalSignData[2], vitalSignData[0])])
+
+def delete_range(start_date, end_date):
     if not start_date:
-        start_date = datetime.now() - dt.timedelta(days=30)
+        start_date = datetime.utcnow() - dt.timedelta(days=30)
     if not end_date:
-        end_date = datetime.now()
-
-    deleteVitalSigns = [account_id, start_date, end_date]
-    execute_batch(session, vs_stmt, [deleteVitalSigns])
-
-    vitalSignsTypes = ['blood pressure', 'heart rate', 'temperature', 'weight', 'height']
-    for vitalSignType in vitalSignsTypes:
-        deleteVitalSignsType = [account_id, vitalSignType, start_date, end_date]
-        execute_batch(session, vsad_stmt, [deleteVitalSignsType])
-
-def get_vital_signs(session, account_id, start_date=None, end_date=None, vital_sign_type=None):
-
-    if vital_sign_type:
-        stmt = session.prepare(SELECT_VITAL_SIGNS_BY_ACCOUNT_TYPE_DATE)
-        rows = session.execute(stmt, [account_id, vital_sign_type, start_date, end_date])
-    else:
-        stmt = session.prepare(SELECT_VITAL_SIGNS_BY_ACCOUNT_DATE)
-        rows = session.execute(stmt, [account_id, start_date, end_date])
-
-    if rows is None:
+        end_date = datetime.utcnow()
+    return start_date, end_date
+
+def vital_sign_types(session, account_id, latest):
+    # Types the per type deletes cover, read from the account's partition
+    # of the type index instead of from every reading in the range. The
+    # snapshot rows are added for readings written before the index was
+    # backfilled, see migrate_vital_sign_buckets
+    rows = session.execute(get_prepared(session, SELECT_VITAL_SIGN_TYPES_BY_ACCOUNT), [account_id])
+    return {row.type for row in rows} | {row.type for row in latest}
+
+def vital_sign_deletes(account_id, start_date, end_date, vital_sign_types):
+    start_date, end_date = delete_range(start_date, end_date)
+    buckets = vital_sign_buckets(start_date, end_date)
+    deleteVitalSigns = [(DELETE_VITAL_SIGNS_BY_ACCOUNT_BUCKET, (account_id, bucket, start_date, end_date))
+                        for bucket in buckets]
+
+    for vitalSignType in vital_sign_types:
+        deleteVitalSigns.extend((DELETE_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET,
+                                 (account_id, vitalSignType, bucket, start_date, end_date))
+                                for bucket in buckets)
+    return deleteVitalSigns
+
+def delete_vital_signs(session, account_id, start_date, end_date, concurrency=BULK_CONCURRENCY):
+    latest = get_latest_vitals(session, [account_id], concurrency)[account_id].values()
+    types = vital_sign_types(session, account_id, latest)
+    deletes = [(get_prepared(session, query), params)
+               for query, params in vital_sign_deletes(account_id, start_date, end_date, types)]
+    deletes.extend((get_prepared(session, query), params)
+                   for query, params in latest_vital_sign_deletes(latest, start_date, end_date))
+    touched = rollup_hours(session, account_id, types, start_date, end_date, concurrency)
+    execute_concurrent(session, deletes, concurrency=concurrency,
+                       execution_profile=profile_for(session, clusterProfile.PROFILE_BULK))
+    # Hours left without readings lose their rollups, the others are
+    # rebuilt from the readings that remain
+    refresh_rollups(session, touched, concurrency)
+
+def rollup_hours(session, account_id, vital_sign_types, start_date, end_date, concurrency=BULK_CONCURRENCY):
+    # Rollup keys of the hours in the range that have an hourly rollup
+    start_date, end_date = default_datetime_range(*delete_range(start_date, end_date))
+    start = start_date - dt.timedelta(seconds=(start_date - EPOCH_DATETIME).total_seconds() % 3600)
+    vital_sign_types = list(vital_sign_types)
+    stmt = get_prepared(session, SELECT_VITAL_SIGN_ROLLUPS)
+    params = [(account_id, vital_sign_type, 'hour', start, end_date) for vital_sign_type in vital_sign_types]
+    results = execute_concurrent_with_args(session, stmt, params, concurrency=concurrency)
+    return [(account_id, vital_sign_type, int((row.period - EPOCH_DATETIME).total_seconds()))
+            for vital_sign_type, (success, result) in zip(vital_sign_types, results) for row in result]
+
+def get_vital_signs(session, account_id, start_date=None, end_date=None, vital_sign_type=None,
+                    fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    rows, next_state = get_vital_signs_page(session, account_id, start_date, end_date, vital_sign_type,
+                                            fetch_size, paging_state)
+
+    if not rows and paging_state is None:
         print("You have no vital signs registered.")
-        return
+        return None
 
     for row in rows:
         print(" ")
@@ -721,21 +2296,20 @@ def get_vital_signs(session, account_id, start_date=None, end_date=None, vital_s
         print(f"=== Date: {row.date}")
         print(f"=== Type: {row.type}")
         print(f"=== Value: {row.value}")
+    return next_state
 
 
 def insert_alert(session, alertData):
 
-    stmt = session.prepare(INSERT_ALERT_BY_ACCOUNT_DATE)
+    stmt = get_prepared(session, INSERT_ALERT_BY_ACCOUNT_DATE)
     session.execute(stmt, alertData)
 
-def get_alerts(session, account_id):
-    date = datetime.now() - dt.timedelta(days=760)
-    stmt = session.prepare(SELECT_ALERTS_BY_ACCOUNT)
-    rows = session.execute(stmt, [account_id, date])
+def get_alerts(session, account_id, fetch_size=DEFAULT_FETCH_SIZE, paging_state=None):
+    rows, next_state = get_alerts_page(session, account_id, fetch_size, paging_state)
 
-    if rows is None:
+    if not rows and paging_state is None:
         print("You have no alerts in the last 30 days.")
-        return
+        return None
 
     for row in rows:
         print(" ")
@@ -745,8 +2319,317 @@ def get_alerts(session, account_id):
         print(f"=== Date: {date}")
         print(f"=== Type: {row.alert_type}")
         print(f"=== Message: {row.alert_message}")
+    return next_state
+
+'''
+========================================================
+==                 Latest vital signs                 ==
+========================================================
+'''
+
+def uuid_micros(vital_sign_id):
+    return (vital_sign_id.time - UUID_EPOCH_OFFSET) // 10
+
+def latest_vital_sign_params(vitalSignData):
+    return (vitalSignData[1], vitalSignData[2], vitalSignData[0], vitalSignData[3], vitalSignData[4],
+            uuid_micros(vitalSignData[0]))
+
+def write_latest_vital_signs(session, rows, concurrency=BULK_CONCURRENCY):
+    stmt = get_prepared(session, INSERT_LATEST_VITAL_SIGN)
+    execute_concurrent_with_args(session, stmt, [latest_vital_sign_params(row) for row in rows],
+                                 concurrency=concurrency)
+
+def latest_vital_sign_deletes(latest, start_date, end_date):
+    # A snapshot whose reading was deleted is removed with a tombstone at the
+    # reading's own timestamp, so a newer reading written meanwhile survives.
+    # The type has no snapshot until its next reading
+    start_date, end_date = delete_range(start_date, end_date)
+    if not isinstance(start_date, datetime):
+        start_date = datetime.combine(start_date, dt.time())
+    if not isinstance(end_date, datetime):
+        end_date = datetime.combine(end_date, dt.time())
+    start = (start_date - EPOCH_DATETIME).total_seconds()
+    end = (end_date - EPOCH_DATETIME).total_seconds()
+    return [(DELETE_LATEST_VITAL_SIGN, (uuid_micros(row.vital_sign_id), row.account_id, row.type))
+            for row in latest if start <= uuid_timestamp(row.vital_sign_id) <= end]
+
+def get_latest_vitals(session, account_ids, concurrency=BULK_CONCURRENCY):
+    # Returns {account_id: {type: row}} for a whole ward in one concurrent
+    # round, one single partition read per account
+    account_ids = list(dict.fromkeys(account_ids))
+    stmt = get_prepared(session, SELECT_LATEST_VITAL_SIGNS)
+    results = execute_concurrent_with_args(session, stmt, [(account_id,) for account_id in account_ids],
+                                           concurrency=concurrency, raise_on_first_error=False)
+    latest = {}
+    for account_id, (success, result) in zip(account_ids, results):
+        if not success:
+            log.error(f"Latest vital signs of {account_id} failed: {result}")
+            result = []
+        latest[account_id] = {row.type: row for row in result}
+    return latest
+
+'''
+========================================================
+==                    Retention                       ==
+========================================================
+'''
+
+# Days each table keeps its rows, 0 keeps them forever. They are applied
+# as the tables' default TTL so every insert expires without binding one
+VITAL_SIGN_RETENTION_DAYS = int(os.getenv('CASSANDRA_VITAL_SIGN_RETENTION_DAYS', '365'))
+ROLLUP_RETENTION_DAYS = int(os.getenv('CASSANDRA_ROLLUP_RETENTION_DAYS', '1095'))
+ALERT_RETENTION_DAYS = int(os.getenv('CASSANDRA_ALERT_RETENTION_DAYS', '760'))
+# Deletes per second issued by the purge job, and at most this many in flight
+PURGE_RATE = float(os.getenv('CASSANDRA_PURGE_RATE', '200'))
+PURGE_CONCURRENCY = 8
+# The retention job is off unless an interval is set, and its first full
+# scan waits PURGE_START_DELAY seconds so short CLI sessions never run it
+PURGE_INTERVAL_HOURS = float(os.getenv('CASSANDRA_PURGE_INTERVAL_HOURS', '0'))
+PURGE_START_DELAY = float(os.getenv('CASSANDRA_PURGE_START_DELAY', '600'))
+PURGE_FETCH_SIZE = 1000
+
+LEVELED_COMPACTION = "{'class': 'LeveledCompactionStrategy'}"
+SIZE_TIERED_COMPACTION = "{'class': 'SizeTieredCompactionStrategy'}"
+
+def time_window_compaction(retention_days):
+    # Around 30 windows over the retention, so whole SSTables expire together
+    window = max(1, retention_days // 30) if retention_days else VITAL_SIGN_BUCKET_DAYS
+    return ("{'class': 'TimeWindowCompactionStrategy', "
+            f"'compaction_window_unit': 'DAYS', 'compaction_window_size': {window}}}")
+
+def retention_settings():
+    # (table, retention days, compaction) for every table that expires.
+    # Raw readings and alerts are append only time series, the snapshot and
+    # the rollups are overwritten in place
+    return [
+        ('vital_signs_by_account_bucket', VITAL_SIGN_RETENTION_DAYS, time_window_compaction(VITAL_SIGN_RETENTION_DAYS)),
+        ('vital_signs_by_account_type_bucket', VITAL_SIGN_RETENTION_DAYS, time_window_compaction(VITAL_SIGN_RETENTION_DAYS)),
+        ('alerts_by_account_date', ALERT_RETENTION_DAYS, time_window_compaction(ALERT_RETENTION_DAYS)),
+        ('latest_vital_signs', VITAL_SIGN_RETENTION_DAYS, LEVELED_COMPACTION),
+        ('vital_sign_types_by_account', VITAL_SIGN_RETENTION_DAYS, LEVELED_COMPACTION),
+        ('vital_sign_rollups', ROLLUP_RETENTION_DAYS, SIZE_TIERED_COMPACTION),
+    ]
+
+class RateLimiter(object):
+    """
+    Spaces operations out to at most rate per second, rate 0 disables it.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+
+    def wait(self, count=1):
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(self._next, now) + count * self.interval
+
+def execute_throttled(session, stats, writes, rate=PURGE_RATE, concurrency=PURGE_CONCURRENCY):
+    # Sends the (query, params) writes a round of concurrency at a time,
+    # pausing between rounds to stay under rate writes per second
+    limiter = RateLimiter(rate)
+    profile = profile_for(session, clusterProfile.PROFILE_BULK)
+    writes = _prepared_writes(session, writes)
+    start = time.perf_counter()
+    while True:
+        chunk = list(islice(writes, concurrency))
+        if not chunk:
+            break
+        limiter.wait(len(chunk))
+        for success, result in execute_concurrent(session, chunk, concurrency=concurrency,
+                                                  raise_on_first_error=False, execution_profile=profile):
+            stats.writes += 1
+            if not success:
+                stats.errors += 1
+                log.error(f"{stats.name} failed a delete: {result}")
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+def _scan_partitions(session, query):
+    return session.execute(SimpleStatement(query, fetch_size=PURGE_FETCH_SIZE))
+
+def _purge_writes(session, stats, now):
+    # Whole buckets older than the cutoff are dropped with one partition
+    # delete each, the bucket holding the cutoff with a range delete. The
+    # types are read from the partition keys actually stored
+    if VITAL_SIGN_RETENTION_DAYS:
+        cutoff = now - dt.timedelta(days=VITAL_SIGN_RETENTION_DAYS)
+        last_bucket = vital_sign_bucket(cutoff)
+        for row in _scan_partitions(session, SELECT_VITAL_SIGN_PARTITIONS):
+            stats.rows += 1
+            if row.bucket < last_bucket:
+                yield DELETE_VITAL_SIGN_BUCKET, (row.account_id, row.bucket)
+            elif row.bucket == last_bucket:
+                yield DELETE_VITAL_SIGNS_BY_ACCOUNT_BUCKET, (row.account_id, row.bucket, EPOCH_DATETIME, cutoff)
+        for row in _scan_partitions(session, SELECT_VITAL_SIGN_TYPE_PARTITIONS):
+            stats.rows += 1
+            if row.bucket < last_bucket:
+                yield DELETE_VITAL_SIGN_TYPE_BUCKET, (row.account_id, row.type, row.bucket)
+            elif row.bucket == last_bucket:
+                yield (DELETE_VITAL_SIGNS_BY_ACCOUNT_TYPE_BUCKET,
+                       (row.account_id, row.type, row.bucket, EPOCH_DATETIME, cutoff))
+
+    if ROLLUP_RETENTION_DAYS:
+        # Rollups outlive the readings they summarize on purpose, they are
+        # dropped only once past their own retention
+        cutoff = now - dt.timedelta(days=ROLLUP_RETENTION_DAYS)
+        for row in _scan_partitions(session, SELECT_VITAL_SIGN_ROLLUP_PARTITIONS):
+            stats.rows += 1
+            yield DELETE_VITAL_SIGN_ROLLUPS_BEFORE, (row.account_id, row.type, row.resolution, cutoff)
+
+    if ALERT_RETENTION_DAYS:
+        cutoff = now - dt.timedelta(days=ALERT_RETENTION_DAYS)
+        for row in _scan_partitions(session, SELECT_ALERT_PARTITIONS):
+            stats.rows += 1
+            yield DELETE_ALERTS_BEFORE, (row.account_id, cutoff)
+
+def purge_expired(session, rate=PURGE_RATE, concurrency=PURGE_CONCURRENCY):
+    # Deletes readings, rollups and alerts older than their retention by
+    # reading time. TTLs count from the write instead, this catches rows loaded
+    # after the fact and rows written before the TTLs were set.
+    # stats.rows counts the partitions scanned
+    stats = LoadStats("purge")
+    execute_throttled(session, stats, _purge_writes(session, stats, datetime.utcnow()), rate, concurrency)
+    log.info(str(stats))
+    return stats
+
+class RetentionJob(object):
+    """
+    Runs purge_expired from a background thread every interval_hours,
+    the first time after delay seconds.
+    """
+
+    def __init__(self, session, interval_hours=PURGE_INTERVAL_HOURS, rate=PURGE_RATE, delay=PURGE_START_DELAY):
+        self.session = session
+        self.interval = interval_hours * 3600
+        self.rate = rate
+        self.delay = delay
+        self.last_run = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        self._stop.wait(self.delay)
+        while not self._stop.is_set():
+            try:
+                self.last_run = purge_expired(self.session, self.rate)
+            except Exception as exc:
+                log.error(f"Retention purge failed: {exc}")
+            self._stop.wait(self.interval)
+
+def start_retention_job(session):
+    if PURGE_INTERVAL_HOURS <= 0:
+        return None
+    return RetentionJob(session)
+
+'''
+========================================================
+==                 Account lookups                    ==
+========================================================
+'''
+
+ACCOUNT_CACHE_SIZE = int(os.getenv('CASSANDRA_ACCOUNT_CACHE_SIZE', '10000'))
+ACCOUNT_CACHE_TTL = float(os.getenv('CASSANDRA_ACCOUNT_CACHE_TTL', '300'))
+
+class AccountCache(object):
+    """
+    Bounded LRU cache of account rows with a time to live, shared by
+    logins and the appointment listings that resolve names.
+    """
+
+    def __init__(self, max_size=ACCOUNT_CACHE_SIZE, ttl=ACCOUNT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, account_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._rows.get(account_id)
+            if entry is None or entry[0] < now:
+                self._rows.pop(account_id, None)
+                self.misses += 1
+                return None
+            self._rows.move_to_end(account_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, account_id, row):
+        with self._lock:
+            self._rows[account_id] = (time.monotonic() + self.ttl, row)
+            self._rows.move_to_end(account_id)
+            while len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, account_id=None):
+        with self._lock:
+            if account_id is None:
+                self._rows.clear()
+            else:
+                self._rows.pop(account_id, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._rows),
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+accounts = AccountCache()
 
 def get_user(session, account_id):
-    stmt = session.prepare(SELECT_ACCOUNTS)
-    rows = session.execute(stmt, [account_id])
-    return rows[0] if rows else None
\ No newline at end of file
+    row = accounts.get(account_id)
+    if row is not None:
+        return row
+
+    stmt = get_prepared(session, SELECT_ACCOUNTS)
+    rows = session.execute(stmt, [account_id], execution_profile=profile_for(session, clusterProfile.PROFILE_LOGIN))
+    row = rows[0] if rows else None
+    # Unknown ids are not cached so a freshly created account is found
+    if row is not None:
+        accounts.put(account_id, row)
+    return row
+
+def get_users(session, account_ids, concurrency=BULK_CONCURRENCY):
+    # Resolves the distinct ids in one concurrent round instead of one
+    # blocking query per row, returns {account_id: row or None}
+    users = {}
+    missing = []
+    for account_id in set(account_ids):
+        row = accounts.get(account_id)
+        if row is not None:
+            users[account_id] = row
+        else:
+            missing.append(account_id)
+
+    if missing:
+        stmt = get_prepared(session, SELECT_ACCOUNTS)
+        results = execute_concurrent_with_args(session, stmt, [(account_id,) for account_id in missing],
+                                               concurrency=concurrency, raise_on_first_error=False,
+                                               execution_profile=profile_for(session, clusterProfile.PROFILE_LOGIN))
+        for account_id, (success, result) in zip(missing, results):
+            row = None
+            if success:
+                rows = list(result)
+                row = rows[0] if rows else None
+                if row is not None:
+                    accounts.put(account_id, row)
+            else:
+                log.error(f"Account lookup for {account_id} failed: {result}")
+            users[account_id] = row
+    return users
+
+def full_name(users, account_id):
+    user = users.get(account_id)
+    return f"{user[3]} {user[4]}" if user else account_id
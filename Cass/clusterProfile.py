@@ -0,0 +1,142 @@
+import copy
+import json
+import logging
+import os
+
+from cassandra import ConsistencyLevel
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import (ConstantSpeculativeExecutionPolicy, DCAwareRoundRobinPolicy,
+                                FallthroughRetryPolicy, HostDistance, RetryPolicy, TokenAwarePolicy)
+
+log = logging.getLogger()
+
+'''
+========================================================
+==               Connection profile                   ==
+========================================================
+
+Settings come from the defaults below, then the JSON file named by
+CASSANDRA_CONFIG_FILE, then the environment. A config file looks like:
+
+    {
+        "contact_points": ["10.0.0.1", "10.0.0.2"],
+        "local_dc": "dc1",
+        "protocol_version": 4,
+        "compression": "lz4",
+        "profiles": {
+            "login": {"request_timeout": 1.5},
+            "bulk": {"request_timeout": 120, "consistency": "LOCAL_ONE"}
+        }
+    }
+
+Profiles are the driver's execution profiles. "default" serves every
+query that names no profile and speculatively retries idempotent
+statements (every prepared SELECT is idempotent, see StatementRegistry).
+"login" fails fast on account lookups and "bulk" tolerates slow
+replicas during loads and purges.
+'''
+
+CONFIG_FILE = os.getenv('CASSANDRA_CONFIG_FILE')
+
+PROFILE_LOGIN = 'login'
+PROFILE_BULK = 'bulk'
+
+DEFAULT_SETTINGS = {
+    "contact_points": ["localhost"],
+    "port": 9042,
+    # None lets the driver take the datacenter of the first contact point
+    "local_dc": None,
+    # None negotiates the highest version both sides support
+    "protocol_version": None,
+    # Only honoured by protocol versions 1 and 2, newer ones multiplex
+    # thousands of requests over one connection per host
+    "connections_per_host": None,
+    "connect_timeout": 5,
+    # True picks lz4 or snappy when installed, or "lz4", "snappy", false
+    "compression": True,
+    "profiles": {
+        "default": {"request_timeout": 10, "consistency": "LOCAL_ONE",
+                    "speculative_delay": 0.1, "speculative_attempts": 2},
+        PROFILE_LOGIN: {"request_timeout": 2, "consistency": "LOCAL_ONE", "retry": "never"},
+        PROFILE_BULK: {"request_timeout": 60, "consistency": "LOCAL_QUORUM"},
+    },
+}
+
+# (environment variable, setting, parser)
+ENV_SETTINGS = [
+    ('CASSANDRA_CLUSTER_IPS', 'contact_points', lambda value: value.split(',')),
+    ('CASSANDRA_PORT', 'port', int),
+    ('CASSANDRA_LOCAL_DC', 'local_dc', str),
+    ('CASSANDRA_PROTOCOL_VERSION', 'protocol_version', int),
+    ('CASSANDRA_CONNECTIONS_PER_HOST', 'connections_per_host', int),
+    ('CASSANDRA_CONNECT_TIMEOUT', 'connect_timeout', float),
+    ('CASSANDRA_COMPRESSION', 'compression', lambda value: {'true': True, 'false': False}.get(value.lower(), value)),
+]
+
+# (environment variable, profile, setting)
+ENV_PROFILE_SETTINGS = [
+    ('CASSANDRA_REQUEST_TIMEOUT', 'default', 'request_timeout'),
+    ('CASSANDRA_LOGIN_TIMEOUT', PROFILE_LOGIN, 'request_timeout'),
+    ('CASSANDRA_BULK_TIMEOUT', PROFILE_BULK, 'request_timeout'),
+    ('CASSANDRA_SPECULATIVE_DELAY', 'default', 'speculative_delay'),
+]
+
+def load_settings(path=CONFIG_FILE):
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    if path:
+        with open(path, mode='r') as file:
+            config = json.load(file)
+        for name, profile in config.pop('profiles', {}).items():
+            settings['profiles'].setdefault(name, {}).update(profile)
+        settings.update(config)
+
+    for variable, name, parse in ENV_SETTINGS:
+        value = os.getenv(variable)
+        if value:
+            settings[name] = parse(value)
+    for variable, profile, name in ENV_PROFILE_SETTINGS:
+        value = os.getenv(variable)
+        if value:
+            settings['profiles'][profile][name] = float(value)
+    return settings
+
+def load_balancing_policy(settings):
+    # Replicas of the statement's partition first, in the local datacenter
+    return TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=settings['local_dc']))
+
+def execution_profile(settings, profile):
+    speculative = None
+    if profile.get('speculative_delay'):
+        speculative = ConstantSpeculativeExecutionPolicy(profile['speculative_delay'],
+                                                         int(profile.get('speculative_attempts', 1)))
+    return ExecutionProfile(
+        load_balancing_policy=load_balancing_policy(settings),
+        retry_policy=FallthroughRetryPolicy() if profile.get('retry') == 'never' else RetryPolicy(),
+        consistency_level=ConsistencyLevel.name_to_value[profile.get('consistency', 'LOCAL_ONE')],
+        request_timeout=float(profile.get('request_timeout', 10)),
+        speculative_execution_policy=speculative,
+    )
+
+def create_cluster(settings=None, **overrides):
+    # overrides replace top level settings, e.g. contact_points
+    settings = dict(settings or load_settings(), **overrides)
+    profiles = {name: execution_profile(settings, profile) for name, profile in settings['profiles'].items()}
+    profiles[EXEC_PROFILE_DEFAULT] = profiles.pop('default')
+
+    options = {}
+    if settings['protocol_version']:
+        options['protocol_version'] = settings['protocol_version']
+    cluster = Cluster(settings['contact_points'], port=settings['port'], compression=settings['compression'],
+                      connect_timeout=settings['connect_timeout'], execution_profiles=profiles, **options)
+
+    if settings['connections_per_host']:
+        if cluster.protocol_version >= 3:
+            log.warning("connections_per_host is ignored by protocol version 3 and later")
+        else:
+            cluster.set_core_connections_per_host(HostDistance.LOCAL, settings['connections_per_host'])
+            cluster.set_max_connections_per_host(HostDistance.LOCAL, settings['connections_per_host'])
+    return cluster
+
+def connect(keyspace=None, settings=None):
+    cluster = create_cluster(settings)
+    return cluster, cluster.connect(keyspace)
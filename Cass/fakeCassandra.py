@@ -0,0 +1,1193 @@
+import calendar
+import hashlib
+import heapq
+import itertools
+import logging
+import operator
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from cassandra import AlreadyExists, InvalidRequest, OperationTimedOut
+from cassandra import cqltypes
+from cassandra.cluster import EXEC_PROFILE_DEFAULT, NoHostAvailable, QueryExhausted, ResultSet, _NOT_SET
+from cassandra.metadata import Murmur3Token
+from cassandra.protocol import ColumnMetadata
+from cassandra.query import (BatchStatement, BoundStatement, FETCH_SIZE_UNSET, PreparedStatement,
+                             UNSET_VALUE, named_tuple_factory)
+
+log = logging.getLogger()
+
+'''
+========================================================
+==              In-memory Cassandra stand-in          ==
+========================================================
+
+FakeCluster and FakeSession answer the driver calls the model makes
+(execute, execute_async, prepare, set_keyspace, request listeners,
+execute_concurrent and paging) from tables held in memory, so the model
+can be exercised and benchmarked without a cluster:
+
+    cluster, session = fakeCassandra.connect(latency=0.002)
+    model.ensure_schema(session, 'healthcare', 1)
+
+Statements are parsed from their CQL and checked against the schema the
+way a node would check them: CREATE KEYSPACE / TABLE, ALTER TABLE, USE,
+SELECT [DISTINCT] with =, <, <=, >, >= on key columns, minTimeuuid and
+maxTimeuuid, token() ranges, LIMIT and ALLOW FILTERING, INSERT, UPDATE
+and DELETE (rows, ranges and partitions) with USING TIMESTAMP, and
+batches. Values go through the driver's own serializers, so rows come
+back with the types a node returns (Date, millisecond datetimes).
+
+Every request waits latency seconds, or latency(query) seconds when it is
+a callable, on a single dispatcher thread that then runs it, so requests
+in flight overlap like they would on a cluster. session.requests counts
+round trips and session.counts the statements run per (kind, table).
+
+Not modelled: TTLs (default_time_to_live is accepted and ignored),
+collections, secondary indexes, IN, aggregates, lightweight transactions
+and replication, every write is visible to the next read. Tables live
+in one process, so loads and benchmarks must run with a single process.
+'''
+
+FAKE_LATENCY_MS = float(os.getenv('CASSANDRA_FAKE_LATENCY_MS', '0'))
+FAKE_HOST = 'fake-cassandra'
+PROTOCOL_VERSION = 4
+DEFAULT_FETCH_SIZE = 5000
+
+# 100ns intervals between the UUID epoch (1582) and the unix epoch
+UUID_EPOCH_TICKS = 0x01b21dd213814000
+
+CQL_TYPES = {
+    'text': cqltypes.UTF8Type,
+    'varchar': cqltypes.VarcharType,
+    'ascii': cqltypes.AsciiType,
+    'timeuuid': cqltypes.TimeUUIDType,
+    'uuid': cqltypes.UUIDType,
+    'date': cqltypes.SimpleDateType,
+    'timestamp': cqltypes.DateType,
+    'double': cqltypes.DoubleType,
+    'float': cqltypes.FloatType,
+    'int': cqltypes.Int32Type,
+    'bigint': cqltypes.LongType,
+    'smallint': cqltypes.ShortType,
+    'boolean': cqltypes.BooleanType,
+    'blob': cqltypes.BytesType,
+}
+
+OPERATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+ALLOW_FILTERING_MESSAGE = ("Cannot execute this query as it might involve data filtering and thus may have "
+                           "unpredictable performance. If you want to execute this query despite the "
+                           "performance unpredictability, use ALLOW FILTERING")
+
+USE_RE = re.compile(r'^USE\s+"?(?P<keyspace>\w+)"?$', re.I)
+CREATE_KEYSPACE_RE = re.compile(r'^CREATE\s+KEYSPACE\s+(?P<exists>IF\s+NOT\s+EXISTS\s+)?(?P<keyspace>\w+)'
+                                r'\s+WITH\s+(?P<options>.+)$', re.I)
+CREATE_TABLE_RE = re.compile(r'^CREATE\s+TABLE\s+(?P<exists>IF\s+NOT\s+EXISTS\s+)?(?P<table>[\w.]+)\s*(?P<rest>\(.*)$',
+                             re.I)
+ALTER_TABLE_RE = re.compile(r'^ALTER\s+TABLE\s+(?P<table>[\w.]+)\s+(?:WITH\s+(?P<options>.+)|ADD\s+(?P<column>\w+)\s+(?P<type>\w+))$',
+                            re.I)
+SELECT_RE = re.compile(r'^SELECT\s+(?P<distinct>DISTINCT\s+)?(?P<columns>.+?)\s+FROM\s+(?P<table>[\w.]+)'
+                       r'(?:\s+WHERE\s+(?P<where>.+?))?(?:\s+LIMIT\s+(?P<limit>\?|\d+))?'
+                       r'(?P<filtering>\s+ALLOW\s+FILTERING)?$', re.I)
+INSERT_RE = re.compile(r'^INSERT\s+INTO\s+(?P<table>[\w.]+)\s*\((?P<columns>[^)]*)\)\s*VALUES\s*\((?P<values>.*)\)'
+                       r'(?:\s+USING\s+TIMESTAMP\s+(?P<timestamp>\?|\d+))?$', re.I)
+UPDATE_RE = re.compile(r'^UPDATE\s+(?P<table>[\w.]+)(?:\s+USING\s+TIMESTAMP\s+(?P<timestamp>\?|\d+))?'
+                       r'\s+SET\s+(?P<assignments>.+?)\s+WHERE\s+(?P<where>.+)$', re.I)
+DELETE_RE = re.compile(r'^DELETE\s+FROM\s+(?P<table>[\w.]+)(?:\s+USING\s+TIMESTAMP\s+(?P<timestamp>\?|\d+))?'
+                       r'\s+WHERE\s+(?P<where>.+)$', re.I)
+CONDITION_RE = re.compile(r'^(?:token\s*\((?P<token>[^)]*)\)|(?P<column>\w+))\s*(?P<op><=|>=|=|<|>)\s*(?P<value>.+)$',
+                          re.I)
+FUNCTION_RE = re.compile(r'^(?P<function>minTimeuuid|maxTimeuuid)\s*\(\s*(?P<arg>.+?)\s*\)$', re.I)
+CLUSTERING_ORDER_RE = re.compile(r'CLUSTERING\s+ORDER\s+BY\s*\((?P<order>[^)]*)\)', re.I)
+
+def _normalize(query):
+    return ' '.join(query.split()).rstrip(';').strip()
+
+def _split_top_level(text, separator=','):
+    # Splits on separator outside of parentheses and quotes
+    parts, depth, quoted, current = [], 0, False, []
+    for char in text:
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        if char == separator and depth == 0 and not quoted:
+            parts.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    parts.append(''.join(current).strip())
+    return [part for part in parts if part]
+
+def _matching_paren(text, start):
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    raise InvalidRequest(f"Unbalanced parentheses in {text}")
+
+def _sort_value(cql_type, value):
+    # A value comparable the way the column's type orders it
+    if cql_type is cqltypes.TimeUUIDType:
+        return (value.time, value.bytes)
+    if cql_type is cqltypes.SimpleDateType:
+        return value.days_from_epoch
+    return value
+
+def _timeuuid_bound(timestamp, upper):
+    # The smallest or largest TimeUUID of a millisecond, see _sort_value
+    millis = calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+    ticks = millis * 10000 + UUID_EPOCH_TICKS
+    return (ticks + 9999, b'\xff' * 17) if upper else (ticks, b'')
+
+def _literal(text, cql_type):
+    if text.lower() == 'null':
+        return None
+    if text.startswith("'") and text.endswith("'"):
+        value = text[1:-1].replace("''", "'")
+    elif text.lower() in ('true', 'false'):
+        value = text.lower() == 'true'
+    else:
+        for parse in (int, float, uuid.UUID):
+            try:
+                value = parse(text)
+                break
+            except ValueError:
+                continue
+        else:
+            raise InvalidRequest(f"Unsupported literal {text}")
+    try:
+        return cql_type.from_binary(cql_type.serialize(value, PROTOCOL_VERSION), PROTOCOL_VERSION)
+    except Exception:
+        raise InvalidRequest(f"Invalid literal {text} for type {cql_type.typename}")
+
+def _deserialize(values, types):
+    return [value if value is UNSET_VALUE else cql_type.from_binary(value, PROTOCOL_VERSION)
+            for value, cql_type in zip(values, types)]
+
+class _Desc(object):
+    # Reverses the order of a clustering value of a DESC column
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+'''
+========================================================
+==                     Storage                        ==
+========================================================
+'''
+
+class Row(object):
+
+    def __init__(self, key_values):
+        self.key_values = key_values
+        # column -> (write timestamp, value), None marks a deleted cell and
+        # '' is the row marker INSERT writes
+        self.cells = {}
+        self.deleted = None
+
+    def live(self):
+        return any(value is not None for timestamp, value in self.cells.values())
+
+    def values(self):
+        values = dict(self.key_values)
+        for column, (timestamp, value) in self.cells.items():
+            if column:
+                values[column] = value
+        return values
+
+    def write(self, cells, timestamp):
+        for column, value in cells.items():
+            current = self.cells.get(column)
+            if current is None or timestamp >= current[0]:
+                self.cells[column] = (timestamp, value)
+
+    def delete(self, timestamp):
+        self.deleted = timestamp if self.deleted is None else max(self.deleted, timestamp)
+        self.cells = {column: cell for column, cell in self.cells.items() if cell[0] > timestamp}
+
+class Partition(object):
+
+    def __init__(self, key_values, token):
+        self.key_values = key_values
+        self.token = token
+        self.rows = {}
+        # Clustering keys in clustering order
+        self.order = []
+        self.deleted = None
+        # (clustering conditions, timestamp) of range deletes
+        self.range_tombstones = []
+
+    def live(self):
+        return any(self.rows[key].live() for key in self.order)
+
+class Table(object):
+
+    def __init__(self, keyspace, name, columns, partition_key, clustering_key, descending, options):
+        self.keyspace = keyspace
+        self.name = name
+        # name -> driver type, in definition order
+        self.columns = columns
+        self.partition_key = partition_key
+        self.clustering_key = clustering_key
+        self.descending = descending
+        self.options = options
+        self.partitions = {}
+
+    @property
+    def primary_key(self):
+        return self.partition_key + self.clustering_key
+
+    def column_type(self, column):
+        if column not in self.columns:
+            raise InvalidRequest(f"Undefined column name {column} in table {self.keyspace}.{self.name}")
+        return self.columns[column]
+
+    def star_columns(self):
+        # The order SELECT * returns, keys first and then the rest by name
+        return self.primary_key + sorted(column for column in self.columns if column not in self.primary_key)
+
+    def sort_value(self, column, value):
+        return _sort_value(self.columns[column], value)
+
+    def partition(self, key_values, create=False):
+        key = tuple(self.sort_value(column, key_values[column]) for column in self.partition_key)
+        partition = self.partitions.get(key)
+        if partition is None and create:
+            partition = self.partitions[key] = Partition(
+                {column: key_values[column] for column in self.partition_key}, self.token(key_values))
+        return partition
+
+    def token(self, key_values):
+        # Murmur3 of the routing key, serialized like the driver does
+        parts = [self.columns[column].serialize(key_values[column], PROTOCOL_VERSION) for column in self.partition_key]
+        if len(parts) == 1:
+            return Murmur3Token.hash_fn(parts[0])
+        return Murmur3Token.hash_fn(b''.join(struct.pack('>H', len(part)) + part + b'\x00' for part in parts))
+
+    def row(self, partition, key_values, create=False):
+        key = tuple(_Desc(self.sort_value(column, key_values[column])) if column in self.descending
+                    else self.sort_value(column, key_values[column]) for column in self.clustering_key)
+        row = partition.rows.get(key)
+        if row is None and create:
+            row = partition.rows[key] = Row({column: key_values[column] for column in self.clustering_key})
+            # bisect.insort with the clustering key of each row
+            low, high = 0, len(partition.order)
+            while low < high:
+                middle = (low + high) // 2
+                if partition.order[middle] < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            partition.order.insert(low, key)
+        return row
+
+    def shadowed(self, partition, row, timestamp):
+        # True when a delete at least as recent as timestamp covers the row
+        deletes = [partition.deleted, row.deleted]
+        deletes.extend(deleted for conditions, deleted in partition.range_tombstones
+                       if _matches(self, conditions, row.key_values))
+        return any(deleted is not None and timestamp <= deleted for deleted in deletes)
+
+    def write(self, key_values, cells, timestamp):
+        for column in self.primary_key:
+            if key_values.get(column) is None:
+                raise InvalidRequest(f"Invalid null value in condition for column {column}")
+        partition = self.partition(key_values, create=True)
+        row = self.row(partition, key_values, create=True)
+        if not self.shadowed(partition, row, timestamp):
+            row.write(cells, timestamp)
+
+    def delete(self, key_values, conditions, timestamp):
+        # key_values holds the partition key, and the clustering key too
+        # when the delete names a single row
+        partition = self.partition(key_values, create=True)
+        if not conditions:
+            partition.deleted = timestamp if partition.deleted is None else max(partition.deleted, timestamp)
+            for row in partition.rows.values():
+                row.delete(timestamp)
+        elif all(column in key_values for column in self.clustering_key):
+            self.row(partition, key_values, create=True).delete(timestamp)
+        else:
+            partition.range_tombstones.append((conditions, timestamp))
+            for row in partition.rows.values():
+                if _matches(self, conditions, row.key_values):
+                    row.delete(timestamp)
+
+def _matches(table, conditions, values):
+    # conditions are (column, operator, sort value of the bound)
+    for column, op, bound in conditions:
+        value = values.get(column)
+        if value is None or not op(table.sort_value(column, value), bound):
+            return False
+    return True
+
+'''
+========================================================
+==                   Statements                       ==
+========================================================
+'''
+
+class _Bound(object):
+    # A value in a statement: a bind marker or a literal, optionally
+    # wrapped in minTimeuuid or maxTimeuuid
+    __slots__ = ('index', 'literal', 'function')
+
+    def __init__(self, index=None, literal=None, function=None):
+        self.index = index
+        self.literal = literal
+        self.function = function
+
+    def value(self, values):
+        value = self.literal if self.index is None else values[self.index]
+        if value is UNSET_VALUE:
+            raise InvalidRequest("Unset values are not allowed here")
+        return value
+
+    def sort_value(self, values, cql_type):
+        value = self.value(values)
+        if value is None:
+            raise InvalidRequest("Invalid null value in condition")
+        if self.function:
+            return _timeuuid_bound(value, self.function == 'maxtimeuuid')
+        return _sort_value(cql_type, value)
+
+class Statement(object):
+    """
+    A parsed statement bound to the schema it was parsed against. markers
+    are (name, driver type) per bind marker in the order of the CQL.
+    """
+
+    def __init__(self, kind, keyspace, table=None):
+        self.kind = kind
+        self.keyspace = keyspace
+        self.table = table
+        self.markers = []
+        self.columns = []
+        self.assignments = []
+        self.conditions = []
+        self.timestamp = None
+        self.limit = None
+        self.distinct = False
+        self.allow_filtering = False
+        self.options = None
+
+    @property
+    def label(self):
+        return (self.kind, self.table.name if self.table else None)
+
+    @property
+    def marker_types(self):
+        return [cql_type for name, cql_type in self.markers]
+
+    def marker(self, name, cql_type):
+        self.markers.append((name, cql_type))
+        return len(self.markers) - 1
+
+    def bound(self, text, column, cql_type):
+        text = text.strip()
+        match = FUNCTION_RE.match(text)
+        if match:
+            if cql_type is not cqltypes.TimeUUIDType:
+                raise InvalidRequest(f"{match.group('function')} only applies to timeuuid column {column}")
+            function = match.group('function').lower()
+            if match.group('arg') == '?':
+                return _Bound(index=self.marker(f"{function}({column})", cqltypes.DateType), function=function)
+            return _Bound(literal=_literal(match.group('arg'), cqltypes.DateType), function=function)
+        if text == '?':
+            return _Bound(index=self.marker(column, cql_type))
+        return _Bound(literal=_literal(text, cql_type))
+
+    def routing_key_indexes(self):
+        # Markers of the partition key columns when all of them are bound
+        indexes = {}
+        for column, op, bound in self.conditions:
+            if op == '=' and bound.index is not None:
+                indexes[column] = bound.index
+        for column, bound in self.assignments:
+            if bound.index is not None:
+                indexes.setdefault(column, bound.index)
+        if self.table and all(column in indexes for column in self.table.partition_key):
+            return [indexes[column] for column in self.table.partition_key]
+        return None
+
+class Store(object):
+    """
+    Keyspaces, tables and parsed statements of a FakeCluster. Statements
+    are parsed once per keyspace and CQL string.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.keyspaces = {}
+        self.prepared = {}
+        self._statements = {}
+        self._last_timestamp = 0
+
+    def timestamp(self):
+        # Microseconds since the epoch, never the same twice
+        with self.lock:
+            self._last_timestamp = max(int(time.time() * 1000000), self._last_timestamp + 1)
+            return self._last_timestamp
+
+    def table(self, keyspace, name):
+        if '.' in name:
+            keyspace, name = name.split('.', 1)
+        if keyspace is None:
+            raise InvalidRequest("No keyspace has been specified. USE a keyspace, or explicitly specify keyspace.tablename")
+        if keyspace.lower() not in self.keyspaces:
+            raise InvalidRequest(f"Keyspace {keyspace} does not exist")
+        table = self.keyspaces[keyspace.lower()]['tables'].get(name.lower())
+        if table is None:
+            raise InvalidRequest(f"unconfigured table {name}")
+        return table
+
+    def parse(self, keyspace, query):
+        text = _normalize(query)
+        key = (keyspace, text)
+        with self.lock:
+            statement = self._statements.get(key)
+            if statement is None:
+                statement = self._parse(keyspace, text)
+                if statement.kind not in ('CREATE', 'ALTER', 'USE'):
+                    self._statements[key] = statement
+            return statement
+
+    def _parse(self, keyspace, text):
+        for pattern, parse in ((SELECT_RE, self._parse_select), (INSERT_RE, self._parse_insert),
+                               (UPDATE_RE, self._parse_update), (DELETE_RE, self._parse_delete),
+                               (USE_RE, self._parse_use), (CREATE_KEYSPACE_RE, self._parse_create_keyspace),
+                               (CREATE_TABLE_RE, self._parse_create_table), (ALTER_TABLE_RE, self._parse_alter)):
+            match = pattern.match(text)
+            if match:
+                return parse(keyspace, match)
+        raise InvalidRequest(f"Unsupported statement: {text[:100]}")
+
+    def _parse_use(self, keyspace, match):
+        statement = Statement('USE', match.group('keyspace').lower())
+        return statement
+
+    def _parse_create_keyspace(self, keyspace, match):
+        statement = Statement('CREATE', match.group('keyspace').lower())
+        statement.options = match.group('options')
+        statement.allow_filtering = bool(match.group('exists'))
+        return statement
+
+    def _parse_create_table(self, keyspace, match):
+        name = match.group('table').lower()
+        if '.' in name:
+            keyspace, name = name.split('.', 1)
+        rest = match.group('rest')
+        end = _matching_paren(rest, 0)
+        options = rest[end + 1:].strip()
+        if options and not options.upper().startswith('WITH'):
+            raise InvalidRequest(f"Unexpected {options} after the columns of {name}")
+
+        columns, partition_key, clustering_key = OrderedDict(), [], []
+        for item in _split_top_level(rest[1:end]):
+            words = item.split()
+            if words[0].upper() == 'PRIMARY':
+                spec = item[item.index('(') + 1:item.rindex(')')]
+                keys = _split_top_level(spec)
+                first = keys.pop(0)
+                partition_key = [column.strip().lower() for column in first.strip('()').split(',')]
+                clustering_key = [column.lower() for column in keys]
+                continue
+            cql_type = CQL_TYPES.get(words[1].lower())
+            if cql_type is None:
+                raise InvalidRequest(f"Unsupported type {words[1]} for column {words[0]}")
+            columns[words[0].lower()] = cql_type
+            if ' '.join(words[2:]).upper() == 'PRIMARY KEY':
+                partition_key = [words[0].lower()]
+        if not partition_key:
+            raise InvalidRequest(f"No PRIMARY KEY specified for table {name}")
+        for column in partition_key + clustering_key:
+            if column not in columns:
+                raise InvalidRequest(f"Unknown definition {column} referenced in PRIMARY KEY")
+
+        descending = set()
+        order = CLUSTERING_ORDER_RE.search(options)
+        if order:
+            for item in _split_top_level(order.group('order')):
+                column, direction = item.split()
+                if column.lower() not in clustering_key:
+                    raise InvalidRequest("Only clustering key columns can be defined in CLUSTERING ORDER directive")
+                if direction.upper() == 'DESC':
+                    descending.add(column.lower())
+
+        statement = Statement('CREATE', keyspace)
+        statement.table = Table(keyspace, name, columns, partition_key, clustering_key, descending, options)
+        statement.allow_filtering = bool(match.group('exists'))
+        return statement
+
+    def _parse_alter(self, keyspace, match):
+        statement = Statement('ALTER', keyspace, self.table(keyspace, match.group('table')))
+        statement.options = match.group('options')
+        statement.column = None
+        if match.group('column'):
+            statement.column = match.group('column').lower()
+            if statement.column in statement.table.columns:
+                raise InvalidRequest(f"Invalid column name {statement.column} because it conflicts with an existing column")
+            statement.cql_type = CQL_TYPES.get(match.group('type').lower())
+            if statement.cql_type is None:
+                raise InvalidRequest(f"Unsupported type {match.group('type')} for column {statement.column}")
+        return statement
+
+    def _parse_conditions(self, statement, where):
+        table = statement.table
+        for text in re.split(r'\s+AND\s+', where, flags=re.I):
+            match = CONDITION_RE.match(text.strip())
+            if not match:
+                raise InvalidRequest(f"Unsupported condition {text}")
+            op = match.group('op')
+            if match.group('token') is not None:
+                columns = [column.strip().lower() for column in match.group('token').split(',')]
+                if columns != table.partition_key:
+                    raise InvalidRequest("The token function must be applied to the partition key columns")
+                statement.conditions.append((None, op, statement.bound(match.group('value'), 'token', cqltypes.LongType)))
+                continue
+            column = match.group('column').lower()
+            cql_type = table.column_type(column)
+            statement.conditions.append((column, op, statement.bound(match.group('value'), column, cql_type)))
+
+    def _check_partition_restricted(self, statement):
+        restricted = {column for column, op, bound in statement.conditions if column in statement.table.partition_key}
+        for column, op, bound in statement.conditions:
+            if column in statement.table.partition_key and op != '=':
+                raise InvalidRequest("Only EQ and IN relation are supported on the partition key "
+                                     "(unless you use the token() function)")
+        missing = [column for column in statement.table.partition_key if column not in restricted]
+        if restricted and missing:
+            raise InvalidRequest(f"Partition key parts: {', '.join(missing)} must be restricted as other parts are")
+        return not missing
+
+    def _parse_select(self, keyspace, match):
+        statement = Statement('SELECT', keyspace, self.table(keyspace, match.group('table')))
+        table = statement.table
+        columns = match.group('columns').strip()
+        statement.columns = (table.star_columns() if columns == '*'
+                             else [column.strip().lower() for column in columns.split(',')])
+        for column in statement.columns:
+            table.column_type(column)
+        statement.distinct = bool(match.group('distinct'))
+        statement.allow_filtering = bool(match.group('filtering'))
+        if statement.distinct and any(column not in table.partition_key for column in statement.columns):
+            raise InvalidRequest("SELECT DISTINCT queries must only request partition key columns")
+        if match.group('where'):
+            self._parse_conditions(statement, match.group('where'))
+
+        full_key = self._check_partition_restricted(statement)
+        for column, op, bound in statement.conditions:
+            if column is None and full_key:
+                raise InvalidRequest("Restricting the partition key by both token and value is not supported")
+            if column in table.clustering_key and not full_key and not statement.allow_filtering:
+                raise InvalidRequest(ALLOW_FILTERING_MESSAGE)
+            if column is not None and column not in table.primary_key and not statement.allow_filtering:
+                raise InvalidRequest(ALLOW_FILTERING_MESSAGE)
+
+        limit = match.group('limit')
+        if limit:
+            statement.limit = _Bound(index=statement.marker('[limit]', cqltypes.Int32Type)) if limit == '?' \
+                else _Bound(literal=int(limit))
+        return statement
+
+    def _parse_timestamp(self, statement, match):
+        text = match.group('timestamp')
+        if text:
+            statement.timestamp = (_Bound(index=statement.marker('[timestamp]', cqltypes.LongType)) if text == '?'
+                                   else _Bound(literal=int(text)))
+
+    def _check_row_restricted(self, statement, clustering_ranges):
+        table = statement.table
+        self._check_partition_restricted(statement)
+        for column in table.partition_key:
+            if not any(restricted == column for restricted, op, bound in statement.conditions):
+                raise InvalidRequest(f"Some partition key parts are missing: {column}")
+        for column, op, bound in statement.conditions:
+            if column is None or column not in table.primary_key:
+                raise InvalidRequest(f"Non PRIMARY KEY columns found in where clause: {column or 'token'}")
+            if column in table.clustering_key and op != '=' and not clustering_ranges:
+                raise InvalidRequest("Slice restrictions are not supported on the clustering columns in UPDATE statements")
+        if not clustering_ranges:
+            restricted = {column for column, op, bound in statement.conditions}
+            missing = [column for column in table.clustering_key if column not in restricted]
+            if missing:
+                raise InvalidRequest(f"Some clustering keys are missing: {', '.join(missing)}")
+
+    def _parse_insert(self, keyspace, match):
+        statement = Statement('INSERT', keyspace, self.table(keyspace, match.group('table')))
+        table = statement.table
+        columns = [column.strip().lower() for column in match.group('columns').split(',')]
+        values = _split_top_level(match.group('values'))
+        if len(columns) != len(values):
+            raise InvalidRequest("Unmatched column names/values")
+        for column, value in zip(columns, values):
+            statement.assignments.append((column, statement.bound(value, column, table.column_type(column))))
+        missing = [column for column in table.primary_key if column not in columns]
+        if missing:
+            raise InvalidRequest(f"Some primary key parts are missing: {', '.join(missing)}")
+        self._parse_timestamp(statement, match)
+        return statement
+
+    def _parse_update(self, keyspace, match):
+        statement = Statement('UPDATE', keyspace, self.table(keyspace, match.group('table')))
+        table = statement.table
+        self._parse_timestamp(statement, match)
+        for assignment in _split_top_level(match.group('assignments')):
+            column, value = assignment.split('=', 1)
+            column = column.strip().lower()
+            if column in table.primary_key:
+                raise InvalidRequest(f"PRIMARY KEY part {column} found in SET part")
+            statement.assignments.append((column, statement.bound(value, column, table.column_type(column))))
+        self._parse_conditions(statement, match.group('where'))
+        self._check_row_restricted(statement, clustering_ranges=False)
+        return statement
+
+    def _parse_delete(self, keyspace, match):
+        statement = Statement('DELETE', keyspace, self.table(keyspace, match.group('table')))
+        self._parse_timestamp(statement, match)
+        self._parse_conditions(statement, match.group('where'))
+        self._check_row_restricted(statement, clustering_ranges=True)
+        return statement
+
+    '''=== Execution ==='''
+
+    def execute(self, statement, values, timestamp=None):
+        # Returns (column names, column types, rows) for a SELECT and None
+        # otherwise, rows being lists of values
+        with self.lock:
+            if statement.kind == 'SELECT':
+                return self._select(statement, values)
+            if statement.kind in ('INSERT', 'UPDATE', 'DELETE'):
+                if statement.timestamp is not None:
+                    timestamp = statement.timestamp.value(values)
+                self._write(statement, values, timestamp or self.timestamp())
+            elif statement.kind == 'CREATE':
+                self._create(statement)
+            elif statement.kind == 'ALTER' and statement.column:
+                statement.table.columns[statement.column] = statement.cql_type
+            elif statement.kind == 'ALTER':
+                statement.table.options = statement.options
+            elif statement.kind == 'USE' and statement.keyspace not in self.keyspaces:
+                raise InvalidRequest(f"Keyspace '{statement.keyspace}' does not exist")
+            return None
+
+    def _create(self, statement):
+        if statement.table is None:
+            if statement.keyspace in self.keyspaces:
+                if not statement.allow_filtering:
+                    raise AlreadyExists(keyspace=statement.keyspace)
+                return
+            self.keyspaces[statement.keyspace] = {'options': statement.options, 'tables': {}}
+            return
+
+        table = statement.table
+        if table.keyspace is None:
+            raise InvalidRequest("No keyspace has been specified. USE a keyspace, or explicitly specify keyspace.tablename")
+        if table.keyspace not in self.keyspaces:
+            raise InvalidRequest(f"Keyspace {table.keyspace} does not exist")
+        tables = self.keyspaces[table.keyspace]['tables']
+        if table.name in tables:
+            if not statement.allow_filtering:
+                raise AlreadyExists(keyspace=table.keyspace, table=table.name)
+            return
+        tables[table.name] = table
+
+    def _resolve_conditions(self, statement, values):
+        table = statement.table
+        key_values, conditions, token_conditions = {}, [], []
+        for column, op, bound in statement.conditions:
+            if column is None:
+                token_conditions.append((None, OPERATORS[op], bound.sort_value(values, cqltypes.LongType)))
+            elif column in table.partition_key:
+                key_values[column] = bound.value(values)
+            else:
+                conditions.append((column, OPERATORS[op], bound.sort_value(values, table.columns[column])))
+        return key_values, conditions, token_conditions
+
+    def _select(self, statement, values):
+        table = statement.table
+        key_values, conditions, token_conditions = self._resolve_conditions(statement, values)
+        limit = statement.limit.value(values) if statement.limit else None
+
+        if key_values:
+            partition = table.partition(key_values)
+            partitions = [partition] if partition else []
+        else:
+            partitions = sorted(table.partitions.values(), key=lambda partition: partition.token)
+            partitions = [partition for partition in partitions
+                          if all(op(partition.token, bound) for column, op, bound in token_conditions)]
+
+        rows = []
+        for partition in partitions:
+            if limit is not None and len(rows) >= limit:
+                break
+            if statement.distinct:
+                if partition.live():
+                    rows.append([partition.key_values[column] for column in statement.columns])
+                continue
+            for key in partition.order:
+                row = partition.rows[key]
+                if not row.live():
+                    continue
+                row_values = row.values()
+                if not _matches(table, conditions, row_values):
+                    continue
+                row_values.update(partition.key_values)
+                rows.append([row_values.get(column) for column in statement.columns])
+                if limit is not None and len(rows) >= limit:
+                    break
+        return statement.columns, [table.columns[column] for column in statement.columns], rows
+
+    def _write(self, statement, values, timestamp):
+        table = statement.table
+        if statement.kind == 'INSERT':
+            row_values = {}
+            for column, bound in statement.assignments:
+                value = values[bound.index] if bound.index is not None else bound.literal
+                if value is not UNSET_VALUE:
+                    row_values[column] = value
+            cells = {column: value for column, value in row_values.items() if column not in table.primary_key}
+            cells[''] = True
+            table.write(row_values, cells, timestamp)
+            return
+
+        key_values, conditions, token_conditions = self._resolve_conditions(statement, values)
+        for column, op, bound in statement.conditions:
+            if column in table.clustering_key and op == '=' and not bound.function:
+                key_values[column] = bound.value(values)
+        if statement.kind == 'UPDATE':
+            cells = {}
+            for column, bound in statement.assignments:
+                value = values[bound.index] if bound.index is not None else bound.literal
+                if value is not UNSET_VALUE:
+                    cells[column] = value
+            table.write(key_values, cells, timestamp)
+        else:
+            table.delete(key_values, conditions, timestamp)
+
+    def metadata(self):
+        # The parts of cluster.metadata the model reads
+        keyspaces = {}
+        with self.lock:
+            for name, keyspace in self.keyspaces.items():
+                tables = {}
+                for table in keyspace['tables'].values():
+                    columns = OrderedDict((column, SimpleNamespace(name=column, cql_type=cql_type.typename))
+                                          for column, cql_type in table.columns.items())
+                    tables[table.name] = SimpleNamespace(
+                        name=table.name, columns=columns, options=table.options,
+                        partition_key=[columns[column] for column in table.partition_key],
+                        clustering_key=[columns[column] for column in table.clustering_key])
+                keyspaces[name] = SimpleNamespace(name=name, tables=tables)
+        return SimpleNamespace(keyspaces=keyspaces)
+
+'''
+========================================================
+==                 Driver stand-ins                   ==
+========================================================
+'''
+
+def _encode_paging_state(offset):
+    return struct.pack('>Q', offset)
+
+def _decode_paging_state(paging_state):
+    return struct.unpack('>Q', paging_state)[0] if paging_state else 0
+
+class _Dispatcher(object):
+    """
+    Runs requests one at a time on its own thread, each once its latency
+    has passed, like the driver's event loop delivering responses.
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="fake-cassandra", daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay, fn, *args):
+        with self._condition:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._sequence), fn, args))
+            self._condition.notify()
+
+    def on_thread(self):
+        return threading.current_thread() is self._thread
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _next(self, done=None):
+        # Waits for the earliest task to be due and pops it, None once
+        # stopped or once done is set
+        with self._condition:
+            while not self._stopped and not (done and done.is_set()):
+                if self._queue:
+                    wait = self._queue[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self._queue)
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+            return None
+
+    def _execute(self, task):
+        ready, sequence, fn, args = task
+        try:
+            fn(*args)
+        except Exception:
+            log.exception("Fake Cassandra dispatcher task failed")
+
+    def run_until(self, done):
+        # A callback blocking on a request would never see it answered, so
+        # the dispatcher thread runs the queue itself until done is set
+        while not done.is_set():
+            task = self._next(done)
+            if task is None:
+                return
+            self._execute(task)
+
+    def _run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            self._execute(task)
+
+class FakeResponseFuture(object):
+    """
+    The parts of the driver's ResponseFuture the model, execute_concurrent
+    and ResultSet use. Callbacks run on the dispatcher thread.
+    """
+
+    def __init__(self, session, query, parameters, paging_state=None):
+        self.session = session
+        self.query = query
+        self.attempted_hosts = []
+        self.coordinator_host = None
+        self.has_more_pages = False
+        self._parameters = parameters
+        self._request_paging_state = paging_state
+        self._paging_state = None
+        self._col_names = None
+        self._col_types = None
+        self._continuous_paging_session = None
+        self._start_time = time.time()
+        self._callbacks = []
+        self._errbacks = []
+        self._final_result = _NOT_SET
+        self._final_exception = None
+        self._cancelled = False
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    def send_request(self):
+        self.session._send(self)
+
+    def _deliver(self):
+        self.attempted_hosts.append(FAKE_HOST)
+        self.coordinator_host = FAKE_HOST
+        try:
+            result, paging_state = self.session._run(self.query, self._parameters, self._request_paging_state)
+        except Exception as exc:
+            with self._lock:
+                self._final_exception = exc
+                self._event.set()
+                errbacks = [] if self._cancelled else list(self._errbacks)
+            for fn, args, kwargs in errbacks:
+                fn(exc, *args, **kwargs)
+            return
+
+        with self._lock:
+            if result is not None:
+                self._col_names, self._col_types, rows = result
+                result = self.session.row_factory(self._col_names, rows)
+            self._paging_state = paging_state
+            self.has_more_pages = bool(paging_state)
+            self._final_result = result
+            self._event.set()
+            callbacks = [] if self._cancelled else list(self._callbacks)
+        for fn, args, kwargs in callbacks:
+            fn(result, *args, **kwargs)
+
+    def add_callback(self, fn, *args, **kwargs):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append((fn, args, kwargs))
+                return self
+            run = self._final_exception is None
+        if run:
+            fn(self._final_result, *args, **kwargs)
+        return self
+
+    def add_errback(self, fn, *args, **kwargs):
+        with self._lock:
+            if not self._event.is_set():
+                self._errbacks.append((fn, args, kwargs))
+                return self
+            run = self._final_exception is not None
+        if run:
+            fn(self._final_exception, *args, **kwargs)
+        return self
+
+    def add_callbacks(self, callback, errback, callback_args=(), callback_kwargs=None,
+                      errback_args=(), errback_kwargs=None):
+        self.add_callback(callback, *callback_args, **(callback_kwargs or {}))
+        self.add_errback(errback, *errback_args, **(errback_kwargs or {}))
+
+    def clear_callbacks(self):
+        with self._lock:
+            self._callbacks = []
+            self._errbacks = []
+
+    def result(self, timeout=_NOT_SET):
+        if timeout is _NOT_SET:
+            timeout = None
+        dispatcher = self.session.cluster.dispatcher
+        if dispatcher.on_thread():
+            dispatcher.run_until(self._event)
+        if not self._event.wait(timeout):
+            raise OperationTimedOut(errors={FAKE_HOST: "Client request timeout"}, last_host=FAKE_HOST)
+        if self._final_exception is not None:
+            raise self._final_exception
+        return ResultSet(self, self._final_result)
+
+    def start_fetching_next_page(self):
+        if not self.has_more_pages:
+            raise QueryExhausted()
+        with self._lock:
+            self._request_paging_state = self._paging_state
+            self._final_result = _NOT_SET
+            self._event.clear()
+        self.send_request()
+
+    def cancel(self):
+        self._cancelled = True
+
+class FakeSession(object):
+    """
+    A session of a FakeCluster. Requests go through the cluster's
+    dispatcher, counted in requests (round trips) and counts (statements
+    per (kind, table), a batch counting each of its statements).
+    """
+
+    def __init__(self, cluster, keyspace=None):
+        self.cluster = cluster
+        self.keyspace = None
+        self.is_shutdown = False
+        self.row_factory = named_tuple_factory
+        self.default_fetch_size = DEFAULT_FETCH_SIZE
+        self.default_timeout = 10.0
+        self.requests = 0
+        self.counts = Counter()
+        self._listeners = []
+        self._counts_lock = threading.Lock()
+        if keyspace:
+            self.set_keyspace(keyspace)
+
+    def set_keyspace(self, keyspace):
+        self.execute(f"USE {keyspace}")
+
+    def prepare(self, query, custom_payload=None, keyspace=None):
+        store = self.cluster.store
+        statement = store.parse(keyspace or self.keyspace, query)
+        keyspace = statement.table.keyspace if statement.table else statement.keyspace
+        table = statement.table.name if statement.table else None
+        query_id = hashlib.md5(f"{keyspace}:{_normalize(query)}".encode()).digest()
+        prepared = PreparedStatement(
+            column_metadata=[ColumnMetadata(keyspace, table, name, cql_type) for name, cql_type in statement.markers],
+            query_id=query_id, routing_key_indexes=statement.routing_key_indexes(), query=query,
+            keyspace=keyspace, protocol_version=PROTOCOL_VERSION,
+            result_metadata=[ColumnMetadata(keyspace, table, column, statement.table.columns[column])
+                             for column in statement.columns],
+            result_metadata_id=None)
+        with store.lock:
+            store.prepared[query_id] = statement
+        return prepared
+
+    def add_request_init_listener(self, fn, *args, **kwargs):
+        self._listeners.append((fn, args, kwargs))
+
+    def remove_request_init_listener(self, fn, *args, **kwargs):
+        self._listeners.remove((fn, args, kwargs))
+
+    def execute_async(self, query, parameters=None, trace=False, custom_payload=None, timeout=_NOT_SET,
+                      execution_profile=EXEC_PROFILE_DEFAULT, paging_state=None, host=None, execute_as=None):
+        future = FakeResponseFuture(self, query, parameters, paging_state)
+        for fn, args, kwargs in self._listeners:
+            fn(future, *args, **kwargs)
+        future.send_request()
+        return future
+
+    def execute(self, query, parameters=None, timeout=_NOT_SET, trace=False, custom_payload=None,
+                execution_profile=EXEC_PROFILE_DEFAULT, paging_state=None, host=None, execute_as=None):
+        return self.execute_async(query, parameters, trace, custom_payload, timeout, execution_profile,
+                                  paging_state, host, execute_as).result(timeout)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as exc:
+                future.set_exception(exc)
+
+        self.cluster.dispatcher.schedule(0, run)
+        return future
+
+    def reset_counts(self):
+        with self._counts_lock:
+            self.requests = 0
+            self.counts.clear()
+
+    def shutdown(self):
+        self.is_shutdown = True
+
+    def _send(self, future):
+        if self.is_shutdown:
+            # Fails at once, like the driver once its pools are closed
+            future._deliver()
+            return
+        self.cluster.dispatcher.schedule(self.cluster.latency_of(future.query), future._deliver)
+
+    def _statement(self, query, parameters):
+        # (statement, deserialized values) of a bound or plain statement
+        store = self.cluster.store
+        if isinstance(query, BoundStatement):
+            return self._prepared(query.prepared_statement.query_id, query.values)
+
+        query_string = query if isinstance(query, str) else query.query_string
+        # Plain statements take %s placeholders, passed through the same
+        # serializers as bound values
+        statement = store.parse(getattr(query, 'keyspace', None) or self.keyspace, query_string.replace('%s', '?'))
+        parameters = list(parameters or [])
+        if len(parameters) != len(statement.markers):
+            raise InvalidRequest(f"Expected {len(statement.markers)} parameters, got {len(parameters)}")
+        return statement, _deserialize([cql_type.serialize(value, PROTOCOL_VERSION) if value is not None else None
+                                        for value, cql_type in zip(parameters, statement.marker_types)],
+                                       statement.marker_types)
+
+    def _prepared(self, query_id, values):
+        statement = self.cluster.store.prepared.get(query_id)
+        if statement is None:
+            raise InvalidRequest("Prepared statement not found, prepare it on this cluster first")
+        return statement, _deserialize(values, statement.marker_types)
+
+    def _run(self, query, parameters, paging_state):
+        # Runs on the dispatcher, returns (result, next paging state)
+        if self.is_shutdown:
+            raise NoHostAvailable("Pool is shutdown", {})
+        store = self.cluster.store
+        if isinstance(query, BatchStatement):
+            writes = []
+            for is_prepared, statement, values in query._statements_and_parameters:
+                if is_prepared:
+                    writes.append(self._prepared(statement, values))
+                else:
+                    writes.append(self._statement(statement, None))
+            for statement, values in writes:
+                if statement.kind not in ('INSERT', 'UPDATE', 'DELETE'):
+                    raise InvalidRequest("Invalid statement in batch: only UPDATE, INSERT and DELETE statements are allowed.")
+            with self._counts_lock:
+                self.requests += 1
+                self.counts.update(statement.label for statement, values in writes)
+            # Every statement of a batch is written with the same timestamp
+            timestamp = store.timestamp()
+            with store.lock:
+                for statement, values in writes:
+                    store.execute(statement, values, timestamp)
+            return None, None
+
+        statement, values = self._statement(query, parameters)
+        with self._counts_lock:
+            self.requests += 1
+            self.counts[statement.label] += 1
+        result = store.execute(statement, values)
+        if statement.kind == 'USE':
+            self.keyspace = statement.keyspace
+        if result is None:
+            return None, None
+
+        fetch_size = getattr(query, 'fetch_size', FETCH_SIZE_UNSET)
+        if fetch_size is FETCH_SIZE_UNSET or fetch_size is None:
+            fetch_size = self.default_fetch_size
+        names, types, rows = result
+        start = _decode_paging_state(paging_state)
+        if not fetch_size or start + fetch_size >= len(rows):
+            return (names, types, rows[start:]), None
+        return (names, types, rows[start:start + fetch_size]), _encode_paging_state(start + fetch_size)
+
+class FakeCluster(object):
+    """
+    Stands in for cassandra.cluster.Cluster. Sessions of one cluster share
+    its tables. latency is seconds per request, or a callable taking the
+    statement and returning them.
+    """
+
+    def __init__(self, latency=FAKE_LATENCY_MS / 1000):
+        self.latency = latency
+        self.contact_points = [FAKE_HOST]
+        self.port = 9042
+        self.protocol_version = PROTOCOL_VERSION
+        self.store = Store()
+        self.dispatcher = _Dispatcher()
+        self.sessions = []
+        self.is_shutdown = False
+
+    @property
+    def metadata(self):
+        return self.store.metadata()
+
+    def latency_of(self, query):
+        return self.latency(query) if callable(self.latency) else self.latency
+
+    def connect(self, keyspace=None):
+        session = FakeSession(self, keyspace)
+        self.sessions.append(session)
+        return session
+
+    def shutdown(self):
+        self.is_shutdown = True
+        for session in self.sessions:
+            session.shutdown()
+        self.dispatcher.stop()
+
+def connect(keyspace=None, latency=FAKE_LATENCY_MS / 1000):
+    # Same shape as clusterProfile.connect
+    cluster = FakeCluster(latency)
+    return cluster, cluster.connect(keyspace)
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from Cass import cassandraModel as model
+
+log = logging.getLogger()
+
+'''
+========================================================
+==              Vital sign ingest batching            ==
+========================================================
+
+Readings submitted by many devices are queued and written every
+INGEST_FLUSH_MS as micro-batches of at most INGEST_MAX_BATCH readings
+through load_vital_signs in batch mode, which groups them into one
+unlogged batch per partition and refreshes alerts and the latest
+snapshot. The hours a batch touches are only marked dirty: the session's
+RollupRefresher rebuilds each of them once per interval, so concurrent
+batches never rebuild the same hot hour at once. A submit resolves only
+once every one of its readings is written at the bulk profile's
+consistency, and fails if any write did.
+
+Micro-batches in flight are capped by a window that grows while their
+latency stays under INGEST_TARGET_MS and shrinks when it does not. Once
+INGEST_MAX_PENDING readings are queued behind it new submits are turned
+away with IngestBusy, so a slow cluster pushes back on the devices
+instead of growing the queue. Reading ids derive from their content, so
+devices can safely resend a batch that was turned away or failed.
+'''
+
+INGEST_FLUSH_MS = float(os.getenv('INGEST_FLUSH_MS', '5'))
+INGEST_MAX_BATCH = int(os.getenv('INGEST_MAX_BATCH', '500'))
+INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', '20000'))
+INGEST_TARGET_MS = float(os.getenv('INGEST_TARGET_MS', '50'))
+INGEST_MAX_IN_FLIGHT = int(os.getenv('INGEST_MAX_IN_FLIGHT', '16'))
+
+class IngestBusy(Exception):
+    """
+    Raised by submit when the queue is full, retry_after is a hint in
+    seconds.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Ingest queue is full, retry in {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+class InvalidReading(ValueError):
+    pass
+
+'''
+========================================================
+==                    Parsing                         ==
+========================================================
+'''
+
+# vital_sign,account_id=P0001,type=heart\ rate value=72.5 1697040000000000000
+LINE_SEPARATOR_RE = re.compile(r'(?<!\\) ')
+TAG_SEPARATOR_RE = re.compile(r'(?<!\\),')
+LINE_MEASUREMENT = 'vital_sign'
+
+def _unescape(value):
+    return re.sub(r'\\([ ,=])', r'\1', value)
+
+def vital_sign_row(account_id, vital_sign_type, value, timestamp=None):
+    # Row in the layout load_vital_signs takes, timestamp is a naive UTC
+    # datetime and defaults to now
+    if not account_id or not vital_sign_type:
+        raise InvalidReading("Readings need an account_id and a type")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise InvalidReading(f"Invalid value {value!r}")
+    if not math.isfinite(value):
+        raise InvalidReading(f"Invalid value {value!r}")
+    timestamp = timestamp or datetime.utcnow()
+    vital_sign_type = vital_sign_type.lower()
+    vital_sign_id = model.vital_sign_uuid(account_id, vital_sign_type, timestamp, value)
+    return (vital_sign_id, account_id, vital_sign_type, value, timestamp.date(), model.uuid_bucket(vital_sign_id))
+
+def _utc(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+def parse_line(line):
+    # InfluxDB line protocol with an optional timestamp in nanoseconds
+    parts = LINE_SEPARATOR_RE.split(line.strip())
+    if len(parts) not in (2, 3):
+        raise InvalidReading(f"Malformed line {line!r}")
+    measurement, *tags = TAG_SEPARATOR_RE.split(parts[0])
+    if measurement != LINE_MEASUREMENT:
+        raise InvalidReading(f"Unknown measurement {measurement!r}")
+    tags = dict(_unescape(tag).split('=', 1) for tag in tags if '=' in tag)
+    fields = dict(field.split('=', 1) for field in TAG_SEPARATOR_RE.split(parts[1]) if '=' in field)
+    try:
+        timestamp = _utc(int(parts[2]) / 1e9) if len(parts) == 3 else None
+    except ValueError:
+        raise InvalidReading(f"Invalid timestamp {parts[2]!r}")
+    return vital_sign_row(tags.get('account_id'), tags.get('type'), fields.get('value'), timestamp)
+
+def parse_lines(text):
+    return [parse_line(line) for line in text.splitlines() if line.strip() and not line.startswith('#')]
+
+def parse_reading(reading):
+    # {"account_id", "type", "value", "timestamp"}, the timestamp in ISO
+    # 8601 or epoch milliseconds
+    timestamp = reading.get('timestamp')
+    try:
+        if isinstance(timestamp, (int, float)):
+            timestamp = _utc(timestamp / 1000)
+        elif timestamp:
+            timestamp = datetime.fromisoformat(timestamp)
+            if timestamp.tzinfo:
+                timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    except (ValueError, OverflowError, OSError):
+        raise InvalidReading(f"Invalid timestamp {timestamp!r}")
+    return vital_sign_row(reading.get('account_id'), reading.get('type'), reading.get('value'), timestamp)
+
+'''
+========================================================
+==                    Batching                        ==
+========================================================
+'''
+
+class _Ticket(object):
+    # One submit, resolved once all of its readings are written
+
+    def __init__(self, future, readings):
+        self.future = future
+        self.remaining = readings
+
+class IngestStats(object):
+
+    def __init__(self):
+        self.readings = 0
+        self.batches = 0
+        self.errors = 0
+        self.rejected = 0
+        self.alerts = 0
+
+    def __str__(self):
+        return (f"ingest: {self.readings} readings in {self.batches} batches, "
+                f"{self.errors} failed batches, {self.rejected} rejected submits, {self.alerts} alerts")
+
+class IngestBatcher(object):
+    """
+    Coalesces submitted readings into micro-batches on the event loop and
+    writes them on a thread pool, at most window batches at a time.
+    """
+
+    def __init__(self, session, flush_ms=INGEST_FLUSH_MS, max_batch=INGEST_MAX_BATCH,
+                 max_pending=INGEST_MAX_PENDING, target_ms=INGEST_TARGET_MS, max_in_flight=INGEST_MAX_IN_FLIGHT):
+        self.session = session
+        self.flush_seconds = flush_ms / 1000
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.target_seconds = target_ms / 1000
+        self.max_in_flight = max_in_flight
+        # Batches allowed in flight, fractional so it can grow slowly
+        self.window = float(max_in_flight)
+        self.in_flight = 0
+        self.latency = 0.0
+        self.stats = IngestStats()
+        self._pending = []
+        self._pending_readings = 0
+        self._wake = None
+        self._slot = None
+        self._task = None
+        self._writes = set()
+        self._closing = False
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="ingest")
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        self._slot = asyncio.Condition()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Writes everything already accepted before returning
+        self._closing = True
+        self._wake.set()
+        await self._task
+        if self._writes:
+            await asyncio.gather(*self._writes)
+        refresher = model.get_rollup_refresher(self.session)
+        await asyncio.get_running_loop().run_in_executor(self._executor, refresher.flush)
+        self._executor.shutdown(wait=True)
+        log.info(str(self.stats))
+
+    @property
+    def pending(self):
+        return self._pending_readings
+
+    def retry_after(self):
+        # Time to drain the queue at the current window and latency
+        batches = self._pending_readings / self.max_batch
+        return max(self.flush_seconds, batches / max(self.window, 1) * max(self.latency, self.flush_seconds))
+
+    async def submit(self, rows):
+        # Resolves to the number of readings written
+        if self._closing:
+            raise IngestBusy(1.0)
+        if not rows:
+            return 0
+        if self._pending_readings + len(rows) > self.max_pending:
+            self.stats.rejected += 1
+            raise IngestBusy(self.retry_after())
+        ticket = _Ticket(asyncio.get_running_loop().create_future(), len(rows))
+        self._pending.append((rows, ticket))
+        self._pending_readings += len(rows)
+        self._wake.set()
+        await ticket.future
+        return len(rows)
+
+    def _take_batch(self):
+        # [(rows, ticket)] of up to max_batch readings, splitting the last
+        # submit if it does not fit
+        batch, size = [], 0
+        while self._pending and size < self.max_batch:
+            rows, ticket = self._pending[0]
+            room = self.max_batch - size
+            if len(rows) > room:
+                self._pending[0] = (rows[room:], ticket)
+                rows = rows[:room]
+            else:
+                self._pending.pop(0)
+            batch.append((rows, ticket))
+            size += len(rows)
+        self._pending_readings -= size
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            if not self._pending:
+                if self._closing:
+                    break
+                continue
+            # Let readings arriving within the flush interval join the batch
+            await asyncio.sleep(self.flush_seconds)
+            while self._pending:
+                async with self._slot:
+                    await self._slot.wait_for(lambda: self.in_flight < max(1, int(self.window)))
+                    self.in_flight += 1
+                # The loop only keeps weak references to tasks
+                task = asyncio.create_task(self._write(self._take_batch()))
+                self._writes.add(task)
+                task.add_done_callback(self._writes.discard)
+            if self._closing:
+                self._wake.set()
+        async with self._slot:
+            await self._slot.wait_for(lambda: self.in_flight == 0)
+
+    async def _write(self, batch):
+        rows = [row for batch_rows, ticket in batch for row in batch_rows]
+        start = time.perf_counter()
+        error = None
+        try:
+            stats = await asyncio.get_running_loop().run_in_executor(
+                self._executor, lambda: model.load_vital_signs(self.session, rows, mode='batch', defer_rollups=True,
+                                                       rules=model.alert_rules))
+            if stats.errors:
+                error = IOError(f"{stats.errors} of {stats.writes} writes failed")
+            self.stats.alerts += stats.alerts
+        except Exception as exc:
+            error = exc
+        self._adjust(time.perf_counter() - start)
+
+        self.stats.batches += 1
+        if error is None:
+            self.stats.readings += len(rows)
+        else:
+            self.stats.errors += 1
+            log.error(f"Ingest batch of {len(rows)} readings failed: {error}")
+        for batch_rows, ticket in batch:
+            if ticket.future.done():
+                continue
+            if error is not None:
+                ticket.future.set_exception(error)
+                continue
+            ticket.remaining -= len(batch_rows)
+            if not ticket.remaining:
+                ticket.future.set_result(None)
+
+        async with self._slot:
+            self.in_flight -= 1
+            self._slot.notify_all()
+
+    def _adjust(self, seconds):
+        # Additive increase, multiplicative decrease on the batch latency
+        self.latency = seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+        if seconds > self.target_seconds:
+            self.window = max(1.0, self.window * 0.75)
+        else:
+            self.window = min(float(self.max_in_flight), self.window + 1 / self.window)
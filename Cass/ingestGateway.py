@@ -0,0 +1,129 @@
+import json
+import logging
+import math
+import os
+
+import falcon
+import falcon.asgi
+
+from Cass import cassandraModel as model
+from Cass import clusterProfile
+from Cass import ingestBatcher
+from Cass import queryStats
+
+log = logging.getLogger()
+
+'''
+========================================================
+==               Device ingest gateway                ==
+========================================================
+
+ASGI service the mobile app and bedside devices post readings to:
+
+    python -m uvicorn Cass.ingestGateway:app --port 9200
+
+POST /vital_signs takes either a JSON body,
+
+    {"readings": [{"account_id": "P0001", "type": "heart rate",
+                   "value": 72.5, "timestamp": "2024-05-01T10:00:00Z"}]}
+
+or, with any other content type, line protocol:
+
+    vital_sign,account_id=P0001,type=heart\\ rate value=72.5 1714557600000000000
+
+It answers 200 with {"written": n} once every reading is durable, 400 for
+malformed readings (none of the body is written) and 503 with a
+Retry-After header when the queue is full or a write failed. GET /health
+reports the queue and the current write window.
+'''
+
+KEYSPACE = os.getenv('CASSANDRA_KEYSPACE', 'healthcare')
+REPLICATION_FACTOR = os.getenv('CASSANDRA_REPLICATION_FACTOR', '1')
+MAX_BODY_BYTES = int(os.getenv('INGEST_MAX_BODY_BYTES', str(4 * 1024 * 1024)))
+
+class IngestGateway(object):
+    """
+    Owns the cluster connection and the batcher for the lifetime of the
+    ASGI app, both set up on lifespan startup.
+    """
+
+    def __init__(self):
+        self.cluster = None
+        self.session = None
+        self.batcher = None
+
+    async def process_startup(self, scope, event):
+        self.cluster, self.session = clusterProfile.connect()
+        queryStats.instrument(self.session)
+        model.ensure_schema(self.session, KEYSPACE, REPLICATION_FACTOR)
+        model.prepare_statements(self.session)
+        self.batcher = ingestBatcher.IngestBatcher(self.session)
+        await self.batcher.start()
+
+    async def process_shutdown(self, scope, event):
+        if self.batcher is not None:
+            await self.batcher.close()
+        if self.cluster is not None:
+            self.cluster.shutdown()
+
+def parse_body(content_type, body):
+    if content_type and content_type.startswith('application/json'):
+        data = json.loads(body)
+        readings = data.get('readings') if isinstance(data, dict) else data
+        if not isinstance(readings, list) or not all(isinstance(reading, dict) for reading in readings):
+            raise ingestBatcher.InvalidReading("Expected a list of readings")
+        return [ingestBatcher.parse_reading(reading) for reading in readings]
+    return ingestBatcher.parse_lines(body.decode())
+
+class VitalSignsResource(object):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    async def on_post(self, req, resp):
+        if req.content_length and req.content_length > MAX_BODY_BYTES:
+            raise falcon.HTTPError(falcon.HTTP_413, title="Body too large",
+                                   description=f"Send at most {MAX_BODY_BYTES} bytes per request")
+        body = await req.stream.read(MAX_BODY_BYTES + 1)
+        if len(body) > MAX_BODY_BYTES:
+            raise falcon.HTTPError(falcon.HTTP_413, title="Body too large",
+                                   description=f"Send at most {MAX_BODY_BYTES} bytes per request")
+        try:
+            rows = parse_body(req.content_type, body)
+        except (ValueError, UnicodeDecodeError) as exc:
+            # InvalidReading and json.JSONDecodeError are both ValueErrors
+            raise falcon.HTTPBadRequest(title="Invalid readings", description=str(exc))
+
+        try:
+            written = await self.gateway.batcher.submit(rows)
+        except ingestBatcher.IngestBusy as exc:
+            raise falcon.HTTPServiceUnavailable(title="Busy", description=str(exc),
+                                                retry_after=math.ceil(exc.retry_after))
+        except Exception as exc:
+            raise falcon.HTTPServiceUnavailable(title="Write failed", description=str(exc), retry_after=1)
+        resp.media = {"written": written}
+
+class HealthResource(object):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    async def on_get(self, req, resp):
+        batcher = self.gateway.batcher
+        stats = batcher.stats
+        resp.media = {
+            "pending": batcher.pending,
+            "in_flight": batcher.in_flight,
+            "window": round(batcher.window, 2),
+            "latency_ms": round(batcher.latency * 1000, 1),
+            "readings": stats.readings,
+            "batches": stats.batches,
+            "errors": stats.errors,
+            "rejected": stats.rejected,
+        }
+
+gateway = IngestGateway()
+
+app = falcon.asgi.App(middleware=[gateway])
+app.add_route('/vital_signs', VitalSignsResource(gateway))
+app.add_route('/health', HealthResource(gateway))
@@ -0,0 +1,122 @@
+import math
+import os
+import struct
+
+import numpy as np
+
+'''
+========================================================
+==               Mergeable quantile sketch            ==
+========================================================
+
+A merging t-digest: readings are kept as weighted centroids, small ones
+near the tails and large ones around the median, so p50 is within a
+fraction of a percent and p95 and p99 are closer still. Two digests merge
+into one with the same guarantee, which lets hourly digests add up to a
+day and days add up to any range without the raw readings.
+'''
+
+# Roughly the number of centroids kept, higher is more exact and larger
+SKETCH_COMPRESSION = int(os.getenv('CASSANDRA_SKETCH_COMPRESSION', '100'))
+
+# version, compression, count, min, max, centroids
+HEADER = struct.Struct('<BHQddI')
+VERSION = 1
+
+class TDigest(object):
+    """
+    Centroid means and weights sorted by mean, plus the exact count, min
+    and max of everything added.
+    """
+
+    def __init__(self, compression=SKETCH_COMPRESSION, means=None, weights=None, minimum=math.inf, maximum=-math.inf):
+        self.compression = compression
+        self.means = np.empty(0) if means is None else np.asarray(means, dtype=np.float64)
+        self.weights = np.empty(0) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.min = minimum
+        self.max = maximum
+
+    @property
+    def count(self):
+        return int(self.weights.sum())
+
+    @classmethod
+    def from_values(cls, values, compression=SKETCH_COMPRESSION):
+        values = np.asarray(values, dtype=np.float64)
+        digest = cls(compression)
+        if len(values):
+            digest._absorb(values, np.ones(len(values)), values.min(), values.max())
+        return digest
+
+    @classmethod
+    def merge_all(cls, digests, compression=SKETCH_COMPRESSION):
+        merged = cls(compression)
+        digests = [digest for digest in digests if len(digest.means)]
+        if digests:
+            merged._absorb(np.concatenate([digest.means for digest in digests]),
+                           np.concatenate([digest.weights for digest in digests]),
+                           min(digest.min for digest in digests), max(digest.max for digest in digests))
+        return merged
+
+    def merge(self, other):
+        return TDigest.merge_all([self, other], self.compression)
+
+    def _absorb(self, means, weights, minimum, maximum):
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind='stable')
+        self.means, self.weights = _compress(means[order], weights[order], self.compression)
+
+    def quantile(self, q):
+        # Interpolates between centroid centres, the exact min and max
+        # anchoring both ends. None when the digest is empty
+        if not len(self.means):
+            return None
+        total = self.weights.sum()
+        centres = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * total, np.concatenate([[0], centres, [total]]),
+                               np.concatenate([[self.min], self.means, [self.max]])))
+
+    def percentiles(self, percents):
+        return {percent: self.quantile(percent / 100) for percent in percents}
+
+    def to_bytes(self):
+        header = HEADER.pack(VERSION, self.compression, self.count, self.min, self.max, len(self.means))
+        return header + self.means.tobytes() + self.weights.astype(np.uint32).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, compression, count, minimum, maximum, size = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f"Unsupported sketch version {version}")
+        offset = HEADER.size
+        means = np.frombuffer(data, dtype=np.float64, count=size, offset=offset)
+        weights = np.frombuffer(data, dtype=np.uint32, count=size, offset=offset + size * 8)
+        return cls(compression, means, weights.astype(np.float64), minimum, maximum)
+
+def _scale(q, compression):
+    # The k1 scale function, centroids may span one unit of k
+    return compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+def _compress(means, weights, compression):
+    # One pass over centroids sorted by mean, folding each into the
+    # previous while the merged centroid spans at most one unit of k
+    if len(means) <= 1:
+        return means, weights
+    total = weights.sum()
+    out_means, out_weights = [means[0]], [weights[0]]
+    before = 0.0
+    limit = _scale(0.0, compression) + 1
+    for mean, weight in zip(means[1:].tolist(), weights[1:].tolist()):
+        if _scale((before + out_weights[-1] + weight) / total, compression) <= limit:
+            merged = out_weights[-1] + weight
+            out_means[-1] += (mean - out_means[-1]) * weight / merged
+            out_weights[-1] = merged
+        else:
+            before += out_weights[-1]
+            limit = _scale(before / total, compression) + 1
+            out_means.append(mean)
+            out_weights.append(weight)
+    return np.array(out_means), np.array(out_weights)
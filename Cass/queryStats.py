@@ -0,0 +1,224 @@
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from cassandra.query import BatchStatement, BoundStatement
+
+log = logging.getLogger()
+
+'''
+========================================================
+==                Query statistics                    ==
+========================================================
+'''
+
+# Requests slower than this are logged with the shape of their parameters
+SLOW_QUERY_MS = float(os.getenv('CASSANDRA_SLOW_QUERY_MS', '500'))
+# Port serving the text format over HTTP, 0 disables it
+METRICS_PORT = int(os.getenv('CASSANDRA_METRICS_PORT', '0'))
+
+# Histogram bucket upper bounds in seconds, four per power of two from
+# 50us to about 105s, so percentiles are within about 19% of the truth
+LATENCY_BOUNDS = [0.00005 * 2 ** (i / 4) for i in range(85)]
+PERCENTILES = [50, 95, 99]
+# (family, help, StatementStats field) of the counters in text_format
+COUNTER_FAMILIES = [
+    ("cassandra_query_rows_total", "Rows returned by each statement.", "rows"),
+    ("cassandra_query_errors_total", "Failed requests of each statement.", "errors"),
+    ("cassandra_query_retries_total", "Retries and speculative executions of each statement.", "retries"),
+]
+
+def _statement_names():
+    # Maps each CQL string of the model to the name of its constant, so
+    # statistics read SELECT_ACCOUNTS instead of the query text
+    from Cass import cassandraModel
+    return {' '.join(value.split()): name for name, value in vars(cassandraModel).items()
+            if name.isupper() and isinstance(value, str) and value.strip()[:6].upper()
+            in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')}
+
+def _query_string(query):
+    if isinstance(query, BoundStatement):
+        return query.prepared_statement.query_string
+    if isinstance(query, BatchStatement):
+        return None
+    return getattr(query, 'query_string', str(query))
+
+def _param_shape(query):
+    # Types of the bound values without the values themselves, lists and
+    # sets show their length
+    if isinstance(query, BatchStatement):
+        return f"batch of {len(query)}"
+    values = getattr(query, 'raw_values', None)
+    if values is None:
+        return "()"
+    shapes = []
+    for value in values:
+        if isinstance(value, (list, tuple, set)):
+            shapes.append(f"{type(value).__name__}[{len(value)}]")
+        else:
+            shapes.append(type(value).__name__)
+    return f"({', '.join(shapes)})"
+
+class StatementStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.pages = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BOUNDS) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BOUNDS, seconds)] += 1
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the percentile, capped at the max seen
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+class QueryStats(object):
+    """
+    Collects latency histograms, row, page, retry and error counts per
+    statement from a session's request listener. Latency is measured to
+    the first page, later pages of a paged read only add rows and pages.
+    """
+
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self.slow_seconds = slow_query_ms / 1000
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._names = None
+
+    def name(self, query):
+        text = _query_string(query)
+        if text is None:
+            return "BATCH"
+        if self._names is None:
+            self._names = _statement_names()
+        text = ' '.join(text.split())
+        return self._names.get(text) or text[:60]
+
+    def on_request(self, response_future):
+        start = time.perf_counter()
+        query = response_future.query
+        name = self.name(query)
+        # Pages delivered and hosts sent to so far, for the paged reads
+        pages = [0]
+        sent = [0]
+
+        def on_page(rows):
+            seconds = time.perf_counter() - start
+            pages[0] += 1
+            with self._lock:
+                stats = self._stats.setdefault(name, StatementStats())
+                if pages[0] == 1:
+                    stats.record(seconds)
+                stats.pages += 1
+                stats.rows += len(rows) if isinstance(rows, list) else 0
+                # One send per page is expected, the rest are retries and
+                # speculative executions
+                stats.retries += max(0, len(response_future.attempted_hosts) - sent[0] - 1)
+                sent[0] = len(response_future.attempted_hosts)
+            if pages[0] == 1 and seconds >= self.slow_seconds:
+                log.warning(f"Slow query {name} {_param_shape(query)} took {seconds * 1000:.0f}ms "
+                            f"on {response_future.coordinator_host}")
+
+        def on_error(exc):
+            seconds = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats.setdefault(name, StatementStats())
+                stats.errors += 1
+                stats.retries += max(0, len(response_future.attempted_hosts) - sent[0] - 1)
+            log.warning(f"Query {name} {_param_shape(query)} failed after {seconds * 1000:.0f}ms: {exc}")
+
+        response_future.add_callbacks(on_page, on_error)
+
+    def snapshot(self):
+        # [(name, stats)] sorted by total time spent, the costliest first
+        with self._lock:
+            items = [(name, stats) for name, stats in self._stats.items()]
+        return sorted(items, key=lambda item: item[1].seconds, reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self):
+        lines = [f"{'statement':<45} {'count':>8} {'errors':>6} {'retries':>7} {'rows':>9} "
+                 f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+        for name, stats in self.snapshot():
+            p50, p95, p99 = (stats.percentile(percent) * 1000 for percent in PERCENTILES)
+            lines.append(f"{name[:45]:<45} {stats.count:>8} {stats.errors:>6} {stats.retries:>7} {stats.rows:>9} "
+                         f"{p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {stats.max_seconds * 1000:>8.1f}")
+        return '\n'.join(lines)
+
+    def text_format(self):
+        # Prometheus text exposition format, each family's samples together
+        # under its HELP and TYPE lines
+        snapshot = [(f'statement="{_escape(name)}"', stats) for name, stats in self.snapshot()]
+        lines = [
+            "# HELP cassandra_query_latency_seconds Time to the first page of each statement.",
+            "# TYPE cassandra_query_latency_seconds histogram",
+        ]
+        for label, stats in snapshot:
+            seen = 0
+            for bound, count in zip(LATENCY_BOUNDS, stats.buckets):
+                seen += count
+                lines.append(f'cassandra_query_latency_seconds_bucket{{{label},le="{bound:.6g}"}} {seen}')
+            lines.append(f'cassandra_query_latency_seconds_bucket{{{label},le="+Inf"}} {stats.count}')
+            lines.append(f'cassandra_query_latency_seconds_sum{{{label}}} {stats.seconds:.6f}')
+            lines.append(f'cassandra_query_latency_seconds_count{{{label}}} {stats.count}')
+        for family, help_text, field in COUNTER_FAMILIES:
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} counter")
+            for label, stats in snapshot:
+                lines.append(f'{family}{{{label}}} {getattr(stats, field)}')
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return re.sub(r'(["\\])', r'\\\1', value).replace('\n', ' ')
+
+query_stats = QueryStats()
+
+def instrument(session, stats=query_stats):
+    session.add_request_init_listener(stats.on_request)
+    return stats
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = query_stats.text_format().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT):
+    # Serves text_format on every path from a daemon thread
+    if not port:
+        return None
+    server = HTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="query-metrics", daemon=True).start()
+    log.info(f"Serving query metrics on port {port}")
+    return server
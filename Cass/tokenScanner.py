@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from Cass import cassandraModel as model
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+log = logging.getLogger()
+
+'''
+========================================================
+==                Token range scans                   ==
+========================================================
+'''
+
+# Murmur3Partitioner tokens, the minimum token itself is never assigned
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+SCAN_SPLITS = int(os.getenv('CASSANDRA_SCAN_SPLITS', '64'))
+SCAN_PARALLELISM = int(os.getenv('CASSANDRA_SCAN_PARALLELISM', '8'))
+SCAN_FETCH_SIZE = int(os.getenv('CASSANDRA_SCAN_FETCH_SIZE', '5000'))
+# Rows buffered by scan_to_file before they are written as a row group
+SCAN_ROW_GROUP_ROWS = int(os.getenv('CASSANDRA_SCAN_ROW_GROUP_ROWS', '65536'))
+
+SCAN_RANGE = """
+    SELECT {} FROM {}
+        WHERE token({}) > ?
+        AND token({}) <= ?
+"""
+
+def token_ranges(splits=SCAN_SPLITS):
+    # (start, end] ranges of equal width covering the whole ring
+    width = (MAX_TOKEN - MIN_TOKEN) // splits
+    bounds = [MIN_TOKEN + i * width for i in range(splits)] + [MAX_TOKEN]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def partition_key(session, table):
+    keyspace = session.cluster.metadata.keyspaces.get(session.keyspace)
+    if keyspace is None or table not in keyspace.tables:
+        raise ValueError(f"Unknown table {table} in keyspace {session.keyspace}")
+    return [column.name for column in keyspace.tables[table].partition_key]
+
+class ScanStats(object):
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = 0
+        self.pages = 0
+        self.ranges = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        rate = self.rows / self.seconds if self.seconds else 0.0
+        return (f"{self.table}: {self.rows} rows in {self.pages} pages over {self.ranges} ranges "
+                f"({self.skipped} already done) in {self.seconds:.2f}s ({rate:.0f} rows/s)")
+
+class Checkpoint(object):
+    """
+    Progress of a scan kept in a JSON file, per range either the paging
+    state to resume from or true once the range is done. Without a path
+    the progress is only kept in memory.
+    """
+
+    def __init__(self, path, table, splits):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = {"table": table, "splits": splits, "ranges": {}}
+        if path and os.path.exists(path):
+            with open(path, mode='r') as file:
+                state = json.load(file)
+            if state.get("table") == table and state.get("splits") == splits:
+                self._state = state
+            else:
+                log.warning(f"Ignoring checkpoint {path}, it belongs to another scan")
+
+    def done(self, index):
+        return self._state["ranges"].get(str(index)) is True
+
+    def paging_state(self, index):
+        state = self._state["ranges"].get(str(index))
+        return bytes.fromhex(state) if isinstance(state, str) else None
+
+    def save(self, index, paging_state):
+        with self._lock:
+            self._state["ranges"][str(index)] = paging_state.hex() if paging_state else True
+            if not self.path:
+                return
+            temp = self.path + '.tmp'
+            with open(temp, mode='w') as file:
+                json.dump(self._state, file)
+            os.replace(temp, self.path)
+
+def scan_table(session, table, consumer, columns=None, splits=SCAN_SPLITS, parallelism=SCAN_PARALLELISM,
+               fetch_size=SCAN_FETCH_SIZE, checkpoint_file=None):
+    # Scans every row of table, splitting the ring into splits token ranges
+    # and reading up to parallelism of them at once. consumer(rows) gets
+    # each page, one call at a time. A range is checkpointed after each
+    # page its consumer call returned from, so a scan resumed from the same
+    # checkpoint_file delivers every row at least once
+    key = ", ".join(partition_key(session, table))
+    query = SCAN_RANGE.format(", ".join(columns) if columns else "*", table, key, key)
+    stmt = model.get_prepared(session, query)
+    checkpoint = Checkpoint(checkpoint_file, table, splits)
+    stats = ScanStats(table)
+    consumer_lock = threading.Lock()
+
+    def scan_range(index, start, end):
+        paging_state = checkpoint.paging_state(index)
+        while True:
+            bound = stmt.bind((start, end))
+            bound.fetch_size = fetch_size
+            result = session.execute(bound, paging_state=paging_state)
+            paging_state = result.paging_state
+            with consumer_lock:
+                consumer(result.current_rows)
+                stats.rows += len(result.current_rows)
+                stats.pages += 1
+            checkpoint.save(index, paging_state)
+            if not paging_state:
+                break
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = []
+        for index, (start, end) in enumerate(token_ranges(splits)):
+            if checkpoint.done(index):
+                stats.skipped += 1
+                continue
+            futures.append(executor.submit(scan_range, index, start, end))
+        for future in futures:
+            future.result()
+            stats.ranges += 1
+    stats.seconds = time.perf_counter() - start_time
+
+    log.info(str(stats))
+    return stats
+
+'''
+========================================================
+==                 Columnar output                    ==
+========================================================
+'''
+
+class ColumnarConsumer(object):
+    """
+    Scan consumer that keeps the rows as one list per column, turned into
+    NumPy arrays by to_arrays or written as an .npz file by save. Every
+    row is held in memory, ParquetConsumer streams larger scans to disk.
+    """
+
+    def __init__(self, columns=None, where=None):
+        self.columns = columns
+        self.where = where
+        self._data = None
+
+    def __call__(self, rows):
+        for row in rows:
+            if self.where is not None and not self.where(row):
+                continue
+            if self._data is None:
+                self.columns = self.columns or list(row._fields)
+                self._data = {column: [] for column in self.columns}
+            for column in self.columns:
+                self._data[column].append(getattr(row, column))
+
+    def to_arrays(self):
+        arrays = {}
+        for column, values in (self._data or {}).items():
+            array = np.asarray(values)
+            # UUIDs, dates and other objects are kept as strings
+            arrays[column] = array.astype(str) if array.dtype == object else array
+        return arrays
+
+    def save(self, path):
+        np.savez_compressed(path, **self.to_arrays())
+        return path
+
+def _arrow_column(values):
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # UUIDs and other objects are kept as strings
+        return pa.array([None if value is None else str(value) for value in values], pa.string())
+
+class ParquetConsumer(object):
+    """
+    Scan consumer that writes the rows to a Parquet file as they arrive,
+    one row group every row_group_rows rows, so at most that many are held
+    in memory. The schema is taken from the first row group and no file
+    is written when no row matched. close writes what is left and the
+    file footer, the file is unreadable before.
+    """
+
+    def __init__(self, path, columns=None, where=None, row_group_rows=SCAN_ROW_GROUP_ROWS):
+        if pa is None:
+            raise ImportError("Scanning to a file needs pyarrow, install it with 'pip install pyarrow'")
+        self.path = path
+        self.columns = columns
+        self.where = where
+        self.row_group_rows = row_group_rows
+        self.rows = 0
+        self.row_groups = 0
+        self._data = None
+        self._buffered = 0
+        self._writer = None
+
+    def __call__(self, rows):
+        for row in rows:
+            if self.where is not None and not self.where(row):
+                continue
+            if self._data is None:
+                self.columns = self.columns or list(row._fields)
+                self._data = {column: [] for column in self.columns}
+            for column in self.columns:
+                self._data[column].append(getattr(row, column))
+            self._buffered += 1
+        if self._buffered >= self.row_group_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        table = pa.table({column: _arrow_column(values) for column, values in self._data.items()})
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+        else:
+            table = table.cast(self._writer.schema)
+        self._writer.write_table(table)
+        self.rows += self._buffered
+        self.row_groups += 1
+        self._data = {column: [] for column in self.columns}
+        self._buffered = 0
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+def scan_to_file(session, table, path, columns=None, where=None, row_group_rows=SCAN_ROW_GROUP_ROWS, **options):
+    # Streams the scan to a Parquet file at path. Rows are checkpointed
+    # once handed to the consumer, not once the footer is written, so a
+    # scan resumed from a checkpoint_file must write a new path and read
+    # back together with the earlier, complete, files
+    consumer = ParquetConsumer(path, columns, where, row_group_rows)
+    try:
+        stats = scan_table(session, table, consumer, columns, **options)
+    finally:
+        consumer.close()
+    return stats
@@ -0,0 +1,143 @@
+import numpy as np
+
+from Cass import cassandraModel as model
+from Cass import tokenScanner
+
+'''
+========================================================
+==            Vectorized vital sign checks            ==
+========================================================
+'''
+
+def out_of_range(types, values, ranges=None, default=None):
+    # Flags every reading against the range of its type in one pass per
+    # type instead of one Python call per reading. Types missing from
+    # ranges use the default range, or are never flagged without one
+    ranges = model.VITAL_SIGN_RANGES if ranges is None else ranges
+    types = np.asarray(types)
+    values = np.asarray(values, dtype=np.float64)
+
+    mask = np.zeros(len(values), dtype=bool)
+    known = np.zeros(len(values), dtype=bool)
+    for vital_sign_type, (low, high) in ranges.items():
+        of_type = types == vital_sign_type
+        known |= of_type
+        mask |= of_type & ((values < low) | (values > high))
+    if default is not None:
+        low, high = default
+        mask |= ~known & ((values < low) | (values > high))
+    return mask
+
+'''
+========================================================
+==                 Series analytics                   ==
+========================================================
+'''
+
+def load_series(session, account_id, start_date=None, end_date=None, vital_sign_type=None):
+    # Returns {type: (timestamps, values)} oldest first, timestamps are unix seconds
+    series = {}
+    for row in model.get_vital_signs_range(session, account_id, start_date, end_date, vital_sign_type):
+        timestamps, values = series.setdefault(row.type, ([], []))
+        timestamps.append(model.uuid_timestamp(row.vital_sign_id))
+        values.append(row.value)
+
+    # Rows arrive newest first
+    return {
+        vital_sign_type: (np.array(timestamps[::-1]), np.array(values[::-1], dtype=np.float64))
+        for vital_sign_type, (timestamps, values) in series.items()
+    }
+
+def _rolling_sums(values, window):
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    return sums[window:] - sums[:-window]
+
+def rolling_mean(values, window):
+    # Mean of each reading and the window - 1 before it, NaN until the
+    # first full window
+    means = np.full(len(values), np.nan)
+    if len(values) >= window:
+        means[window - 1:] = _rolling_sums(values, window) / window
+    return means
+
+def rolling_std(values, window):
+    stds = np.full(len(values), np.nan)
+    if len(values) >= window:
+        means = _rolling_sums(values, window) / window
+        squares = _rolling_sums(values * values, window) / window
+        stds[window - 1:] = np.sqrt(np.clip(squares - means * means, 0.0, None))
+    return stds
+
+def zscore_anomalies(values, window=20, threshold=3.0):
+    # Each reading is scored against the window before it, so a spike
+    # does not inflate the statistics it is compared with
+    mask = np.zeros(len(values), dtype=bool)
+    if len(values) <= window:
+        return mask
+    means = rolling_mean(values, window)[window - 1:-1]
+    stds = rolling_std(values, window)[window - 1:-1]
+    current = values[window:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.abs(current - means) / stds
+    mask[window:] = np.nan_to_num(scores, nan=0.0, posinf=0.0) > threshold
+    return mask
+
+def trend_slope(timestamps, values):
+    # Least squares slope in units per day
+    if len(values) < 2:
+        return np.nan
+    days = (timestamps - timestamps.mean()) / 86400
+    spread = np.sum(days * days)
+    if not spread:
+        return np.nan
+    return float(np.sum(days * (values - values.mean())) / spread)
+
+def analyze_vital_signs(session, account_id, start_date=None, end_date=None,
+                        vital_sign_type=None, window=20, threshold=3.0):
+    report = {}
+    for series_type, (timestamps, values) in load_series(session, account_id, start_date,
+                                                          end_date, vital_sign_type).items():
+        flagged = out_of_range(np.full(len(values), series_type), values)
+        report[series_type] = {
+            "count": len(values),
+            "mean": float(values.mean()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "out_of_range": int(flagged.sum()),
+            "anomalies": int(zscore_anomalies(values, window, threshold).sum()),
+            "slope_per_day": trend_slope(timestamps, values),
+            "last_rolling_mean": float(rolling_mean(values, min(window, len(values)))[-1]),
+        }
+    return report
+
+def _unix_seconds(day):
+    if not isinstance(day, model.datetime):
+        day = model.datetime.combine(day, model.dt.time())
+    return (day - model.EPOCH_DATETIME).total_seconds()
+
+def population_out_of_range(session, vital_sign_type, start_date=None, end_date=None, **options):
+    # Share of patients with at least one reading of the type out of range
+    # between the dates, from a token range scan of the per type table.
+    # options are passed on to tokenScanner.scan_table
+    start_date, end_date = model.default_date_range(start_date, end_date)
+    buckets = set(model.vital_sign_buckets(start_date, end_date))
+    start, end = _unix_seconds(start_date), _unix_seconds(end_date)
+    patients = set()
+    abnormal = set()
+
+    def consume(rows):
+        rows = [row for row in rows if row.type == vital_sign_type and row.bucket in buckets
+                and start <= model.uuid_timestamp(row.vital_sign_id) <= end]
+        if not rows:
+            return
+        flagged = out_of_range(np.full(len(rows), vital_sign_type), [row.value for row in rows])
+        patients.update(row.account_id for row in rows)
+        abnormal.update(row.account_id for row, out in zip(rows, flagged.tolist()) if out)
+
+    tokenScanner.scan_table(session, 'vital_signs_by_account_type_bucket', consume,
+                            ['account_id', 'type', 'bucket', 'vital_sign_id', 'value'], **options)
+    return {
+        "patients": len(patients),
+        "abnormal": len(abnormal),
+        "share": len(abnormal) / len(patients) if patients else 0.0,
+    }
@@ -0,0 +1,237 @@
+import logging
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from Cass import cassandraModel as model
+from Cass import clusterProfile
+
+log = logging.getLogger()
+
+'''
+========================================================
+==              Vital sign ingest benchmark           ==
+========================================================
+
+Simulates the devices of BENCH_PATIENTS patients, each sending one
+reading every 1 / BENCH_DEVICE_RATE seconds, split across BENCH_PROCESSES
+worker processes. The load is open loop: readings are due on a fixed
+schedule whether or not earlier writes have finished, and latency is
+measured from the time a reading was due, so a saturated cluster shows up
+as growing latency and lag instead of a quietly lower rate.
+
+The 'single' path writes each reading with insert_vital_sign from a pool
+of BENCH_THREADS threads. The 'bulk' path hands every BENCH_BATCH_SECONDS
+of readings to load_vital_signs, the loader behind bulk_insert.
+
+Readings belong to accounts named BENCH000001 and up, which have no
+account rows and expire with the retention of any other reading.
+'''
+
+BENCH_PATIENTS = int(os.getenv('BENCH_PATIENTS', '1000'))
+# Readings per second sent by each device
+BENCH_DEVICE_RATE = float(os.getenv('BENCH_DEVICE_RATE', '1'))
+BENCH_SECONDS = float(os.getenv('BENCH_SECONDS', '60'))
+BENCH_PROCESSES = int(os.getenv('BENCH_PROCESSES', '1'))
+BENCH_MODE = os.getenv('BENCH_MODE', 'single')
+BENCH_THREADS = int(os.getenv('BENCH_THREADS', '32'))
+BENCH_BATCH_SECONDS = float(os.getenv('BENCH_BATCH_SECONDS', '1'))
+# Readings due but not yet written before the schedule stops for them
+BENCH_MAX_IN_FLIGHT = 10000
+
+# (low, high) of the uniformly drawn values, wider than the normal ranges
+# so a share of the readings raise alerts
+VITAL_SIGN_DISTRIBUTIONS = {
+    'blood pressure': (80, 150),
+    'heart rate': (50, 110),
+    'oxygenation': (85, 100),
+    'temperature': (35, 39),
+}
+
+PERCENTILES = [50, 90, 95, 99, 99.9]
+
+def bench_accounts(patients):
+    return [f"BENCH{i:06d}" for i in range(1, patients + 1)]
+
+def reading(account_id, timestamp):
+    vital_sign_type = random.choice(list(VITAL_SIGN_DISTRIBUTIONS))
+    value = random.uniform(*VITAL_SIGN_DISTRIBUTIONS[vital_sign_type])
+    vital_sign_id = model.vital_sign_uuid(account_id, vital_sign_type, timestamp, value)
+    return [vital_sign_id, account_id, vital_sign_type, value, timestamp.date()]
+
+class WorkerResult(object):
+
+    def __init__(self):
+        self.readings = 0
+        self.errors = 0
+        self.alerts = 0
+        self.max_lag = 0.0
+        self.seconds = 0.0
+        # Milliseconds from due to written, one per reading
+        self.latencies = []
+
+class BenchmarkReport(object):
+
+    def __init__(self, mode, patients, device_rate, processes):
+        self.mode = mode
+        self.patients = patients
+        self.target_rate = patients * device_rate
+        self.processes = processes
+        self.readings = 0
+        self.errors = 0
+        self.alerts = 0
+        self.max_lag = 0.0
+        self.seconds = 0.0
+        self.latencies = np.empty(0, dtype=np.float32)
+
+    def add(self, result):
+        self.readings += result.readings
+        self.errors += result.errors
+        self.alerts += result.alerts
+        self.max_lag = max(self.max_lag, result.max_lag)
+        self.seconds = max(self.seconds, result.seconds)
+        self.latencies = np.concatenate([self.latencies, np.asarray(result.latencies, dtype=np.float32)])
+
+    @property
+    def throughput(self):
+        return self.readings / self.seconds if self.seconds else 0.0
+
+    def percentiles(self):
+        if not len(self.latencies):
+            return {percent: 0.0 for percent in PERCENTILES}
+        return dict(zip(PERCENTILES, np.percentile(self.latencies, PERCENTILES).tolist()))
+
+    def __str__(self):
+        alert_rate = self.alerts / self.readings * 100 if self.readings else 0.0
+        percentiles = ", ".join(f"p{percent:g} {value:.1f}ms" for percent, value in self.percentiles().items())
+        return (f"{self.mode} path, {self.patients} devices over {self.processes} processes\n"
+                f"=== Throughput: {self.throughput:.0f} readings/s of {self.target_rate:.0f} targeted, "
+                f"{self.readings} readings in {self.seconds:.1f}s\n"
+                f"=== Latency: {percentiles}\n"
+                f"=== Alerts: {self.alerts} ({alert_rate:.2f}% of readings), errors: {self.errors}\n"
+                f"=== Max lag behind schedule: {self.max_lag:.2f}s")
+
+def _schedule(account_ids, device_rate, seconds, start):
+    # Yields (due time, account) with every device sending at device_rate,
+    # the devices spread evenly over each interval
+    interval = 1 / (len(account_ids) * device_rate)
+    count = int(seconds * len(account_ids) * device_rate)
+    for i in range(count):
+        yield start + i * interval, account_ids[i % len(account_ids)]
+
+def run_single(session, account_ids, device_rate, seconds, threads=BENCH_THREADS):
+    result = WorkerResult()
+    lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(BENCH_MAX_IN_FLIGHT)
+    writer = model.get_alert_writer(session)
+    alerts_before = writer.written + writer.errors
+
+    def write(due, data):
+        try:
+            model.insert_vital_sign(session, data)
+            error = False
+        except Exception as exc:
+            log.error(f"Benchmark write failed: {exc}")
+            error = True
+        finally:
+            in_flight.release()
+        latency = (time.monotonic() - due) * 1000
+        with lock:
+            result.readings += 1
+            result.errors += error
+            result.latencies.append(latency)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for due, account_id in _schedule(account_ids, device_rate, seconds, start):
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            in_flight.acquire()
+            result.max_lag = max(result.max_lag, time.monotonic() - due)
+            executor.submit(write, due, reading(account_id, datetime.utcnow()))
+    writer.flush()
+    result.seconds = time.monotonic() - start
+    result.alerts = writer.written + writer.errors - alerts_before
+    return result
+
+def run_bulk(session, account_ids, device_rate, seconds, batch_seconds=BENCH_BATCH_SECONDS):
+    result = WorkerResult()
+    start = time.monotonic()
+    schedule = _schedule(account_ids, device_rate, seconds, start)
+    pending = next(schedule, None)
+    batch_end = start
+    while pending is not None:
+        batch_end += batch_seconds
+        delay = batch_end - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        result.max_lag = max(result.max_lag, time.monotonic() - batch_end)
+
+        dues, rows = [], []
+        now = datetime.utcnow()
+        while pending is not None and pending[0] <= batch_end:
+            due, account_id = pending
+            # Readings are stamped with when they were due
+            data = reading(account_id, now - timedelta(seconds=batch_end - due))
+            rows.append(tuple(data) + (model.uuid_bucket(data[0]),))
+            dues.append(due)
+            pending = next(schedule, None)
+        if not rows:
+            continue
+
+        stats = model.load_vital_signs(session, rows)
+        done = time.monotonic()
+        result.readings += stats.rows
+        result.errors += stats.errors
+        result.alerts += stats.alerts
+        result.latencies.extend((done - due) * 1000 for due in dues)
+    result.seconds = time.monotonic() - start
+    return result
+
+BENCH_RUNNERS = {
+    'single': run_single,
+    'bulk': run_bulk,
+}
+
+def _run_worker(task):
+    contact_points, port, keyspace, mode, account_ids, device_rate, seconds = task
+    cluster = clusterProfile.create_cluster(contact_points=contact_points, port=port)
+    try:
+        session = cluster.connect(keyspace)
+        model.prepare_statements(session)
+        return BENCH_RUNNERS[mode](session, account_ids, device_rate, seconds)
+    finally:
+        cluster.shutdown()
+
+def run_benchmark(session, patients=BENCH_PATIENTS, device_rate=BENCH_DEVICE_RATE, seconds=BENCH_SECONDS,
+                  processes=BENCH_PROCESSES, mode=BENCH_MODE):
+    if mode not in BENCH_RUNNERS:
+        raise ValueError(f"Unknown benchmark mode {mode}, expected one of {', '.join(BENCH_RUNNERS)}")
+    account_ids = bench_accounts(patients)
+    processes = max(1, min(processes, patients))
+    report = BenchmarkReport(mode, patients, device_rate, processes)
+    log.info(f"Benchmarking the {mode} path with {patients} devices at {device_rate} readings/s "
+             f"for {seconds:.0f}s over {processes} processes")
+
+    if processes <= 1:
+        model.prepare_statements(session)
+        report.add(BENCH_RUNNERS[mode](session, account_ids, device_rate, seconds))
+    else:
+        # Each process drives its own share of the devices through its own
+        # connections, as in parallel_load
+        tasks = [(session.cluster.contact_points, session.cluster.port, session.keyspace, mode,
+                  account_ids[i::processes], device_rate, seconds) for i in range(processes)]
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes) as pool:
+            for result in pool.imap_unordered(_run_worker, tasks):
+                report.add(result)
+
+    print(f"=== {report}")
+    return report
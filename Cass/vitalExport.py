@@ -0,0 +1,167 @@
+import logging
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+from cassandra.query import SimpleStatement
+
+from Cass import cassandraModel as model
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+log = logging.getLogger()
+
+'''
+========================================================
+==               Columnar vital sign export           ==
+========================================================
+
+Files are laid out as
+
+    <out_dir>/account_bucket=<n>/date=<yyyy-mm-dd>/part-<run>-<seq>.parquet
+
+with one row group per batch. account_bucket is a stable hash of the
+account id, so one account's readings always land in the same bucket.
+Hive partitioning readers such as pyarrow.dataset and Spark turn both
+directory levels back into columns. The 'arrow' format writes
+uncompressed Arrow IPC files (.arrow) that can be memory mapped instead.
+The IPC file format allows a single dictionary per column, so there the
+type column is plain strings rather than dictionary encoded.
+'''
+
+EXPORT_ACCOUNT_BUCKETS = int(os.getenv('CASSANDRA_EXPORT_ACCOUNT_BUCKETS', '16'))
+# Rows buffered across every partition before all buffers are written
+EXPORT_BATCH_ROWS = int(os.getenv('CASSANDRA_EXPORT_BATCH_ROWS', '65536'))
+# Partition files kept open at once, the least recently written is closed
+# and a later batch for it starts a new part file
+EXPORT_MAX_OPEN_FILES = 64
+
+def _require_arrow():
+    if pa is None:
+        raise ImportError("Exporting vital signs needs pyarrow, install it with 'pip install pyarrow'")
+
+def vital_sign_schema(file_format='parquet'):
+    _require_arrow()
+    type_column = pa.dictionary(pa.int32(), pa.string()) if file_format == 'parquet' else pa.string()
+    return pa.schema([
+        ('vital_sign_id', pa.string()),
+        ('account_id', pa.string()),
+        ('type', type_column),
+        ('value', pa.float64()),
+        ('timestamp', pa.timestamp('us')),
+        ('bucket', pa.int32()),
+    ])
+
+def account_bucket(account_id, buckets=EXPORT_ACCOUNT_BUCKETS):
+    return zlib.crc32(account_id.encode()) % buckets
+
+def vital_sign_accounts(session, start_date=None, end_date=None):
+    # Every account holding readings in the range, from the partition keys
+    start_date, end_date = model.default_date_range(start_date, end_date)
+    buckets = set(model.vital_sign_buckets(start_date, end_date))
+    rows = session.execute(SimpleStatement(model.SELECT_VITAL_SIGN_PARTITIONS, fetch_size=model.PURGE_FETCH_SIZE))
+    return sorted({row.account_id for row in rows if row.bucket in buckets})
+
+class PartitionWriter(object):
+    """
+    Streams rows into one file per (account bucket, date) partition.
+    Once batch_rows rows are buffered across all partitions every buffer
+    is written as one row group or record batch, so memory stays flat
+    however many partitions an export touches.
+    """
+
+    def __init__(self, out_dir, file_format='parquet', batch_rows=EXPORT_BATCH_ROWS,
+                 max_open_files=EXPORT_MAX_OPEN_FILES):
+        _require_arrow()
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError(f"Unknown export format {file_format}")
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.batch_rows = batch_rows
+        self.max_open_files = max_open_files
+        self.schema = vital_sign_schema(file_format)
+        self.run = time.strftime('%Y%m%d%H%M%S')
+        self.rows = 0
+        self.files = 0
+        self._buffered = 0
+        self._buffers = {}
+        self._writers = OrderedDict()
+
+    def add(self, row):
+        partition = (account_bucket(row.account_id), str(row.date))
+        buffer = self._buffers.setdefault(partition, {name: [] for name in self.schema.names})
+        buffer['vital_sign_id'].append(str(row.vital_sign_id))
+        buffer['account_id'].append(row.account_id)
+        buffer['type'].append(row.type)
+        buffer['value'].append(row.value)
+        buffer['timestamp'].append(model.utc_datetime(model.uuid_timestamp(row.vital_sign_id)))
+        buffer['bucket'].append(model.uuid_bucket(row.vital_sign_id))
+        self._buffered += 1
+        if self._buffered >= self.batch_rows:
+            self._flush_all()
+
+    def close(self):
+        self._flush_all()
+        while self._writers:
+            self._writers.popitem(last=False)[1].close()
+
+    def _flush_all(self):
+        for partition in list(self._buffers):
+            self._flush(partition)
+        self._buffered = 0
+
+    def _flush(self, partition):
+        buffer = self._buffers.pop(partition)
+        table = pa.Table.from_pydict(buffer, schema=self.schema)
+        writer = self._writer(partition)
+        if self.file_format == 'parquet':
+            writer.write_table(table)
+        else:
+            for batch in table.to_batches():
+                writer.write_batch(batch)
+        self.rows += table.num_rows
+
+    def _writer(self, partition):
+        writer = self._writers.get(partition)
+        if writer is not None:
+            self._writers.move_to_end(partition)
+            return writer
+
+        while len(self._writers) >= self.max_open_files:
+            self._writers.popitem(last=False)[1].close()
+        bucket, date = partition
+        directory = os.path.join(self.out_dir, f"account_bucket={bucket}", f"date={date}")
+        os.makedirs(directory, exist_ok=True)
+        self.files += 1
+        path = os.path.join(directory, f"part-{self.run}-{self.files:05d}.{self.file_format}")
+        if self.file_format == 'parquet':
+            writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            writer = pa.ipc.new_file(path, self.schema)
+        self._writers[partition] = writer
+        return writer
+
+def export_vital_signs(session, out_dir, account_ids=None, start_date=None, end_date=None,
+                       vital_sign_type=None, file_format='parquet', batch_rows=EXPORT_BATCH_ROWS):
+    # Streams the readings of the accounts, or of every account with
+    # readings in the range, one account at a time through the bucketed
+    # reads. Returns (rows, files) written
+    start_date, end_date = model.default_date_range(start_date, end_date)
+    if not account_ids:
+        account_ids = vital_sign_accounts(session, start_date, end_date)
+
+    writer = PartitionWriter(out_dir, file_format, batch_rows)
+    try:
+        for account_id in account_ids:
+            for row in model.get_vital_signs_range(session, account_id, start_date, end_date, vital_sign_type):
+                writer.add(row)
+    finally:
+        writer.close()
+
+    log.info(f"Exported {writer.rows} vital signs of {len(account_ids)} accounts to {writer.files} files in {out_dir}")
+    return writer.rows, writer.files
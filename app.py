@@ -4,17 +4,17 @@ import datetime as dt
 from uuid import UUID
 import pydgraph
 
-from cassandra.cluster import Cluster
 from dgraph import model
 
 from Cass import cassandraModel
 from Cass import cassandraApp
+from Cass import clusterProfile
+from Cass import queryStats
 
 from mongo import populate
 from mongo import client
 
 
-CLUSTER_IPS = os.getenv('CASSANDRA_CLUSTER_IPS', 'localhost')
 KEYSPACE = os.getenv('CASSANDRA_KEYSPACE', 'healthcare')
 REPLICATION_FACTOR = os.getenv('CASSANDRA_REPLICATION_FACTOR', '1')
 # Configuración de Dgraph
@@ -39,6 +39,11 @@ def printMenuDoctor():
         4: "View vital signs",
         5: "Delete vital signs",
         6: "Create a new doctor",
+        7: "Analyze vital signs",
+        8: "Latest vital signs of patients",
+        9: "Population vital sign report",
+        11: "Ward vital signs",
+        12: "Vital sign percentiles",
         10: "Exit"
     }
     for key in mm_options.keys():
@@ -60,6 +65,9 @@ def print_menu():
         1: "Mongo",
         2: "Dgraph",
         3: "Load data",
+        5: "Migrate vital signs to bucketed tables",
+        6: "Export vital signs",
+        7: "Query statistics",
         4: "Exit"
     }
     for key in mm_options.keys():
@@ -137,6 +145,21 @@ def appDoctor(session, accountData):
             # Create a new doctor
             createDoctor(session)
             pass
+        elif option == 7:
+            # Analyze vital signs
+            cassandraApp.analyzeVitalSignsbyPatient(session)
+        elif option == 8:
+            # Latest vital signs
+            cassandraApp.viewLatestVitalSigns(session)
+        elif option == 9:
+            # Population vital sign report
+            cassandraApp.populationVitalSigns(session)
+        elif option == 11:
+            # Ward vital signs
+            cassandraApp.viewWardVitalSigns(session)
+        elif option == 12:
+            # Vital sign percentiles
+            cassandraApp.viewVitalSignPercentiles(session)
         elif option == 10:
             # Exit
             print("**** Exiting ****")
@@ -294,11 +317,12 @@ def print_menu_dgraph():
     print("========================================")
 
 def main():
-    cluster = Cluster(CLUSTER_IPS.split(','))
-    cassandraSession = cluster.connect()
-    cassandraModel.create_keyspace(cassandraSession, KEYSPACE, REPLICATION_FACTOR)
-    cassandraSession.set_keyspace(KEYSPACE)
-    cassandraModel.create_schema(cassandraSession)
+    cluster, cassandraSession = clusterProfile.connect()
+    queryStats.instrument(cassandraSession)
+    queryStats.start_metrics_server()
+    cassandraModel.ensure_schema(cassandraSession, KEYSPACE, REPLICATION_FACTOR)
+    cassandraModel.prepare_statements(cassandraSession)
+    cassandraModel.start_retention_job(cassandraSession)
     client_stub = create_dgraph_client_stub()
     client = create_dgraph_client(client_stub)
 
@@ -327,6 +351,12 @@ def main():
         elif option == 4:
             print("*** Exiting ****")
             break
+        elif option == 5:
+            cassandraModel.migrate_vital_sign_buckets(cassandraSession)
+        elif option == 6:
+            cassandraApp.exportVitalSigns(cassandraSession)
+        elif option == 7:
+            cassandraApp.viewQueryStats(cassandraSession)
         else:
             print("Invalid option. Please try again.")
         
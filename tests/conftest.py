@@ -0,0 +1,16 @@
+import pytest
+
+from Cass import cassandraModel as model
+from Cass import fakeCassandra
+
+@pytest.fixture
+def session():
+    # A fresh in-memory keyspace per test, with the full schema
+    cluster, session = fakeCassandra.connect()
+    model.ensure_schema(session, 'healthcare', 1)
+    model.prepare_statements(session)
+    yield session
+    refresher = model._rollup_refreshers.pop(session, None)
+    if refresher is not None:
+        refresher.flush(timeout=5)
+    cluster.shutdown()
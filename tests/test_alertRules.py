@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from Cass import alertRules
+from Cass import cassandraModel as model
+
+START = datetime(2026, 3, 2, 10)
+
+def reading(account_id, vital_sign_type, timestamp, value):
+    vital_sign_id = model.vital_sign_uuid(account_id, vital_sign_type, timestamp, value)
+    return (vital_sign_id, account_id, vital_sign_type, value, timestamp.date(), model.uuid_bucket(vital_sign_id))
+
+def rules():
+    return alertRules.AlertRules([{"type": "heart rate", "low": 60, "high": 100, "count": 2, "minutes": 10}])
+
+def test_fresh_engine_shares_no_state():
+    engine = rules()
+    assert engine.evaluate('P0001', 'heart rate', 0, 150) is False
+    assert engine.evaluate('P0001', 'heart rate', 60, 150) is True
+
+    fresh = engine.fresh()
+    assert fresh.alarmed == set()
+    assert fresh.evaluate('P0001', 'heart rate', 0, 150) is False
+    assert fresh.evaluate('P0001', 'heart rate', 60, 150) is True
+    assert engine.alarmed == {('P0001', 'heart rate')}
+
+def test_older_readings_are_skipped():
+    engine = rules()
+    engine.evaluate('P0001', 'heart rate', 600, 150)
+    assert engine.evaluate('P0001', 'heart rate', 0, 150) is False
+    assert engine.stats()["out_of_order"] == 1
+
+def test_unsorted_load_alerts_in_time_order(session):
+    # Twenty minutes apart the two readings out of range never share a window
+    rows = [reading('P0001', 'heart rate', START + timedelta(minutes=minutes), 150) for minutes in (0, 20)]
+    stats = model.load_vital_signs(session, rows[::-1], rules=rules())
+    assert stats.alerts == 0
+
+    rows = [reading('P0002', 'heart rate', START + timedelta(minutes=minutes), value)
+            for minutes, value in ((0, 70), (1, 150), (2, 150))]
+    stats = model.load_vital_signs(session, rows[::-1], rules=rules())
+    assert stats.alerts == 1
+
+def test_load_leaves_live_alarms_alone(session, monkeypatch):
+    live = rules()
+    monkeypatch.setattr(model, 'alert_rules', live)
+    rows = [reading('P0001', 'heart rate', START + timedelta(minutes=i), 150) for i in range(3)]
+
+    stats = model.load_vital_signs(session, rows)
+    assert stats.alerts == 1
+    assert live.alarmed == set()
+    assert live.evaluated == 0
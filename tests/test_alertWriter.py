@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from Cass import cassandraModel as model
+
+def alert(account_id):
+    now = datetime.utcnow()
+    return (model.random_dateUUID(now), account_id, now.date(), "Vital Signs", "Vital sign out of range")
+
+def test_writes_alerts(session):
+    writer = model.AlertWriter(session)
+    for account_id in ('P0001', 'P0001', 'P0002'):
+        writer.submit(alert(account_id))
+    assert writer.flush(timeout=5)
+    assert writer.written == 3
+    assert len(list(model.get_alerts_page(session, 'P0001')[0])) == 2
+
+def test_survives_a_failed_batch(session, monkeypatch):
+    writer = model.AlertWriter(session)
+    real_get_prepared = model.get_prepared
+    calls = []
+
+    def failing_once(session, query):
+        calls.append(query)
+        if len(calls) == 1:
+            raise RuntimeError("prepare failed")
+        return real_get_prepared(session, query)
+
+    monkeypatch.setattr(model, 'get_prepared', failing_once)
+    writer.submit(alert('P0001'))
+    assert writer.flush(timeout=5)
+    writer.submit(alert('P0002'))
+    assert writer.flush(timeout=5)
+    assert writer._thread.is_alive()
+    assert (writer.written, writer.errors) == (1, 1)
+
+def test_flush_times_out(session):
+    writer = model.AlertWriter(session)
+    writer._unfinished = 1
+    assert not writer.flush(timeout=0.05)
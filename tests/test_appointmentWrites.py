@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from Cass import asyncModel
+from Cass import cassandraModel as model
+
+WHEN = datetime(2026, 3, 2, 10)
+
+def appointment():
+    return [model.random_dateUUID(WHEN), WHEN, 'P0001', 'D0001', "Scheduled", ""]
+
+@pytest.fixture
+def flaky(session, monkeypatch):
+    # Fails the appointments_by_pd write failures[0] times
+    failures = [1]
+    execute_async = session.execute_async
+    monkeypatch.setattr(model, 'APPOINTMENT_RETRY_DELAY', 0)
+
+    def spy(query, *args, **kwargs):
+        text = getattr(getattr(query, 'prepared_statement', None), 'query_string', '')
+        if 'appointments_by_pd' in text and failures[0]:
+            failures[0] -= 1
+            return execute_async("SELECT * FROM no_such_table", *args, **kwargs)
+        return execute_async(query, *args, **kwargs)
+
+    monkeypatch.setattr(session, 'execute_async', spy)
+    return failures
+
+def insert(session, mode, asynchronous):
+    if asynchronous:
+        return asyncio.run(asyncModel.insert_appointment(session, appointment(), mode=mode))
+    return model.insert_appointment(session, appointment(), mode=mode)
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_failed_write_is_retried_alone(session, flaky, asynchronous):
+    report = insert(session, 'concurrent', asynchronous)
+    assert report.ok and report.attempts == 2
+    assert sorted(report.succeeded) == sorted(['appointments_by_patient', 'appointments_by_doctor',
+                                               'appointments_by_pd', 'appointments_by_doctor_day'])
+    assert len(model.find_conflicts(session, 'D0001', WHEN)) == 1
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_exhausted_retries_are_reported_not_raised(session, flaky, asynchronous):
+    flaky[0] = model.APPOINTMENT_WRITE_RETRIES + 1
+    report = insert(session, 'concurrent', asynchronous)
+    assert not report.ok
+    assert [table for table, error in report.failed] == ['appointments_by_pd']
+    assert report.attempts == model.APPOINTMENT_WRITE_RETRIES + 1
+    assert len(report.succeeded) == 3
@@ -0,0 +1,19 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from Cass import asyncModel
+from Cass import cassandraModel as model
+
+HOUR = datetime(2026, 3, 2, 10)
+
+def test_async_delete_rebuilds_rollups(session):
+    rows = []
+    for i, value in enumerate([60, 70, 80]):
+        timestamp = HOUR + timedelta(minutes=i * 20)
+        vital_sign_id = model.vital_sign_uuid('P0001', 'heart rate', timestamp, value)
+        rows.append((vital_sign_id, 'P0001', 'heart rate', value, timestamp.date(), model.uuid_bucket(vital_sign_id)))
+    model.load_vital_signs(session, rows)
+
+    asyncio.run(asyncModel.delete_vital_signs(session, 'P0001', HOUR, HOUR + timedelta(minutes=30)))
+    _, [hour] = model.get_vital_signs_summary(session, 'P0001', 'heart rate', HOUR, HOUR + timedelta(hours=1))
+    assert (hour.count, hour.min_value) == (1, 80)
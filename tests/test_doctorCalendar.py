@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from Cass import cassandraModel as model
+
+def book(session, doctor_id, patient_id, when, status="Scheduled"):
+    appointmentData = [model.random_dateUUID(when), when, patient_id, doctor_id, status, ""]
+    assert model.insert_appointment(session, appointmentData).ok
+
+def test_overlapping_slot_conflicts(session):
+    book(session, 'D0001', 'P0001', datetime(2026, 3, 2, 10, 0))
+
+    [row] = model.find_conflicts(session, 'D0001', datetime(2026, 3, 2, 10, 15))
+    assert row.patient_id == 'P0001'
+    assert model.find_conflicts(session, 'D0002', datetime(2026, 3, 2, 10, 15)) == []
+
+def test_back_to_back_slots_do_not_conflict(session):
+    book(session, 'D0001', 'P0001', datetime(2026, 3, 2, 10, 0))
+
+    assert model.find_conflicts(session, 'D0001', datetime(2026, 3, 2, 10, 30)) == []
+    assert model.find_conflicts(session, 'D0001', datetime(2026, 3, 2, 9, 30)) == []
+
+def test_conflicts_across_midnight(session):
+    book(session, 'D0001', 'P0001', datetime(2026, 3, 2, 23, 50))
+    book(session, 'D0001', 'P0002', datetime(2026, 3, 4, 0, 5))
+
+    [row] = model.find_conflicts(session, 'D0001', datetime(2026, 3, 3, 0, 10))
+    assert row.patient_id == 'P0001'
+    [row] = model.find_conflicts(session, 'D0001', datetime(2026, 3, 3, 23, 45))
+    assert row.patient_id == 'P0002'
+
+def test_cancelled_appointments_free_their_slot(session):
+    book(session, 'D0001', 'P0001', datetime(2026, 3, 2, 10, 0), status="Cancelled")
+
+    assert model.find_conflicts(session, 'D0001', datetime(2026, 3, 2, 10, 0)) == []
+
+def test_calendar_lists_each_day(session):
+    book(session, 'D0001', 'P0001', datetime(2026, 3, 2, 10, 0))
+    book(session, 'D0001', 'P0002', datetime(2026, 3, 2, 9, 0))
+
+    calendar = model.get_doctor_calendar(session, 'D0001', datetime(2026, 3, 2), days=2)
+    assert [[row.patient_id for row in rows] for rows in calendar.values()] == [['P0002', 'P0001'], []]
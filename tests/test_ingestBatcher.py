@@ -0,0 +1,40 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from Cass import cassandraModel as model
+from Cass import ingestBatcher
+
+HOUR = datetime(2026, 3, 2, 10)
+
+def test_concurrent_batches_of_one_hour_roll_up_every_reading(session):
+    # Small batches so several are in flight on the same hour at once
+    readings = [[ingestBatcher.vital_sign_row(f'P000{device}', 'heart rate', 60 + i,
+                                              HOUR + timedelta(seconds=device * 100 + i))
+                 for i in range(20)] for device in range(5)]
+
+    async def run():
+        batcher = ingestBatcher.IngestBatcher(session, flush_ms=1, max_batch=7, max_in_flight=4)
+        await batcher.start()
+        written = await asyncio.gather(*(batcher.submit(rows) for rows in readings))
+        await batcher.close()
+        return batcher, written
+
+    batcher, written = asyncio.run(run())
+    assert written == [20] * 5
+    assert batcher.stats.readings == 100 and not batcher.stats.errors
+    assert not batcher._writes
+    for device in range(5):
+        _, [hour] = model.get_vital_signs_summary(session, f'P000{device}', 'heart rate', HOUR, HOUR + timedelta(hours=1))
+        assert (hour.count, hour.min_value, hour.max_value) == (20, 60, 79)
+
+def test_submit_after_close_is_turned_away(session):
+    async def run():
+        batcher = ingestBatcher.IngestBatcher(session)
+        await batcher.start()
+        await batcher.close()
+        await batcher.submit([ingestBatcher.vital_sign_row('P0001', 'heart rate', 70, HOUR)])
+
+    with pytest.raises(ingestBatcher.IngestBusy):
+        asyncio.run(run())
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+from Cass import cassandraModel as model
+
+HOUR = datetime(2026, 3, 2, 10)
+
+def reading(account_id, vital_sign_type, timestamp, value):
+    vital_sign_id = model.vital_sign_uuid(account_id, vital_sign_type, timestamp, value)
+    return (vital_sign_id, account_id, vital_sign_type, value, timestamp.date(), model.uuid_bucket(vital_sign_id))
+
+def test_ward_fetch_returns_newest_reading_per_type(session):
+    model.load_vital_signs(session, [reading('P0001', 'heart rate', HOUR, 70.0),
+                                     reading('P0001', 'heart rate', HOUR + timedelta(minutes=5), 75.0),
+                                     reading('P0001', 'temperature', HOUR, 36.6),
+                                     reading('P0002', 'heart rate', HOUR, 64.0)])
+
+    latest = model.get_latest_vitals(session, ['P0001', 'P0002', 'P0003', 'P0001'])
+    assert list(latest) == ['P0001', 'P0002', 'P0003']
+    assert {vital_sign_type: row.value for vital_sign_type, row in latest['P0001'].items()} == {
+        'heart rate': 75.0, 'temperature': 36.6}
+    assert latest['P0002']['heart rate'].value == 64.0
+    assert latest['P0003'] == {}
+
+def test_older_reading_never_replaces_the_snapshot(session):
+    model.insert_vital_sign(session, reading('P0001', 'heart rate', HOUR + timedelta(minutes=5), 75.0))
+    model.insert_vital_sign(session, reading('P0001', 'heart rate', HOUR, 70.0))
+
+    assert model.get_latest_vitals(session, ['P0001'])['P0001']['heart rate'].value == 75.0
+
+def test_deleting_the_newest_reading_clears_the_snapshot(session):
+    model.load_vital_signs(session, [reading('P0001', 'heart rate', HOUR, 70.0),
+                                     reading('P0001', 'heart rate', HOUR + timedelta(minutes=5), 75.0)])
+
+    model.delete_vital_signs(session, 'P0001', HOUR + timedelta(minutes=1), HOUR + timedelta(minutes=10))
+    assert model.get_latest_vitals(session, ['P0001'])['P0001'] == {}
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from Cass import cassandraModel as model
+
+LEGACY_TABLE = """
+    CREATE TABLE IF NOT EXISTS vital_signs_by_account_date (
+        account_id text,
+        date date,
+        vital_sign_id timeuuid,
+        type text,
+        value double,
+        PRIMARY KEY ((account_id), date, vital_sign_id)
+    )
+"""
+
+def test_migration_without_legacy_table_is_a_no_op(session):
+    assert model.migrate_vital_sign_buckets(session).rows == 0
+
+def test_migration_copies_legacy_rows(session):
+    session.execute(LEGACY_TABLE)
+    timestamp = datetime(2026, 3, 2, 10)
+    vital_sign_id = model.vital_sign_uuid('P0001', 'heart rate', timestamp, 72.0)
+    session.execute("INSERT INTO vital_signs_by_account_date(account_id, date, vital_sign_id, type, value) "
+                    "VALUES (%s, %s, %s, %s, %s)", ('P0001', timestamp.date(), vital_sign_id, 'heart rate', 72.0))
+
+    assert model.migrate_vital_sign_buckets(session).rows == 1
+    [row] = model.get_vital_signs_range(session, 'P0001', datetime(2026, 3, 1), datetime(2026, 3, 3))
+    assert row.vital_sign_id == vital_sign_id
@@ -0,0 +1,32 @@
+from Cass import queryStats
+
+def families(text):
+    # Family of each sample line, in order
+    names = []
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name = line.split('{')[0]
+            # The histogram's _bucket, _sum and _count series are one family
+            if name.startswith('cassandra_query_latency_seconds'):
+                name = 'cassandra_query_latency_seconds'
+            names.append(name)
+    return names
+
+def test_text_format_groups_each_family():
+    stats = queryStats.QueryStats()
+    for name, rows in (('SELECT_ALERTS', 3), ('INSERT_ALERT', 0)):
+        statement = stats._stats.setdefault(name, queryStats.StatementStats())
+        statement.record(0.002)
+        statement.rows = rows
+
+    text = stats.text_format()
+    names = families(text)
+    # Every family is one contiguous run of samples
+    runs = [name for i, name in enumerate(names) if i == 0 or names[i - 1] != name]
+    assert runs == ['cassandra_query_latency_seconds', 'cassandra_query_rows_total',
+                    'cassandra_query_errors_total', 'cassandra_query_retries_total']
+    for family in runs:
+        assert f"# HELP {family} " in text
+        assert f"# TYPE {family} " in text
+        assert text.index(f"# TYPE {family} ") < text.index(f"\n{family}")
+    assert 'cassandra_query_rows_total{statement="SELECT_ALERTS"} 3' in text
@@ -0,0 +1,8 @@
+from Cass import cassandraModel as model
+
+def test_retention_job_waits_before_its_first_scan(session):
+    job = model.RetentionJob(session, interval_hours=1, delay=60)
+    job.stop()
+    job._thread.join(timeout=5)
+    assert not job._thread.is_alive()
+    assert job.last_run is None
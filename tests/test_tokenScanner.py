@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+import pyarrow.parquet as pq
+
+from Cass import cassandraModel as model
+from Cass import tokenScanner
+
+def load(session, accounts, readings):
+    start = datetime(2026, 3, 2, 10)
+    rows = []
+    for account in range(accounts):
+        for i in range(readings):
+            timestamp = start + timedelta(minutes=i)
+            vital_sign_id = model.vital_sign_uuid(f'P{account:04}', 'heart rate', timestamp, 60 + i)
+            rows.append((vital_sign_id, f'P{account:04}', 'heart rate', 60.0 + i, timestamp.date(),
+                         model.uuid_bucket(vital_sign_id)))
+    model.load_vital_signs(session, rows)
+
+def test_scan_streams_row_groups(session, tmp_path):
+    load(session, 20, 15)
+    path = tmp_path / 'scan.parquet'
+
+    stats = tokenScanner.scan_to_file(session, 'vital_signs_by_account_type_bucket', str(path),
+                                      columns=['account_id', 'vital_sign_id', 'value'],
+                                      row_group_rows=50, splits=8, parallelism=2, fetch_size=40)
+    file = pq.ParquetFile(path)
+    assert stats.rows == file.metadata.num_rows == 300
+    assert file.metadata.num_row_groups > 1
+    table = file.read()
+    assert len(set(table.column('vital_sign_id').to_pylist())) == 300
+    assert table.schema.field('value').type == 'double'
+
+def test_scan_filters_rows(session, tmp_path):
+    load(session, 4, 5)
+    path = tmp_path / 'scan.parquet'
+
+    tokenScanner.scan_to_file(session, 'vital_signs_by_account_type_bucket', str(path),
+                              where=lambda row: row.account_id == 'P0001')
+    assert set(pq.read_table(path).column('account_id').to_pylist()) == {'P0001'}
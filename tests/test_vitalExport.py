@@ -0,0 +1,65 @@
+import glob
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pytest
+
+from Cass import cassandraModel as model
+from Cass import vitalExport
+
+Reading = namedtuple('Reading', ['vital_sign_id', 'account_id', 'type', 'value', 'date'])
+
+def reading(account_id, vital_sign_type, timestamp, value=70.0):
+    return Reading(model.vital_sign_uuid(account_id, vital_sign_type, timestamp, value),
+                   account_id, vital_sign_type, value, timestamp.date())
+
+def read_files(out_dir, file_format):
+    paths = sorted(glob.glob(os.path.join(out_dir, '**', f'*.{file_format}'), recursive=True))
+    if file_format == 'arrow':
+        return pa.concat_tables([pa.ipc.open_file(path).read_all() for path in paths])
+    return ds.dataset(paths, format='parquet').to_table()
+
+@pytest.mark.parametrize('file_format', ['parquet', 'arrow'])
+def test_partition_spanning_several_batches(tmp_path, file_format):
+    # Each batch of one partition carries a different set of types
+    timestamp = datetime(2024, 5, 1, 10)
+    types = ['heart rate', 'heart rate', 'temperature', 'oxygenation']
+    writer = vitalExport.PartitionWriter(str(tmp_path), file_format, batch_rows=2)
+    for i, vital_sign_type in enumerate(types):
+        writer.add(reading('P0001', vital_sign_type, timestamp + timedelta(minutes=i)))
+    writer.close()
+
+    table = read_files(str(tmp_path), file_format)
+    assert writer.rows == 4
+    assert writer.files == 1
+    assert sorted(table.column('type').to_pylist()) == sorted(types)
+
+def test_buffers_are_bounded_across_partitions(tmp_path):
+    writer = vitalExport.PartitionWriter(str(tmp_path), 'parquet', batch_rows=10)
+    timestamp = datetime(2024, 5, 1, 10)
+    for day in range(25):
+        # A new date partition for every reading
+        writer.add(reading('P0001', 'heart rate', timestamp + timedelta(days=day)))
+        assert writer._buffered < 10
+    writer.close()
+    assert writer.rows == 25
+    assert len(read_files(str(tmp_path), 'parquet')) == 25
+
+def test_export_vital_signs(session, tmp_path):
+    now = datetime.utcnow().replace(microsecond=0)
+    rows = []
+    for account_id in ('P0001', 'P0002', 'P0003'):
+        for i in range(20):
+            data = reading(account_id, 'heart rate', now - timedelta(hours=i * 5), 60.0 + i)
+            rows.append(tuple(data) + (model.uuid_bucket(data.vital_sign_id),))
+    model.load_vital_signs(session, rows)
+
+    written, files = vitalExport.export_vital_signs(session, str(tmp_path), start_date=now - timedelta(days=7),
+                                                    end_date=now + timedelta(minutes=1), batch_rows=16)
+    table = read_files(str(tmp_path), 'parquet')
+    assert written == 60
+    assert sorted(set(table.column('account_id').to_pylist())) == ['P0001', 'P0002', 'P0003']
+    assert sorted(table.column('value').to_pylist()) == sorted(row[3] for row in rows)
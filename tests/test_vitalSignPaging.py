@@ -0,0 +1,93 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from Cass import asyncModel
+from Cass import cassandraModel as model
+
+START = datetime(2026, 1, 1)
+END = START + timedelta(days=120)
+
+@pytest.fixture
+def readings(session):
+    rows = []
+    for day in range(0, 120, 2):
+        timestamp = START + timedelta(days=day, hours=9)
+        vital_sign_id = model.vital_sign_uuid('P0001', 'heart rate', timestamp, 70.0 + day)
+        rows.append((vital_sign_id, 'P0001', 'heart rate', 70.0 + day, timestamp.date(),
+                     model.uuid_bucket(vital_sign_id)))
+    model.load_vital_signs(session, rows)
+    return sorted((row[0] for row in rows), key=lambda vital_sign_id: vital_sign_id.time, reverse=True)
+
+def sync_pages(session, fetch_size):
+    pages, state = [], None
+    while True:
+        rows, state = model.get_vital_signs_page(session, 'P0001', START, END, fetch_size=fetch_size,
+                                                 paging_state=state)
+        pages.append([row.vital_sign_id for row in rows])
+        if state is None:
+            return pages
+
+def async_pages(session, fetch_size):
+    async def run():
+        pages, state = [], None
+        while True:
+            rows, state = await asyncModel.get_vital_signs(session, 'P0001', START, END, fetch_size=fetch_size,
+                                                           paging_state=state)
+            pages.append([row.vital_sign_id for row in rows])
+            if state is None:
+                return pages
+    return asyncio.run(run())
+
+@pytest.mark.parametrize('fetch_size', [7, 20, 100])
+def test_pages_cover_every_reading_once_newest_first(session, readings, fetch_size):
+    pages = sync_pages(session, fetch_size)
+    assert all(len(page) <= fetch_size for page in pages)
+    assert [vital_sign_id for page in pages for vital_sign_id in page] == readings
+
+@pytest.mark.parametrize('fetch_size', [7, 20, 100])
+def test_pages_read_only_what_they_return(session, readings, fetch_size, monkeypatch):
+    # Every request asks for at most the room left, never for an unpaged
+    # read, and rows read to be dropped stay under one page per call
+    sizes, read = [], []
+    execute_async = session.execute_async
+
+    def spy(query, *args, **kwargs):
+        sizes.append(query.fetch_size)
+        future = execute_async(query, *args, **kwargs)
+        future.add_callback(lambda page: read.append(len(page or [])))
+        return future
+
+    monkeypatch.setattr(session, 'execute_async', spy)
+    pages = sync_pages(session, fetch_size)
+    assert all(0 < size <= fetch_size for size in sizes)
+    assert sum(read) <= len(readings) + len(pages) * fetch_size
+
+def test_full_page_stops_before_the_next_bucket(session, monkeypatch):
+    end = END - timedelta(days=1)
+    rows = []
+    for minute in range(5):
+        timestamp = end + timedelta(minutes=minute)
+        vital_sign_id = model.vital_sign_uuid('P0002', 'heart rate', timestamp, 70.0)
+        rows.append((vital_sign_id, 'P0002', 'heart rate', 70.0, timestamp.date(), model.uuid_bucket(vital_sign_id)))
+    model.load_vital_signs(session, rows)
+
+    requests = []
+    execute_async = session.execute_async
+    monkeypatch.setattr(session, 'execute_async',
+                        lambda query, *args, **kwargs: requests.append(query) or execute_async(query, *args, **kwargs))
+    page, state = model.get_vital_signs_page(session, 'P0002', START, END, fetch_size=5)
+    assert len(page) == 5 and state is not None
+    assert len(requests) == 1
+
+@pytest.mark.parametrize('fetch_size', [7, 20])
+def test_async_pages_match_model_pages(session, readings, fetch_size):
+    assert async_pages(session, fetch_size) == sync_pages(session, fetch_size)
+
+def test_async_summary_matches_model(session, readings):
+    expected = model.get_vital_signs_summary(session, 'P0001', 'heart rate', START.date(), END.date())
+    resolution, rows = asyncio.run(asyncModel.get_vital_signs_summary(session, 'P0001', 'heart rate',
+                                                                       START.date(), END.date()))
+    assert resolution == expected[0] == 'day'
+    assert [row.count for row in rows] == [row.count for row in expected[1]] == [1] * 60
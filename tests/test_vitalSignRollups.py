@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from Cass import asyncModel
+from Cass import cassandraModel as model
+from Cass import clusterProfile
+from Cass import quantileSketch
+
+HOUR = datetime(2026, 3, 2, 10)
+
+def reading(account_id, vital_sign_type, timestamp, value):
+    vital_sign_id = model.vital_sign_uuid(account_id, vital_sign_type, timestamp, value)
+    return (vital_sign_id, account_id, vital_sign_type, value, timestamp.date(), model.uuid_bucket(vital_sign_id))
+
+def load(session, account_id, vital_sign_type, timestamps, values):
+    rows = [reading(account_id, vital_sign_type, timestamp, value) for timestamp, value in zip(timestamps, values)]
+    model.load_vital_signs(session, rows)
+    return rows
+
+def hourly(session, account_id, vital_sign_type):
+    _, rows = model.get_vital_signs_summary(session, account_id, vital_sign_type, HOUR - timedelta(days=1),
+                                            HOUR + timedelta(days=1))
+    return rows
+
+def test_load_builds_hour_and_day_rollups(session):
+    load(session, 'P0001', 'heart rate', [HOUR + timedelta(minutes=i * 10) for i in range(5)], [60, 70, 80, 90, 100])
+
+    [hour] = hourly(session, 'P0001', 'heart rate')
+    assert (hour.count, hour.min_value, hour.max_value, hour.avg_value) == (5, 60, 100, 80)
+    readings, percentiles = model.get_vital_sign_percentiles(session, 'P0001', 'heart rate', HOUR - timedelta(days=2),
+                                                             HOUR + timedelta(days=2))
+    assert readings == 5
+    assert percentiles[50] == 80
+
+def test_delete_rebuilds_rollups(session):
+    timestamps = [HOUR + timedelta(minutes=i * 10) for i in range(5)]
+    load(session, 'P0001', 'heart rate', timestamps, [60, 70, 80, 90, 100])
+
+    # Half the hour goes, the rest is summarized again
+    model.delete_vital_signs(session, 'P0001', HOUR, HOUR + timedelta(minutes=15))
+    [hour] = hourly(session, 'P0001', 'heart rate')
+    assert (hour.count, hour.min_value) == (3, 80)
+
+    # The whole hour goes, and so do its rollups and sketches
+    model.delete_vital_signs(session, 'P0001', HOUR - timedelta(hours=1), HOUR + timedelta(hours=2))
+    assert hourly(session, 'P0001', 'heart rate') == []
+    readings, percentiles = model.get_vital_sign_percentiles(session, 'P0001', 'heart rate', HOUR - timedelta(days=2),
+                                                             HOUR + timedelta(days=2))
+    assert readings == 0
+    assert model.get_daily_percentiles(session, 'P0001', 'heart rate', HOUR - timedelta(days=2),
+                                       HOUR + timedelta(days=2)) == []
+
+def test_purge_drops_expired_rollups(session):
+    old = datetime.utcnow() - timedelta(days=model.ROLLUP_RETENTION_DAYS + 10)
+    recent = datetime.utcnow() - timedelta(days=1)
+    load(session, 'P0001', 'heart rate', [old, recent], [70, 75])
+
+    model.purge_expired(session, rate=0)
+    _, rows = model.get_vital_signs_summary(session, 'P0001', 'heart rate', old - timedelta(days=1),
+                                            datetime.utcnow(), max_points=10 ** 6)
+    assert [row.count for row in rows] == [1]
+    assert len(list(model.get_vital_signs_range(session, 'P0001', old - timedelta(days=1), datetime.utcnow()))) == 1
+
+def test_insert_marks_hour_for_background_refresh(session):
+    model.insert_vital_sign(session, reading('P0001', 'heart rate', HOUR + timedelta(minutes=5), 72.0))
+    model.insert_vital_sign(session, reading('P0001', 'heart rate', HOUR + timedelta(minutes=6), 76.0))
+
+    assert model.get_rollup_refresher(session).flush(timeout=5)
+    [hour] = hourly(session, 'P0001', 'heart rate')
+    assert (hour.count, hour.avg_value) == (2, 74)
+
+def test_inserts_write_at_the_refresh_read_profile(session, monkeypatch):
+    # Rollup rebuilds read at the bulk profile, the writes they follow must
+    # reach the same quorum
+    monkeypatch.setattr(model, 'profile_for', lambda session, name: name)
+    profiles = []
+    execute_async = session.execute_async
+
+    def spy(query, *args, **kwargs):
+        if getattr(query, 'prepared_statement', query).query_string.strip().startswith(('INSERT', 'DELETE')):
+            profiles.append(kwargs.get('execution_profile'))
+        return execute_async(query, *args, **kwargs)
+
+    monkeypatch.setattr(session, 'execute_async', spy)
+    model.insert_vital_sign(session, reading('P0001', 'heart rate', HOUR + timedelta(minutes=5), 72.0))
+    asyncio.run(asyncModel.insert_vital_sign(session, reading('P0001', 'heart rate', HOUR + timedelta(minutes=6), 76.0)))
+    model.delete_vital_signs(session, 'P0001', HOUR, HOUR + timedelta(minutes=30))
+    assert profiles and set(profiles) == {clusterProfile.PROFILE_BULK}
+
+def test_later_rebuild_wins_when_it_lands_first(session):
+    timestamps = [HOUR + timedelta(minutes=i) for i in range(3)]
+    [first] = load(session, 'P0001', 'heart rate', timestamps[:1], [60])
+    key = model.rollup_key('P0001', 'heart rate', first[0])
+
+    # A rebuild that read one reading and stalls before writing, while a
+    # later one reads all three and lands first
+    started = model._read_start()
+    stale = [(key, (60.0, 60.0, 60.0, 60.0, 1), quantileSketch.TDigest.from_values([60]))]
+    load(session, 'P0001', 'heart rate', timestamps[1:], [70, 80])
+    model._write_rollups(session, 'hour', stale, started, concurrency=1)
+
+    [hour] = hourly(session, 'P0001', 'heart rate')
+    assert hour.count == 3
+
+def test_delete_covers_types_outside_the_configuration(session):
+    load(session, 'P0001', 'glucose', [HOUR, HOUR + timedelta(minutes=10)], [5.1, 5.6])
+
+    model.delete_vital_signs(session, 'P0001', HOUR - timedelta(hours=1), HOUR + timedelta(hours=1))
+    assert list(model.get_vital_signs_range(session, 'P0001', HOUR - timedelta(days=1), HOUR + timedelta(days=1),
+                                            vital_sign_type='glucose')) == []
+    assert hourly(session, 'P0001', 'glucose') == []
+
+def test_refresher_stops_with_its_session(session):
+    refresher = model.RollupRefresher(session, interval=0.01)
+    session.cluster.shutdown()
+    refresher.mark([('P0001', 'heart rate', 0)])
+
+    assert not refresher.flush(timeout=5)
+    refresher._thread.join(timeout=5)
+    assert not refresher._thread.is_alive()
+
+def test_delete_covers_types_whose_snapshot_is_gone(session):
+    load(session, 'P0001', 'glucose', [HOUR, HOUR + timedelta(days=2)], [5.1, 5.6])
+    # Takes the newest reading, and with it the snapshot of the type
+    model.delete_vital_signs(session, 'P0001', HOUR + timedelta(days=1), HOUR + timedelta(days=3))
+    assert model.get_latest_vitals(session, ['P0001'])['P0001'] == {}
+
+    model.delete_vital_signs(session, 'P0001', HOUR - timedelta(hours=1), HOUR + timedelta(hours=1))
+    assert list(model.get_vital_signs_range(session, 'P0001', HOUR - timedelta(days=1), HOUR + timedelta(days=3),
+                                            vital_sign_type='glucose')) == []
+
+def test_migration_indexes_types_written_before_the_index(session):
+    [row] = [reading('P0001', 'glucose', HOUR, 5.1)]
+    session.execute(model.get_prepared(session, model.INSERT_VITAL_SIGN_BY_ACCOUNT_TYPE_BUCKET), row)
+    assert model.index_vital_sign_types(session) == 1
+
+    model.delete_vital_signs(session, 'P0001', HOUR - timedelta(hours=1), HOUR + timedelta(hours=1))
+    assert list(model.get_vital_signs_range(session, 'P0001', HOUR - timedelta(days=1), HOUR + timedelta(days=1),
+                                            vital_sign_type='glucose')) == []